@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Measure the CPU cost and bytes saved by each response compression setting.
+
+Samples are URLs (fetched uncompressed from a running deployment) or local
+files, e.g. an inbox page, a share page and a CSV export:
+
+    python benchmarks/bench_compression.py http://localhost:5000/inbox \\
+        http://localhost:5000/note/<uuid> export.csv --cookie session=<id>
+
+Each sample is compressed the way CompressionMiddleware streams it (in 8 KB
+chunks) at several gzip levels and brotli qualities.
+"""
+import argparse
+import time
+import zlib
+
+import httpx
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CHUNK_SIZE = 8192
+
+
+def load(sample, cookies):
+    if sample.startswith(('http://', 'https://')):
+        response = httpx.get(sample, cookies=cookies, headers={'Accept-Encoding': 'identity'},
+                             follow_redirects=True, timeout=60)
+        response.raise_for_status()
+        return response.content
+    with open(sample, 'rb') as f:
+        return f.read()
+
+
+def gzip_stream(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    size = 0
+    for i in range(0, len(data), CHUNK_SIZE):
+        size += len(compressor.compress(data[i:i + CHUNK_SIZE]))
+    return size + len(compressor.flush())
+
+
+def brotli_stream(data, quality):
+    compressor = brotli.Compressor(quality=quality)
+    size = 0
+    for i in range(0, len(data), CHUNK_SIZE):
+        size += len(compressor.process(data[i:i + CHUNK_SIZE]))
+    return size + len(compressor.finish())
+
+
+def measure(compress, data, setting, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        size = compress(data, setting)
+    return size, (time.process_time() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('samples', nargs='+', help='URLs or files')
+    parser.add_argument('--cookie', action='append', default=[], help='name=value')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    cookies = dict(c.split('=', 1) for c in args.cookie)
+    settings = [('gzip', gzip_stream, level) for level in (1, 4, 6, 9)]
+    if brotli is not None:
+        settings += [('br', brotli_stream, quality) for quality in (1, 4, 5, 8, 11)]
+
+    print(f"{'sample':<40}{'codec':>6}{'level':>6}{'bytes':>12}{'saved':>8}{'ms':>9}{'MB/s':>8}")
+    for sample in args.samples:
+        data = load(sample, cookies)
+        print(f'{sample[-40:]:<40}{"-":>6}{"-":>6}{len(data):>12}')
+        for codec, compress, setting in settings:
+            size, seconds = measure(compress, data, setting, args.repeat)
+            saved = 1 - size / len(data) if data else 0
+            rate = len(data) / seconds / 1e6 if seconds else float('inf')
+            print(f'{"":<40}{codec:>6}{setting:>6}{size:>12}{saved:>8.1%}'
+                  f'{seconds * 1000:>9.2f}{rate:>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
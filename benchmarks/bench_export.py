@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Compare note export throughput as CSV, Parquet and an Arrow stream.
+
+Times `flask export-notes` in each format against the configured database
+(the usual environment variables must be set, and pyarrow installed), for
+every note or one inbox's, and reports size, speed and peak memory:
+
+    python benchmarks/bench_export.py --inbox bench
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import pyarrow.parquet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXTENSIONS = {'arrow': 'arrows'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--inbox', help='export one inbox (default: every note)')
+    parser.add_argument('--formats', default='parquet,arrow,csv')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='export-bench-')
+    rows = None
+    for export_format in args.formats.split(','):
+        path = os.path.join(directory, f'notes.{EXTENSIONS.get(export_format, export_format)}')
+        command = [sys.executable, '-m', 'flask', 'export-notes', path, '--format', export_format]
+        if args.inbox:
+            command += ['--inbox', args.inbox]
+        start = time.monotonic()
+        process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                                   env=dict(os.environ, FLASK_APP='saythanks'))
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.monotonic() - start
+        if os.waitstatus_to_exitcode(status):
+            sys.exit(f'{export_format} export failed')
+        if export_format == 'parquet':
+            rows = pyarrow.parquet.read_metadata(path).num_rows
+        size = os.path.getsize(path) / 1e6
+        print(f'{export_format:>8}: {elapsed:6.1f}s, {size:8.1f} MB, {size / elapsed:6.1f} MB/s'
+              + (f', {rows / elapsed:8.0f} notes/s' if rows else '')
+              + f', peak RSS {usage.ru_maxrss / 1024:.0f} MB')
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Measure first-request latency per route on a freshly started worker.
+
+Starts a single-worker `gunicorn -c gunicorn.conf.py saythanks:app` (the
+usual environment variables must be set) in each mode and times the first
+request to each route:
+
+    cold      no template warm-up, empty bytecode cache
+    bytecode  no template warm-up, cache filled by `flask precompile-templates`
+    warm      warm-up in the master plus the filled cache (the default setup)
+
+    python benchmarks/bench_first_request.py --inbox me --note <uuid>
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for_port(port, timeout=60):
+    # Only probe the socket: an HTTP request would be the first request.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('gunicorn did not start')
+
+
+def first_requests(env, port, paths):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'saythanks:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        timings = []
+        with httpx.Client(base_url=f'http://127.0.0.1:{port}', timeout=30) as client:
+            for path in paths:
+                start = time.monotonic()
+                client.get(path)
+                timings.append(time.monotonic() - start)
+        return timings
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--inbox', required=True)
+    parser.add_argument('--note', required=True)
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    paths = ['/', f'/to/{args.inbox}', f'/note/{args.note}']
+    base = dict(os.environ, PORT=str(args.port), WEB_CONCURRENCY='1', GUNICORN_PROFILE='sync')
+    empty_cache = tempfile.mkdtemp(prefix='jinja-empty-')
+    filled_cache = tempfile.mkdtemp(prefix='jinja-filled-')
+    subprocess.run([sys.executable, '-m', 'flask', 'precompile-templates'], cwd=ROOT, check=True,
+                   env=dict(base, FLASK_APP='saythanks', JINJA_CACHE_DIR=filled_cache))
+    modes = {
+        'cold': dict(base, WARM_TEMPLATES='0', JINJA_CACHE_DIR=empty_cache),
+        'bytecode': dict(base, WARM_TEMPLATES='0', JINJA_CACHE_DIR=filled_cache),
+        'warm': dict(base, WARM_TEMPLATES='1', JINJA_CACHE_DIR=filled_cache),
+    }
+
+    print(f"{'mode':<10}" + ''.join(f'{path[:18]:>20}' for path in paths) + '   (median ms)')
+    for mode, env in modes.items():
+        runs = []
+        for _ in range(args.runs):
+            if mode == 'cold':
+                for name in os.listdir(empty_cache):
+                    os.remove(os.path.join(empty_cache, name))
+            runs.append(first_requests(env, args.port, paths))
+        medians = [statistics.median(run[i] for run in runs) * 1000 for i in range(len(paths))]
+        print(f'{mode:<10}' + ''.join(f'{m:>20.1f}' for m in medians))
+
+
+if __name__ == '__main__':
+    main()
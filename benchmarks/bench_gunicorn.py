@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Compare gunicorn worker profiles under the same load.
+
+Starts `gunicorn -c gunicorn.conf.py saythanks:app` once per profile (the
+usual environment variables must be set) and drives it with the load from
+bench_serving.py:
+
+    python benchmarks/bench_gunicorn.py --inbox me --note <uuid> --profiles sync gthread
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from bench_serving import run
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_until_up(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(base_url + '/', timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    raise RuntimeError('gunicorn did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--inbox', required=True)
+    parser.add_argument('--note', required=True)
+    parser.add_argument('--profiles', nargs='+', default=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=20)
+    args = parser.parse_args()
+
+    base_url = f'http://127.0.0.1:{args.port}'
+    requests = [('GET', f'/to/{args.inbox}', None), ('GET', f'/note/{args.note}', None)]
+    print(f"{'profile':<10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for profile in args.profiles:
+        env = dict(os.environ, GUNICORN_PROFILE=profile, PORT=str(args.port), RATELIMIT_ENABLED='0')
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'saythanks:app'],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(base_url)
+            latencies, errors = asyncio.run(run(base_url, requests, args.concurrency, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+        print(f'{profile:<10}{len(latencies) / args.duration:>10.1f}'
+              f'{statistics.median(latencies) * 1000 if latencies else 0:>10.1f}'
+              f'{p99 * 1000:>10.1f}{len(errors):>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Measure note import throughput and peak memory on a synthetic file.
+
+Writes an NDJSON (or CSV) file of generated notes, a share of them repeats,
+then times `flask import-notes` loading it into an existing inbox (the
+usual environment variables must be set; the notes stay in the inbox):
+
+    python benchmarks/bench_import.py --inbox bench --notes 1000000 --jobs 4
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORDS = ('thanks', 'for', 'the', 'great', 'library', 'it', 'saved', 'me', 'hours', 'of',
+         'work', 'really', 'appreciate', 'your', 'effort', 'on', 'this', 'project')
+
+
+def generate(path, count, file_format, repeats):
+    random.seed(0)
+    fields = ('body', 'byline')
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fields) if file_format == 'csv' else None
+        if writer:
+            writer.writeheader()
+        for i in range(count):
+            n = i if random.random() >= repeats else random.randrange(max(i, 1))
+            note = {'body': f'Note {n}: ' + ' '.join(random.choices(WORDS, k=20)) + '\n\n*Cheers!*',
+                    'byline': f'User {n % 5000}'}
+            if writer:
+                writer.writerow(note)
+            else:
+                f.write(json.dumps(note) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--inbox', required=True)
+    parser.add_argument('--notes', type=int, default=100000)
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    parser.add_argument('--repeats', type=float, default=0.05, help='share of repeated notes')
+    parser.add_argument('--jobs', type=int, default=1)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='import-bench-'), f'notes.{args.format}')
+    generate(path, args.notes, args.format, args.repeats)
+    print(f'{args.notes} notes, {os.path.getsize(path) / 1e6:.1f} MB of {args.format}')
+
+    start = time.monotonic()
+    subprocess.run([sys.executable, '-m', 'flask', 'import-notes', args.inbox, path,
+                    '--jobs', str(args.jobs)],
+                   cwd=ROOT, check=True, env=dict(os.environ, FLASK_APP='saythanks'))
+    elapsed = time.monotonic() - start
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f'{elapsed:.1f}s, {args.notes / elapsed:.0f} notes/s, peak RSS {peak:.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
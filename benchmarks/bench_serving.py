@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Load-test the public routes of a running saythanks deployment.
+
+Start the deployment under test, then point this script at it, e.g.:
+
+    gunicorn saythanks:app -w 6 -b :8000                          # WSGI
+    gunicorn -k uvicorn.workers.UvicornWorker saythanks.asgi:app -w 6 -b :8001
+                                                                  # ASGI
+    python benchmarks/bench_serving.py http://localhost:8000 --inbox me --note <uuid>
+    python benchmarks/bench_serving.py http://localhost:8001 --inbox me --note <uuid>
+
+Set RATELIMIT_ENABLED=0 on the server when benchmarking submissions.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def worker(client, requests, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        for method, path, data in requests:
+            start = time.monotonic()
+            try:
+                response = await client.request(method, path, data=data)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+            except httpx.HTTPError as e:
+                errors.append(type(e).__name__)
+            latencies.append(time.monotonic() - start)
+
+
+async def run(base_url, requests, concurrency, duration):
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*[
+            worker(client, requests, deadline, latencies, errors)
+            for _ in range(concurrency)])
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base_url')
+    parser.add_argument('--inbox', required=True, help='slug of an existing inbox')
+    parser.add_argument('--note', required=True, help='uuid of an existing note')
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--no-submit', action='store_true', help='skip POSTing notes')
+    args = parser.parse_args()
+
+    requests = [('GET', f'/to/{args.inbox}', None), ('GET', f'/note/{args.note}', None)]
+    if not args.no_submit:
+        form = {'body': 'Thanks for the benchmark!', 'byline': 'bench', 'content-type': 'markdown'}
+        requests.append(('POST', f'/to/{args.inbox}/submit', form))
+
+    latencies, errors = asyncio.run(run(args.base_url, requests, args.concurrency, args.duration))
+    latencies.sort()
+    print(f'requests:    {len(latencies)} ({len(latencies) / args.duration:.1f}/s)')
+    print(f'errors:      {len(errors)}')
+    if latencies:
+        print(f'latency p50: {statistics.median(latencies) * 1000:.1f} ms')
+        print(f'latency p99: {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Gunicorn Configuration
+# ----------------------
+# Used by the Procfile: `gunicorn -c gunicorn.conf.py saythanks:app`.
+#
+# GUNICORN_PROFILE picks the worker class for the expected workload:
+#
+#   sync     one request per worker; CPU-bound pages (the default)
+#   gthread  a few threads per worker; overlaps Postgres/SendGrid waits
+#   gevent   cooperative greenlets; many slow clients (needs `gevent`)
+#
+# WEB_CONCURRENCY, GUNICORN_THREADS and MAX_WORKER_RSS_MB override the
+# derived defaults.
+
+import multiprocessing
+import os
+
+profile = os.environ.get('GUNICORN_PROFILE', 'sync')
+cpus = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+accesslog = '-'
+errorlog = '-'
+
+if profile == 'gthread':
+    worker_class = 'gthread'
+    workers = cpus + 1
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+elif profile == 'gevent':
+    worker_class = 'gevent'
+    workers = cpus
+    worker_connections = 1000
+elif profile == 'sync':
+    worker_class = 'sync'
+    workers = cpus * 2 + 1
+else:
+    raise ValueError(f'Unknown GUNICORN_PROFILE: {profile}')
+
+workers = int(os.environ.get('WEB_CONCURRENCY', workers))
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+# Import the app once in the master so workers fork with it (and its
+# compiled templates) already loaded.
+preload_app = True
+
+# Recycle workers periodically, and early if their memory keeps growing.
+max_requests = 5000
+max_requests_jitter = 500
+max_worker_rss = int(os.environ.get('MAX_WORKER_RSS_MB', 512)) * 1024 * 1024
+
+
+def when_ready(server):
+    import saythanks
+    from saythanks import storage
+
+    # Off only to measure cold starts (benchmarks/bench_first_request.py).
+    if os.environ.get('WARM_TEMPLATES', '1') == '1':
+        saythanks.warm_templates()
+    # Each worker opens its own connections in post_fork.
+    storage.disconnect()
+
+
+def post_fork(server, worker):
+    from saythanks import cache, live, myemail, storage
+
+    storage.reconnect()
+    myemail.reconnect()
+    # By the class actually running, which `-k` may have overridden.
+    live.enable_for(server.cfg.worker_class)
+    if cache.broadcaster:
+        cache.broadcaster.start()
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def post_request(worker, req, environ, resp):
+    try:
+        rss = rss_bytes()
+    except OSError:
+        return
+    if rss > max_worker_rss:
+        worker.log.info('Worker RSS %d MB over limit; recycling', rss // (1024 * 1024))
+        worker.alive = False
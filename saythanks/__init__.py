@@ -1,4 +1,6 @@
 from .core import *
+# Imported for the routes, middleware and hooks they register.
+from . import api, assets, commands, compression, exports, imports, live, snapshots  # noqa: F401
 
 
 @app.context_processor
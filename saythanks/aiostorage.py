@@ -0,0 +1,76 @@
+import os
+import re
+
+import asyncpg
+
+from . import counts
+from .utils import note_text, note_preview, note_event, NOTES_CHANNEL
+
+# Async Storage
+# -------------
+# The handful of queries the public ASGI routes need, on an asyncpg pool.
+# Everything else keeps using the synchronous models in storage.py.
+
+DATABASE_URL = os.environ['DATABASE_URL']
+POOL_SIZE = int(os.environ.get('ASYNC_DB_POOL_SIZE', 20))
+
+pool = None
+
+
+async def connect():
+    global pool
+    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=POOL_SIZE)
+
+
+async def disconnect():
+    await pool.close()
+
+
+async def fetch_inbox(slug):
+    """Returns the inbox row for `slug` (auth_id, enabled, email_enabled,
+    email) in a single round trip, or None if there is no such inbox."""
+    return await pool.fetchrow(
+        'SELECT auth_id, enabled, email_enabled, email FROM inboxes WHERE slug = $1',
+        slug)
+
+
+async def fetch_note(uuid):
+    """Returns the note row for `uuid`, or None if there is no such note."""
+    return await pool.fetchrow(
+        'SELECT uuid, body, byline, body_text FROM notes WHERE uuid = $1::uuid', uuid)
+
+
+def positional(sql, **params):
+    """`sql`, with its :named parameters numbered the way asyncpg expects,
+    followed by their values; for the statements shared with storage.py."""
+    names = []
+
+    def number(match):
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+    sql = re.sub(r'(?<![:\w]):(\w+)', number, sql)
+    return (sql, *[params[name] for name in names])
+
+
+async def store_note(auth_id, body, byline):
+    """Stores a note and returns its generated uuid."""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            body_text = note_text(body)
+            preview = note_preview(body_text)
+            row = await conn.fetchrow(
+                'INSERT INTO notes (body, byline, inboxes_auth_id, body_text, preview) '
+                'VALUES ($1, $2, $3, $4, $5) RETURNING uuid, timestamp',
+                body, byline, auth_id, body_text, preview)
+            # The same counts as storage.Note.store keeps.
+            await conn.execute(*positional(counts.COUNT_NOTES, auth_id=auth_id, active=1, archived=0))
+            if byline and byline.strip():
+                await conn.execute(*positional(counts.ADD_BYLINES, auth_id=auth_id, bylines=[byline], delta=1))
+            await conn.execute(*positional(counts.COUNT_ACTIVITY, auth_id=auth_id,
+                                           timestamps=[row['timestamp']], bylines=[byline]))
+            await conn.execute(
+                'SELECT pg_notify($1, $2)', NOTES_CHANNEL,
+                note_event(auth_id, row['uuid'], byline, preview, row['timestamp']))
+    return row['uuid']
@@ -0,0 +1,209 @@
+import json
+import base64
+import binascii
+from datetime import datetime
+from functools import wraps
+
+from flask import request, session, abort
+
+from .core import app, csrf_token, is_uuid
+from . import storage
+
+# JSON API
+# --------
+# Versioned, read-only JSON views of the signed-in user's inbox, so
+# integrations don't have to scrape the HTML pages:
+#
+#   GET /api/v1/inbox/notes?limit=25&cursor=...&fields=uuid,byline,preview
+#   GET /api/v1/inbox/search?q=...&limit=25&cursor=...&fields=...
+#   GET /api/v1/notes/<uuid>?fields=...
+#   GET /api/v1/inbox/changes?cursor=...&limit=100&fields=...
+#   GET /api/v1/inbox/bylines?prefix=...&limit=10
+#   GET /api/v1/inbox/stats?days=30
+#
+# Listings return an opaque `next` cursor to pass back for the following
+# page (null on the last one). The changes feed always returns one: keep
+# it, and pass it back next time to get only the notes stored, archived or
+# restored since (`more` says whether to ask again right away). Bylines are
+# for autocomplete: the inbox's bylines starting with `prefix`, most used
+# first; pass a `key` back as /inbox?byline=... to list its notes. Stats are
+# the notes received over the last `days` days per day, week and hour of
+# the day, and the top bylines, read from daily rollups. Bodies are
+# only sent when asked for in `fields`. Every response carries an ETag, so
+# polling clients get an empty 304 when nothing changed. Responses also
+# carry the session's X-CSRF-Token, which clients send back with the
+# requests that change the inbox (e.g. POST /inbox/notes/bulk).
+
+API_MAX_LIMIT = 100
+STATS_MAX_DAYS = 366
+LIST_FIELDS = ('uuid', 'byline', 'timestamp', 'preview')
+NOTE_FIELDS = ('uuid', 'byline', 'timestamp', 'archived', 'body')
+CHANGE_FIELDS = NOTE_FIELDS
+
+
+def api_response(payload, status=200):
+    body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False, default=str)
+    response = app.response_class(body, status=status, mimetype='application/json')
+    if 'nickname' in session:
+        response.headers['X-CSRF-Token'] = csrf_token()
+    return response
+
+
+def api_error(status, message):
+    abort(api_response({'error': message}, status))
+
+
+def api_auth(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if 'nickname' not in session:
+            api_error(401, 'Sign in first.')
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def conditional(payload):
+    """Returns `payload` with an ETag, or a bare 304 if the client has it."""
+    response = api_response(payload)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def encode_cursor(keyset):
+    timestamp, uuid = keyset
+    raw = f'{timestamp.isoformat()}|{uuid}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, uuid = raw.split('|')
+        if not is_uuid(uuid):
+            raise ValueError(uuid)
+        return datetime.fromisoformat(timestamp), uuid
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        api_error(400, 'Invalid cursor.')
+
+
+def encode_change_cursor(change):
+    txid, seq = change
+    return base64.urlsafe_b64encode(f'c{txid}.{seq}'.encode()).decode().rstrip('=')
+
+
+def decode_change_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        if not raw.startswith('c'):
+            raise ValueError(raw)
+        txid, seq = raw[1:].split('.')
+        return int(txid), int(seq)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        api_error(400, 'Invalid cursor.')
+
+
+def requested_fields(default):
+    fields = request.args.get('fields')
+    if not fields:
+        return default
+    fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in storage.Inbox.NOTE_FIELDS]
+    if unknown:
+        api_error(400, f"Unknown field(s): {', '.join(unknown)}.")
+    if not fields:
+        api_error(400, 'fields is empty.')
+    return fields
+
+
+def serialize(row):
+    for key, value in row.items():
+        if isinstance(value, datetime):
+            row[key] = value.isoformat()
+    return row
+
+
+def requested_limit(default):
+    limit = request.args.get('limit', default, type=int)
+    if not 1 <= limit <= API_MAX_LIMIT:
+        api_error(400, f'limit must be between 1 and {API_MAX_LIMIT}.')
+    return limit
+
+
+def note_page(search_str=None):
+    limit = requested_limit(25)
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    fields = requested_fields(LIST_FIELDS)
+
+    inbox_db = storage.Inbox(session['nickname'])
+    rows, last = inbox_db.page(limit, after=after, search_str=search_str, fields=fields)
+    next_cursor = encode_cursor(last) if len(rows) == limit else None
+    return conditional({'notes': [serialize(row) for row in rows], 'next': next_cursor})
+
+
+@app.route('/api/v1/inbox/notes')
+@api_auth
+def api_inbox_notes():
+    """The inbox's active notes, newest first."""
+    return note_page()
+
+
+@app.route('/api/v1/inbox/search')
+@api_auth
+def api_inbox_search():
+    """The inbox's active notes whose body or byline contains `q`."""
+    search_str = request.args.get('q', '').strip()
+    if not search_str:
+        api_error(400, 'q is required.')
+    return note_page(search_str)
+
+
+@app.route('/api/v1/notes/<uuid>')
+@api_auth
+def api_note(uuid):
+    """One note of the inbox, active or archived."""
+    if not is_uuid(uuid):
+        api_error(404, 'No such note.')
+    note = storage.Inbox(session['nickname']).note(uuid, requested_fields(NOTE_FIELDS))
+    if note is None:
+        api_error(404, 'No such note.')
+    return conditional(serialize(note))
+
+
+@app.route('/api/v1/inbox/changes')
+@api_auth
+def api_inbox_changes():
+    """Notes of the inbox changed since the cursor, oldest change first."""
+    limit = requested_limit(API_MAX_LIMIT)
+    cursor = request.args.get('cursor')
+    after = decode_change_cursor(cursor) if cursor else (0, 0)
+    fields = requested_fields(CHANGE_FIELDS)
+
+    inbox_db = storage.Inbox(session['nickname'])
+    rows, last = inbox_db.changes(after, limit, fields=fields)
+    return conditional({'changes': [serialize(row) for row in rows],
+                        'next': encode_change_cursor(last),
+                        'more': len(rows) == limit})
+
+
+@app.route('/api/v1/inbox/bylines')
+@api_auth
+def api_inbox_bylines():
+    """The inbox's bylines starting with `prefix`, most used first."""
+    limit = requested_limit(10)
+    prefix = request.args.get('prefix', '')
+    bylines = storage.Inbox(session['nickname']).bylines(prefix, limit)
+    return conditional({'bylines': bylines})
+
+
+@app.route('/api/v1/inbox/stats')
+@api_auth
+def api_inbox_stats():
+    """The inbox's activity over the last `days` days."""
+    days = request.args.get('days', 30, type=int)
+    if not 1 <= days <= STATS_MAX_DAYS:
+        api_error(400, f'days must be between 1 and {STATS_MAX_DAYS}.')
+    return conditional(storage.Inbox(session['nickname']).stats(days))
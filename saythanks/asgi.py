@@ -0,0 +1,142 @@
+# ASGI Serving Mode
+# -----------------
+# Serves the public, high-traffic routes (the submit form, note submission
+# and share pages) from asyncio handlers, so a worker waiting on Postgres or
+# SendGrid keeps accepting requests. Every other route falls through to the
+# regular Flask app.
+#
+#     uvicorn saythanks.asgi:app --workers 2
+#     gunicorn -k uvicorn.workers.UvicornWorker saythanks.asgi:app
+
+from contextlib import asynccontextmanager
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from flask import render_template
+from names import get_full_name
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import HTMLResponse, PlainTextResponse, RedirectResponse
+from starlette.routing import Mount, Route
+
+from .core import app as flask_app, PROXY_COUNT, clean_note, is_uuid, share_body, warm_templates
+from . import aiostorage, flood, myemail, ratelimit, snapshots, storage
+from .utils import note_text
+
+http = None
+
+
+def render(request, template, **context):
+    """Render a Flask template for this request, so templates can keep
+    using `url_for`, `request` and the app's context processors."""
+    with flask_app.test_request_context(request.url.path, base_url=str(request.base_url)):
+        return HTMLResponse(render_template(template, **context))
+
+
+def client_ip(request):
+    """The client address, as ProxyFix finds it in core: the X-Forwarded-For
+    entry added by the outermost of PROXY_COUNT trusted proxies. Entries
+    left of it were sent by the client and may be forged."""
+    forwarded = [entry.strip() for entry in request.headers.get('x-forwarded-for', '').split(',')]
+    forwarded = [entry for entry in forwarded if entry]
+    if PROXY_COUNT and len(forwarded) >= PROXY_COUNT:
+        return forwarded[-PROXY_COUNT]
+    return request.client.host if request.client else 'unknown'
+
+
+async def display_submit_note(request):
+    """Display a web form in which user can edit and submit a note."""
+    inbox_id = request.path_params['inbox_id']
+    inbox = await aiostorage.fetch_inbox(inbox_id)
+    if inbox is None or not inbox['enabled']:
+        raise HTTPException(404)
+    topic = request.path_params.get('topic', '')
+    return render(request, 'submit_note.htm.j2',
+                  user=inbox_id,
+                  topic=" about " + topic if topic else "",
+                  fake_name=get_full_name())
+
+
+async def submit_note(request):
+    """Store note in database and send a copy to user's email."""
+    inbox_id = request.path_params['inbox_id']
+    # The limiter and flood check may block on redis; keep them off the loop.
+    retry_after = await run_in_threadpool(ratelimit.check_submission, client_ip(request), inbox_id)
+    if retry_after is not None:
+        return PlainTextResponse('Too many notes, please slow down.', 429,
+                                 headers={'Retry-After': str(int(retry_after) + 1)})
+
+    form = await request.form()
+    body = form.get('body')
+    byline = form.get('byline', '')
+    if body is None:
+        raise HTTPException(400)
+    thanks = RedirectResponse('/thanks', status_code=302)
+    # Collapse repeats of a recent note before doing any work on it.
+    if await run_in_threadpool(flood.is_duplicate, inbox_id, body, byline):
+        return thanks
+
+    inbox = await aiostorage.fetch_inbox(inbox_id)
+    if inbox is None:
+        raise HTTPException(404)
+
+    content_type = form.get('content-type', 'markdown')
+    # markdown and lxml are CPU-bound; keep them off the event loop.
+    cleaned = await run_in_threadpool(clean_note, body, byline, content_type)
+    if not cleaned:
+        # Pretend that it was successful.
+        return thanks
+    stored_body, byline = cleaned
+
+    uuid = await aiostorage.store_note(inbox['auth_id'], stored_body, byline)
+    await run_in_threadpool(storage.invalidate_searches, inbox['auth_id'])
+    if snapshots.SNAPSHOT_DIR:
+        note = storage.Note.from_inbox(inbox=None, body=stored_body, byline=byline, uuid=uuid)
+        await run_in_threadpool(snapshots.on_note_stored, note)
+
+    if inbox['email_enabled']:
+        # HTML notes are mailed as submitted, as in the WSGI route.
+        mail_body = body if content_type == 'html' else stored_body
+        note = storage.Note.from_inbox(inbox=None, body=mail_body, byline=byline, uuid=uuid)
+        note_url = str(request.url_for('share_note', uuid=str(uuid)))
+        await myemail.notify_async(http, note, inbox['email'], note_url)
+
+    return thanks
+
+
+async def share_note(request):
+    """Share and display the note via an unique URL."""
+    uuid = request.path_params['uuid']
+    note = await aiostorage.fetch_note(uuid) if is_uuid(uuid) else None
+    if note is None:
+        raise HTTPException(404)
+    text = note['body_text'] or note_text(note['body'])
+    note = storage.Note.from_inbox(inbox=None, body=note['body'],
+                                   byline=note['byline'], uuid=note['uuid'])
+    return render(request, 'share_note.htm.j2', note=note, note_body=share_body(note.body),
+                  note_text=text)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global http
+    warm_templates()
+    http = httpx.AsyncClient(timeout=10)
+    await aiostorage.connect()
+    yield
+    await http.aclose()
+    await aiostorage.disconnect()
+
+
+routes = [
+    Route('/to/{inbox_id}&{topic}', display_submit_note, methods=['GET']),
+    Route('/to/{inbox_id}', display_submit_note, methods=['GET']),
+    Route('/to/{inbox_id}/submit', submit_note, methods=['POST']),
+]
+if not snapshots.SNAPSHOT_DIR:
+    # With snapshots, share pages are files served ahead of the Flask app.
+    routes.append(Route('/note/{uuid}', share_note, methods=['GET']))
+routes.append(Mount('', app=WSGIMiddleware(flask_app)))
+
+app = Starlette(routes=routes, lifespan=lifespan)
@@ -0,0 +1,169 @@
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+
+from flask import url_for
+
+from .core import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static Assets
+# -------------
+# `flask build-assets` (run at deploy time) turns saythanks/static into
+#
+#   saythanks/static/dist/css/bundle.<hash>.css   (+ .gz, and .br when brotli
+#   saythanks/static/dist/js/bundle.<hash>.js      is installed)
+#   saythanks/static/dist/<every other file, hashed and under its own name>
+#   saythanks/static/dist/staticfiles.json         (name -> hashed name)
+#
+# Templates link assets with static_url('css/bundle.css'); without a build
+# (in development) it falls back to the plain files behind /static/. When
+# the build exists WhiteNoise serves it, with far-future immutable cache
+# headers on the hashed names.
+
+STATIC_DIR = os.path.join(app.root_path, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_PATH = os.path.join(DIST_DIR, 'staticfiles.json')
+
+# Bundles, and the files they are built from, in load order.
+BUNDLES = {
+    'css/bundle.css': ['css/normalize.css', 'css/skeleton.css', 'css/saythanks.css',
+                       'css/carbonads.css', 'css/jquery.modal.min.css'],
+    'js/bundle.js': ['js/jquery.autogrowtextarea.min.js', 'js/jquery.simplyCountable.js',
+                     'js/jquery.modal.min.js', 'js/main.js'],
+}
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.html', '.ico', '.txt')
+
+HASHED_RE = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+STATIC_URL_RE = re.compile(r'''url\((['"]?)/static/([^'")?#]+)\1\)''')
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+manifest = load_manifest()
+
+
+@app.template_global()
+def static_url(filename):
+    """The URL of a static file, fingerprinted when the assets are built."""
+    if manifest and filename in manifest:
+        return url_for('static', filename=manifest[filename])
+    return url_for('static', filename=filename)
+
+
+@app.template_global()
+def bundle_urls(name):
+    """The URLs to load a bundle from: the built bundle, or its sources."""
+    if manifest and name in manifest:
+        return [static_url(name)]
+    return [static_url(source) for source in BUNDLES[name]]
+
+
+def hashed_name(name, data):
+    root, ext = os.path.splitext(name)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+
+
+def minify(name, data):
+    # Only needed at build time, so imported here.
+    if name.endswith('.css'):
+        import rcssmin
+        return rcssmin.cssmin(data.decode('utf-8')).encode('utf-8')
+    import rjsmin
+    return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+
+
+def _emit(out_dir, name, data):
+    # Each file is written under its own name (for relative references, e.g.
+    # from the PWA manifest) and its hashed name, with compressed variants.
+    written = hashed_name(name, data)
+    for target in (name, written):
+        path = os.path.join(out_dir, target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        if not name.endswith(COMPRESSIBLE):
+            continue
+        compressed = gzip.compress(data, 9)
+        if len(compressed) < len(data) * 0.95:
+            with open(path + '.gz', 'wb') as f:
+                f.write(compressed)
+        if brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data) * 0.95:
+                with open(path + '.br', 'wb') as f:
+                    f.write(compressed)
+    return written
+
+
+def _sources():
+    for root, dirs, files in os.walk(STATIC_DIR):
+        if root == STATIC_DIR:
+            dirs[:] = [d for d in dirs if not d.startswith('dist')]
+        for filename in files:
+            path = os.path.join(root, filename)
+            yield os.path.relpath(path, STATIC_DIR).replace(os.sep, '/'), path
+
+
+def build():
+    """Builds the fingerprinted assets into DIST_DIR.
+
+    Returns the manifest written.
+    """
+    built = {}
+    out_dir = DIST_DIR + '.tmp'
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+    # Plain files first, so the bundles can point at their hashed names.
+    for name, path in _sources():
+        with open(path, 'rb') as f:
+            built[name] = _emit(out_dir, name, f.read())
+
+    def rewrite(match):
+        quote, name = match.groups()
+        return f'url({quote}/static/{built.get(name, name)}{quote})'
+
+    for name, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            with open(os.path.join(STATIC_DIR, source), 'rb') as f:
+                parts.append(minify(name, f.read()))
+        data = b'\n'.join(parts)
+        if name.endswith('.css'):
+            data = STATIC_URL_RE.sub(rewrite, data.decode('utf-8')).encode('utf-8')
+        built[name] = _emit(out_dir, name, data)
+
+    with open(os.path.join(out_dir, os.path.basename(MANIFEST_PATH)), 'w') as f:
+        json.dump(built, f, indent=2, sort_keys=True)
+
+    # Swap the new build in whole.
+    shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.replace(out_dir, DIST_DIR)
+
+    global manifest
+    manifest = built
+    return built
+
+
+def is_hashed(path, url):
+    return bool(HASHED_RE.search(url))
+
+
+if manifest is not None:
+    from whitenoise import WhiteNoise
+
+    app.wsgi_app = WhiteNoise(app.wsgi_app, root=DIST_DIR, prefix='static/',
+                              immutable_file_test=is_hashed)
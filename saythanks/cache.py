@@ -0,0 +1,307 @@
+import os
+import mmap
+import time
+import fcntl
+import pickle
+import struct
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse, parse_qs
+
+# Shared Cache
+# ------------
+# A small get/set/delete/incr cache with TTLs and namespaced keys. The
+# backend is chosen by CACHE_URL:
+#
+#   memory://?size=10000           per-process LRU (the default)
+#   redis://host:6379/0            any redis-protocol server
+#   shm:///tmp/saythanks.cache     an mmap'd file shared by workers on one host
+#
+# Entries in a per-process LRU go stale independently in each worker, so
+# deletes are broadcast to the other workers over CACHE_BROADCAST_URL (a
+# redis-protocol server) when it is set.
+
+
+class LocalBackend:
+    """An in-process LRU with per-entry expiry."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl if ttl else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self.lock:
+            value, expires = self.entries.get(key, (0, None))
+            if expires and expires < time.time():
+                value, expires = 0, None
+            value += amount
+            if expires is None and ttl:
+                expires = time.time() + ttl
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            return value
+
+
+class RedisBackend:
+    """Entries kept in a redis-protocol server, shared by every worker."""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, pickle.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def incr(self, key, amount=1, ttl=None):
+        # Counters are stored as plain integers so INCRBY works on them;
+        # read them back with incr(key, 0) rather than get().
+        value = self.client.incrby(key, amount)
+        if ttl and value == amount:
+            self.client.expire(key, int(ttl))
+        return value
+
+
+class SharedMemoryBackend:
+    """A fixed-size hash table in an mmap'd file, for workers on one host.
+
+    Each slot holds one pickled (key, value) pair; a key probes a few slots
+    from its hash and evicts the soonest-expiring one when all are taken.
+    Entries too large for a slot are simply not cached.
+    """
+
+    HEADER = struct.Struct('<QdI')  # key hash, expiry (0 = never), length
+    PROBES = 4
+
+    def __init__(self, path, slots=8192, slot_size=2048):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * slot_size
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        # POSIX record locks exclude other processes; the thread lock covers
+        # threads of this one.
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def _hash(self, key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+    def _slots(self, hashed):
+        for i in range(self.PROBES):
+            yield ((hashed + i) % self.slots) * self.slot_size
+
+    def _read(self, offset):
+        return self.HEADER.unpack_from(self.map, offset)
+
+    def _find(self, key, hashed):
+        now = time.time()
+        for offset in self._slots(hashed):
+            slot_hash, expires, length = self._read(offset)
+            if slot_hash != hashed or (expires and expires < now):
+                continue
+            start = offset + self.HEADER.size
+            stored_key, value = pickle.loads(self.map[start:start + length])
+            if stored_key == key:
+                return offset, value
+        return None, None
+
+    def _write(self, key, hashed, value, expires, offset=None):
+        data = pickle.dumps((key, value))
+        if self.HEADER.size + len(data) > self.slot_size:
+            return
+        if offset is None:
+            offset = min(self._slots(hashed), key=self._eviction_order)
+        self.HEADER.pack_into(self.map, offset, hashed, expires, len(data))
+        start = offset + self.HEADER.size
+        self.map[start:start + len(data)] = data
+
+    def _eviction_order(self, offset):
+        # Empty and expired slots first, then the soonest to expire.
+        slot_hash, expires, _ = self._read(offset)
+        if not slot_hash or 0 < expires < time.time():
+            return 0
+        return expires or float('inf')
+
+    def get(self, key):
+        hashed = self._hash(key)
+        with self._locked():
+            return self._find(key, hashed)[1]
+
+    def set(self, key, value, ttl=None):
+        hashed = self._hash(key)
+        with self._locked():
+            offset, _ = self._find(key, hashed)
+            self._write(key, hashed, value, time.time() + ttl if ttl else 0, offset)
+
+    def delete(self, key):
+        hashed = self._hash(key)
+        with self._locked():
+            offset, _ = self._find(key, hashed)
+            if offset is not None:
+                self.HEADER.pack_into(self.map, offset, 0, 0, 0)
+
+    def incr(self, key, amount=1, ttl=None):
+        hashed = self._hash(key)
+        with self._locked():
+            offset, value = self._find(key, hashed)
+            if offset is None:
+                expires, value = (time.time() + ttl if ttl else 0), 0
+            else:
+                expires = self._read(offset)[1]
+            value += amount
+            self._write(key, hashed, value, expires, offset)
+            return value
+
+
+class Broadcaster:
+    """Relays deletes between workers' local caches over redis pub/sub."""
+
+    CHANNEL = 'saythanks:cache:invalidate'
+
+    def __init__(self, url, backend):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.backend = backend
+        self.origin = None
+        self.pid = None
+
+    def start(self):
+        """Starts the listener in this process (again after a fork)."""
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.origin = f'{self.pid}:{id(self)}'.encode()
+        threading.Thread(target=self.listen, daemon=True).start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                for message in pubsub.listen():
+                    origin, _, key = message['data'].partition(b' ')
+                    if origin != self.origin:
+                        self.backend.delete(key.decode())
+            except Exception as e:
+                logging.error("Cache invalidation listener failed: " + str(e))
+                time.sleep(1)
+
+    def publish(self, key):
+        try:
+            self.client.publish(self.CHANNEL, self.origin + b' ' + key.encode())
+        except Exception as e:
+            logging.error("Cache invalidation not broadcast: " + str(e))
+
+
+class Cache:
+    """A namespaced view over a cache backend."""
+
+    def __init__(self, backend, namespace='saythanks', broadcaster=None):
+        self.backend = backend
+        self.prefix = namespace + ':'
+        self.broadcaster = broadcaster
+
+    def namespace(self, name):
+        """Returns a view whose keys live under `name` within this one."""
+        return Cache(self.backend, self.prefix + name, self.broadcaster)
+
+    def get(self, key, default=None):
+        try:
+            value = self.backend.get(self.prefix + key)
+        except Exception as e:
+            # A cache outage degrades to cache misses.
+            logging.error("Cache get failed: " + str(e))
+            return default
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.backend.set(self.prefix + key, value, ttl)
+        except Exception as e:
+            logging.error("Cache set failed: " + str(e))
+
+    def delete(self, key):
+        try:
+            self.backend.delete(self.prefix + key)
+        except Exception as e:
+            logging.error("Cache delete failed: " + str(e))
+        if self.broadcaster:
+            self.broadcaster.publish(self.prefix + key)
+
+    def incr(self, key, amount=1, ttl=None):
+        """Increments a counter, returning its new value (None if unavailable).
+
+        The TTL applies when the counter is created. Read a counter with
+        incr(key, 0), which works on every backend.
+        """
+        try:
+            return self.backend.incr(self.prefix + key, amount, ttl)
+        except Exception as e:
+            logging.error("Cache incr failed: " + str(e))
+            return None
+
+
+def backend_from_url(url):
+    """Returns the cache backend described by `url` (see above)."""
+    parsed = urlparse(url)
+    options = {k: int(v[0]) for k, v in parse_qs(parsed.query).items()}
+    if parsed.scheme == 'memory':
+        return LocalBackend(**options)
+    if parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisBackend(url)
+    if parsed.scheme == 'shm':
+        return SharedMemoryBackend(parsed.path, **options)
+    raise ValueError(f'Unsupported CACHE_URL: {url}')
+
+
+backend = backend_from_url(os.environ.get('CACHE_URL') or 'memory://')
+broadcaster = None
+if os.environ.get('CACHE_BROADCAST_URL') and isinstance(backend, LocalBackend):
+    broadcaster = Broadcaster(os.environ['CACHE_BROADCAST_URL'], backend)
+    broadcaster.start()
+
+cache = Cache(backend, broadcaster=broadcaster)
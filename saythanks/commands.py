@@ -0,0 +1,157 @@
+import click
+
+from .core import app, warm_templates, JINJA_CACHE_DIR
+from . import assets, exports, imports, migrations, partitions, snapshots, storage
+
+# Maintenance Commands
+# --------------------
+# Run with the flask CLI, e.g. `FLASK_APP=saythanks flask reconcile-counts`.
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Repair drift in the maintained per-inbox note counters and bylines."""
+    fixed = storage.Inbox.reconcile_counts()
+    click.echo(f'Repaired note counters on {fixed} inbox(es).')
+    fixed = storage.Inbox.reconcile_bylines()
+    click.echo(f'Repaired {fixed} byline count(s).')
+
+
+@app.cli.command('backfill-activity')
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']), metavar='YYYY-MM-DD',
+              help='Only rebuild the days from this one (default: all).')
+def backfill_activity(since):
+    """Rebuild the inbox stats rollups from the notes (after migration 009)."""
+    counted = storage.Inbox.backfill_activity(since.date() if since else None)
+    click.echo(f'Counted {counted} note(s) into the stats rollups.')
+
+
+@app.cli.command('backfill-note-text')
+def backfill_note_text():
+    """Compute body_text and preview for notes stored before they existed."""
+    updated = storage.Note.backfill_text()
+    click.echo(f'Backfilled {updated} note(s).')
+
+
+@app.cli.command('rebuild-snapshots')
+def rebuild_snapshots():
+    """Re-render every share-page snapshot (after template changes)."""
+    if not snapshots.SNAPSHOT_DIR:
+        raise click.UsageError('SNAPSHOT_DIR is not set.')
+    published = snapshots.rebuild()
+    click.echo(f'Published {published} snapshot(s).')
+
+
+@app.cli.command('purge-sessions')
+def purge_sessions():
+    """Delete expired server-side sessions."""
+    purged = storage.Session.purge_expired()
+    click.echo(f'Purged {purged} expired session(s).')
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Bundle, fingerprint and precompress the static files (at deploy)."""
+    built = assets.build()
+    click.echo(f'Built {len(built)} asset(s) into {assets.DIST_DIR}.')
+
+
+@app.cli.command('precompile-templates')
+def precompile_templates():
+    """Compile every template into the bytecode cache (at build time)."""
+    if app.jinja_env.bytecode_cache is None:
+        raise click.UsageError(f'{JINJA_CACHE_DIR} is not writable.')
+    compiled = warm_templates()
+    click.echo(f'Compiled {compiled} template(s) into {JINJA_CACHE_DIR}.')
+
+
+@app.cli.command('maintain-partitions')
+@click.option('--detach-archived-before', type=int, metavar='YEAR',
+              help='Also detach the archived-note partitions of years before YEAR.')
+def maintain_partitions(detach_archived_before):
+    """Create upcoming notes partitions and tier old archived ones (daily, off-peak)."""
+    if not partitions.is_partitioned():
+        raise click.UsageError('notes is not partitioned; apply migration 007 first.')
+    created = partitions.create_upcoming()
+    click.echo(f"Created {len(created)} partition(s){': ' + ', '.join(created) if created else '.'}")
+    cold = partitions.move_cold()
+    click.echo(f"Moved {len(cold)} partition(s) to cold storage{': ' + ', '.join(cold) if cold else '.'}")
+    if detach_archived_before:
+        detached = partitions.detach_archived(detach_archived_before)
+        click.echo(f"Detached {len(detached)} partition(s){': ' + ', '.join(detached) if detached else '.'}")
+        if detached:
+            click.echo('Run `flask reconcile-counts` to update the note counters.')
+
+
+@app.cli.command('migrate')
+@click.option('--dry-run', is_flag=True, help='Only show what would run, with estimates.')
+@click.option('--baseline', metavar='VERSION',
+              help='Record migrations up to VERSION as applied without running them.')
+def migrate(dry_run, baseline):
+    """Apply pending schema migrations (sqls/migrations/) in order."""
+    try:
+        if baseline:
+            recorded = migrations.baseline(baseline)
+            click.echo(f'Recorded {len(recorded)} migration(s) as applied.')
+        elif dry_run:
+            pending = migrations.dry_run(echo=click.echo)
+            click.echo(f'{len(pending)} migration(s) pending.')
+        else:
+            applied = migrations.migrate(echo=click.echo)
+            click.echo(f'Applied {len(applied)} migration(s).')
+    except migrations.MigrationError as e:
+        raise click.ClickException(str(e))
+
+
+@app.cli.command('import-notes')
+@click.argument('inbox')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']),
+              help='Defaults to the file extension, or csv.')
+@click.option('--content-type', type=click.Choice(['markdown', 'html']), default='markdown',
+              help='How to read bodies of rows without a content-type (html for exports).')
+@click.option('--jobs', type=int, default=1, help='Processes sanitizing notes in parallel.')
+@click.option('--upload', metavar='KEY', hidden=True,
+              help='Import an upload spooled by /inbox/import, reporting progress under KEY.')
+def import_notes(inbox, path, file_format, content_type, jobs, upload):
+    """Import a CSV or NDJSON file of notes into INBOX (a slug)."""
+    if upload:
+        imports.run_upload(inbox, upload, path, file_format, content_type)
+        return
+    if not storage.Inbox.does_exist(inbox):
+        raise click.UsageError(f'No inbox {inbox}.')
+
+    def progress(stats):
+        if stats['imported'] is None:
+            click.echo(f"\rRead {stats['read']} row(s), {stats['rejected']} rejected...", nl=False)
+
+    with click.open_file(path, 'rb') as f:
+        stats = imports.import_notes(inbox, f, file_format or imports.format_of(path), content_type,
+                                     jobs=jobs, progress=progress)
+    click.echo(f"\nImported {stats['imported']} note(s); skipped {stats['duplicates']} duplicate(s) "
+               f"and {stats['rejected']} rejected row(s).")
+    for error in stats['errors']:
+        click.echo(f'  {error}')
+
+
+@app.cli.command('export-notes')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True, allow_dash=True))
+@click.option('--format', 'export_format', type=click.Choice(list(exports.STREAMED_FORMATS)),
+              default='parquet', show_default=True)
+@click.option('--inbox', metavar='SLUG', help="Only this inbox's active notes (default: every note).")
+def export_notes(path, export_format, inbox):
+    """Export notes to PATH as Parquet, an Arrow stream or CSV."""
+    if export_format in exports.COLUMNAR_FORMATS and exports.pyarrow is None:
+        raise click.UsageError(f'{export_format} exports need pyarrow installed.')
+    query, params = exports.NOTES_QUERY, None
+    if inbox:
+        if not storage.Inbox.does_exist(inbox):
+            raise click.UsageError(f'No inbox {inbox}.')
+        query, params = exports.INBOX_QUERY, {'auth_id': storage.Inbox(inbox).auth_id}
+
+    written = 0
+    with click.open_file(path, 'wb') as f:
+        for chunk in exports.stream_export(query, params, export_format):
+            f.write(chunk)
+            written += len(chunk)
+    click.echo(f'Wrote {written / 1e6:.1f} MB of {export_format}.', err=path == '-')
@@ -0,0 +1,209 @@
+import os
+import zlib
+import itertools
+
+from .core import app
+from . import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response Compression
+# --------------------
+# Dynamic responses (inbox pages, share pages, exports) are compressed with
+# brotli or gzip, whichever the client prefers in Accept-Encoding. Bodies
+# are compressed chunk by chunk as the app yields them, so streamed exports
+# never sit in memory whole. Responses that are small, already encoded
+# (precompressed snapshots and assets) or not text-like pass through.
+#
+# COMPRESSION_LEVELS tunes the effort per content type as
+# `type=<gzip level>:<brotli quality>`, comma separated, e.g.
+#
+#   COMPRESSION_LEVELS=text/html=6:5,text/csv=4:3
+#
+# Set COMPRESSION_ENABLED=0 when a front proxy compresses instead.
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 512))
+
+# (gzip level, brotli quality) per content type; larger, streamed bodies
+# get cheaper settings.
+DEFAULT_LEVELS = {
+    'text/html': (6, 5),
+    'text/css': (6, 5),
+    'text/plain': (6, 5),
+    'text/csv': (4, 4),
+    'application/json': (6, 5),
+    'application/x-ndjson': (4, 4),
+    'application/javascript': (6, 5),
+    'image/svg+xml': (6, 5),
+}
+
+
+def parse_levels(spec):
+    levels = dict(DEFAULT_LEVELS)
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        mimetype, _, values = item.partition('=')
+        gzip_level, _, brotli_quality = values.partition(':')
+        levels[mimetype.strip()] = (int(gzip_level), int(brotli_quality or gzip_level))
+    return levels
+
+
+LEVELS = parse_levels(os.environ.get('COMPRESSION_LEVELS', ''))
+
+
+def negotiate(accept_encoding):
+    """Returns 'br', 'gzip' or None for an Accept-Encoding header value."""
+    weights = {}
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip()] = q
+    wildcard = weights.get('*', 0.0)
+    available = ('br', 'gzip') if brotli is not None else ('gzip',)
+    # On equal weights brotli wins, as it compresses better.
+    best = max(available, key=lambda coding: weights.get(coding, wildcard))
+    return best if weights.get(best, wildcard) > 0 else None
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def encoder_for(encoding, mimetype):
+    gzip_level, brotli_quality = LEVELS[mimetype]
+    if encoding == 'br':
+        return BrotliEncoder(brotli_quality)
+    return GzipEncoder(gzip_level)
+
+
+class CompressionMiddleware:
+    """Compresses eligible responses of the wrapped WSGI app on the fly."""
+
+    def __init__(self, app, min_size=COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.min_size = min_size
+
+    def __call__(self, environ, start_response):
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        response = {}
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            response.update(status=status, headers=headers, exc_info=exc_info)
+            return written.append
+
+        app_iter = self.app(environ, capture)
+        return self.respond(app_iter, response, written, encoding, start_response)
+
+    def eligible(self, status, headers):
+        if not status.startswith('200') and not status.startswith('201'):
+            return None
+        mimetype = None
+        for name, value in headers:
+            name = name.lower()
+            if name == 'content-encoding':
+                return None
+            if name == 'content-length' and int(value) < self.min_size:
+                return None
+            if name == 'content-type':
+                mimetype = value.split(';')[0].strip().lower()
+        return mimetype if mimetype in LEVELS else None
+
+    def respond(self, app_iter, response, written, encoding, start_response):
+        chunks = iter(app_iter)
+        try:
+            # The app calls start_response by the time it yields a chunk.
+            first = [] if response else [next(chunks, b'')]
+            pending = written + first
+            mimetype = self.eligible(response['status'], response['headers'])
+
+            # Without a Content-Length, read ahead until the body is known to
+            # be big enough to be worth compressing.
+            size = sum(map(len, pending))
+            exhausted = False
+            while mimetype and size < self.min_size and not exhausted:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                else:
+                    pending.append(chunk)
+                    size += len(chunk)
+            if exhausted and size < self.min_size:
+                mimetype = None
+
+            if mimetype is None:
+                start_response(response['status'], response['headers'], response['exc_info'])
+                yield from pending
+                yield from chunks
+                return
+
+            start_response(response['status'], self.headers(response['headers'], encoding),
+                           response['exc_info'])
+            encoder = encoder_for(encoding, mimetype)
+            size_in = size_out = 0
+            for chunk in itertools.chain(pending, chunks):
+                size_in += len(chunk)
+                data = encoder.compress(chunk)
+                if data:
+                    size_out += len(data)
+                    yield data
+            data = encoder.finish()
+            size_out += len(data)
+            yield data
+            metrics.incr('compression_bytes_in_total', size_in, encoding=encoding)
+            metrics.incr('compression_bytes_out_total', size_out, encoding=encoding)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+    def headers(self, headers, encoding):
+        vary = None
+        result = []
+        for name, value in headers:
+            lowered = name.lower()
+            if lowered == 'content-length':
+                continue
+            if lowered == 'vary':
+                vary = value
+                continue
+            if lowered == 'etag' and not value.startswith('W/'):
+                # The encoded body differs byte for byte from the original.
+                value = 'W/' + value
+            result.append((name, value))
+        result.append(('Content-Encoding', encoding))
+        result.append(('Vary', f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'))
+        return result
+
+
+if COMPRESSION_ENABLED:
+    app.wsgi_app = CompressionMiddleware(app.wsgi_app)
@@ -6,24 +6,35 @@
 # |_____|__,|_  | |_| |_|_|__,|_|_|_,_|___|
 #           |___|
 
+import hmac
 import logging
 import os
+import secrets
 import json
 import requests
 # Import your get_version function
 from .version import get_version
-from .utils import strip_html
+from .utils import strip_html, note_text
 
+from datetime import datetime
 from functools import wraps
+from uuid import UUID
 from flask import Flask, request, session, render_template, url_for
-from flask import abort, redirect, Markup, make_response
+from flask import abort, redirect, Markup, make_response, jsonify
 from flask_common import Common
+from werkzeug.middleware.proxy_fix import ProxyFix
+from jinja2 import FileSystemBytecodeCache
 from names import get_full_name
 from raven.contrib.flask import Sentry
 from flask_qrcode import QRcode
 from . import storage
+from . import metrics
+from . import flood
+from .ratelimit import limit_submissions
+from .sessions import ServerSessionInterface, session_store
 from urllib.parse import quote
 from lxml_html_clean import Cleaner
+from lxml.etree import ParserError
 from markdown import markdown
 
 cleaner = Cleaner()
@@ -35,10 +46,37 @@ cleaner.remove_attributes = ['id', 'class', 'style', 'align', 'border', 'cellpad
                              'onchange', 'onfocus', 'onselect', 'onreset', 'onsubmit', 'onabort', 'oncanplay', 'oncanplaythrough', 'oncuechange', 'ondurationchange', 'onemptied', 'onended', 'onloadeddata', 'onloadedmetadata', 'onloadstart', 'onpause', 'onplay', 'onplaying', 'onprogress', 'onratechange', 'onseeked', 'onseeking', 'onstalled', 'onsuspend', 'ontimeupdate', 'onvolumechange', 'onwaiting']
 
 
+def is_uuid(value):
+    try:
+        UUID(value)
+    except ValueError:
+        return False
+    return True
+
+
 def remove_tags(html):
     return cleaner.clean_html(html)
 
 
+def share_body(body):
+    """The note body as shown on its share page, without block wrappers."""
+    for i in ['<div>', '<p>', '</div>', '</p>']:
+        body = body.replace(i, '')
+    return body
+
+
+def clean_note(body, byline, content_type='markdown'):
+    """Returns the sanitized (body, byline) pair stored for a note,
+    or None when nothing is left of the body."""
+    if content_type != 'html':
+        body = markdown(body)
+    if not body.strip():
+        return None
+    if content_type == 'html':
+        return remove_tags(Markup(body)), Markup(byline)
+    return remove_tags(body), Markup(byline).striptags()
+
+
 # importing module
 
 # Create and configure logger
@@ -56,15 +94,38 @@ logger = logging.getLogger()
 app = Flask(__name__)
 app.config['APP_VERSION'] = get_version()
 
+# Requests reach us through PROXY_COUNT reverse proxies (Heroku's router is
+# one), and only the address the nearest of them appended to
+# X-Forwarded-For can be trusted: anything to its left came from the client.
+# ProxyFix makes that address request.remote_addr, which the rate limiter
+# keys on.
+PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 1))
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_COUNT)
+
 # to encode a query
 app.jinja_env.filters['quote'] = quote
 
 # to strip html formatting
 app.jinja_env.filters['strip_html'] = strip_html
 
+# Compiled templates are kept as bytecode in JINJA_CACHE_DIR, which every
+# worker shares; `flask precompile-templates` fills it at build time.
+JINJA_CACHE_DIR = os.environ.get('JINJA_CACHE_DIR') or os.path.join(app.root_path, '.jinja_cache')
+try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+except OSError:
+    # e.g. a read-only install: just compile templates in each worker.
+    pass
+if os.access(JINJA_CACHE_DIR, os.W_OK):
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
 QRcode(app)
 app.secret_key = os.environ.get('APP_SECRET', 'CHANGEME')
-app.debug = True
+# Only an opaque session id goes in the cookie; see sessions.py.
+app.session_interface = ServerSessionInterface(session_store)
+# Not sent along with cross-site POSTs; see also requires_csrf.
+app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
+app.debug = os.environ.get('FLASK_DEBUG') == '1'
 
 # Flask-Common.
 common = Common(app)
@@ -86,12 +147,64 @@ auth_jwt_v2 = os.environ['AUTH0_JWT_V2_TOKEN']
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        if 'profile' not in session:
+        if 'nickname' not in session:
             return redirect('/')
         return f(*args, **kwargs)
 
     return decorated
 
+
+def csrf_token():
+    """The signed-in session's token for requests that change its inbox."""
+    if '_csrf_token' not in session:
+        session['_csrf_token'] = secrets.token_urlsafe(32)
+    return session['_csrf_token']
+
+
+app.jinja_env.globals['csrf_token'] = csrf_token
+
+
+def requires_csrf(f):
+    """Rejects a request without the session's csrf_token, sent as a
+    `csrf_token` form field or an X-CSRF-Token header, so another site
+    can't make a signed-in browser change the inbox."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        expected = session.get('_csrf_token')
+        token = request.headers.get('X-CSRF-Token') or request.form.get('csrf_token')
+        if not expected or not token or not hmac.compare_digest(token, expected):
+            abort(403)
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+@app.before_request
+def restore_primary_pin():
+    # Keep reading from the primary after this session's own writes.
+    storage.pin_until(session.get('primary_until', 0))
+
+
+@app.after_request
+def remember_primary_pin(response):
+    until = storage.pinned_until()
+    # Only signed-in users read back what they wrote; don't start a
+    # session for anonymous note senders.
+    if 'nickname' in session and until > session.get('primary_until', 0):
+        session['primary_until'] = until
+    return response
+
+
+def warm_templates():
+    """Load every template up front, so no request pays for compiling it.
+
+    Returns the number of templates loaded.
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
 # Application Routes
 # ------------------
 
@@ -111,9 +224,9 @@ def index():
 @requires_auth
 def inbox():
     # Auth0 stored account information.
-    profile = session['profile']
+    profile = session.profile
     # Grab the inbox from the database.
-    inbox_db = storage.Inbox(profile['nickname'])
+    inbox_db = storage.Inbox(session['nickname'])
     is_enabled = storage.Inbox.is_enabled(inbox_db.slug)
     # pagination
     page = request.args.get('page', 1, type=int)
@@ -121,9 +234,14 @@ def inbox():
     # checking for invalid page numbers
     if page < 0:
         return render_template("404notfound.htm.j2")
-    data = inbox_db.notes(page, page_size)
-    if page > data['total_pages'] and data['total_pages']!=0:
-                return render_template("404notfound.htm.j2")
+    # filtering by byline (a key from /api/v1/inbox/bylines)
+    byline = request.args.get('byline', '').strip()
+    if byline:
+        data = inbox_db.notes_by_byline(byline, page, page_size)
+    else:
+        data = inbox_db.notes(page, page_size)
+    if page > data['total_pages'] and data['total_pages'] != 0:
+        return render_template("404notfound.htm.j2")
     is_email_enabled = storage.Inbox.is_email_enabled(inbox_db.slug)
 
     # handling search with pagination
@@ -139,7 +257,8 @@ def inbox():
                                user=profile, notes=data['notes'],
                                inbox=inbox_db, is_enabled=is_enabled,
                                is_email_enabled=is_email_enabled, page=data['page'],
-                               total_pages=data['total_pages'], search_str="Search by message body or byline")
+                               total_pages=data['total_pages'], search_str="Search by message body or byline",
+                               byline=byline)
     # reassessing data when search is used
     if 'search_str' in session:
             data = inbox_db.search_notes(session['search_str'], page, page_size)
@@ -149,21 +268,59 @@ def inbox():
                            total_pages=data['total_pages'], search_str=session['search_str'])
 
 
-@app.route('/inbox/export/<format>')
-@requires_auth
-def inbox_export(export_format):
+# Upper bound on the notes accepted by a single bulk request.
+BULK_MAX_NOTES = int(os.environ.get('BULK_MAX_NOTES', 5000))
 
-    # Auth0 stored account information.
-    profile = session['profile']
 
-    # Grab the inbox from the database.
-    inbox_db = storage.Inbox(profile['nickname'])
+def read_bulk_notes():
+    """Parses the request as a JSON array or as NDJSON (one note per line)."""
+    try:
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+            lines = request.get_data(as_text=True).splitlines()
+            return [json.loads(line) for line in lines if line.strip()]
+        if request.mimetype != 'application/json':
+            abort(415)
+        notes = request.get_json()
+    except ValueError:
+        abort(400)
+    if not isinstance(notes, list):
+        abort(400)
+    return notes
 
-    # Send over the list of all given notes for the user.
-    response = make_response(inbox_db.export(export_format))
-    response.headers['Content-Disposition'] = 'attachment; filename=saythanks-inbox.csv'
-    response.headers['Content-type'] = 'text/csv'
-    return response
+
+@app.route('/inbox/notes/bulk', methods=['POST'])
+@requires_auth
+@requires_csrf
+def inbox_bulk_submit():
+    """Store a batch of notes in the user's inbox in one round trip.
+
+    The body is an application/json array or application/x-ndjson lines,
+    sent with an X-CSRF-Token header. Each note is an object with a `body`,
+    an optional `byline` and an optional `content-type` ('markdown' by
+    default, or 'html'). No emails are sent. A note that can't be read
+    fails the whole batch with a 400 naming its index; notes left empty
+    once sanitized are skipped.
+    """
+    notes = read_bulk_notes()
+    if len(notes) > BULK_MAX_NOTES:
+        abort(413)
+
+    cleaned = []
+    for index, note in enumerate(notes):
+        if not isinstance(note, dict) or not isinstance(note.get('body'), str):
+            return jsonify(error=f'note {index} has no body', index=index), 400
+        try:
+            pair = clean_note(note['body'], note.get('byline') or '',
+                              note.get('content-type', 'markdown'))
+        except (ParserError, ValueError) as e:
+            return jsonify(error=f'note {index} is unreadable: {e}', index=index), 400
+        if pair:
+            cleaned.append(pair)
+
+    inbox_db = storage.Inbox(session['nickname'])
+    uuids = inbox_db.submit_notes(cleaned)
+    return jsonify(uuids=[str(uuid) for uuid in uuids],
+                   skipped=len(notes) - len(cleaned))
 
 
 @app.route('/inbox/archived')
@@ -171,10 +328,10 @@ def inbox_export(export_format):
 def archived_inbox():
 
     # Auth0 stored account information.
-    profile = session['profile']
+    profile = session.profile
 
     # Grab the inbox from the database.
-    inbox_db = storage.Inbox(profile['nickname'])
+    inbox_db = storage.Inbox(session['nickname'])
 
     is_enabled = storage.Inbox.is_enabled(inbox_db.slug)
 
@@ -186,6 +343,21 @@ def archived_inbox():
                            is_email_enabled=is_email_enabled)
 
 
+@app.route('/inbox/stats')
+@requires_auth
+def inbox_stats():
+    """Notes received per day, week and hour, and the top bylines."""
+    days = request.args.get('days', 30, type=int)
+    if days not in (7, 30, 90, 365):
+        days = 30
+    inbox_db = storage.Inbox(session['nickname'])
+    stats = inbox_db.stats(days)
+    return render_template('inbox_stats.htm.j2',
+                           user=session.profile, stats=stats,
+                           busiest_day=max(row['notes'] for row in stats['daily']),
+                           busiest_hour=max(stats['hours']))
+
+
 @app.route('/thanks')
 def thanks():
     return render_template('thanks.htm.j2',
@@ -198,7 +370,7 @@ def thanks():
 @requires_auth
 def disable_email():
     # Auth0 stored account information.
-    slug = session['profile']['email']
+    slug = session['email']
     storage.Inbox.disable_email(slug)
     return redirect(url_for('inbox'))
 
@@ -207,7 +379,7 @@ def disable_email():
 @requires_auth
 def enable_email():
     # Auth0 stored account information.
-    slug = session['profile']['email']
+    slug = session['email']
     storage.Inbox.enable_email(slug)
     return redirect(url_for('inbox'))
 
@@ -216,7 +388,7 @@ def enable_email():
 @requires_auth
 def disable_inbox():
     # Auth0 stored account information.
-    slug = session['profile']['email']
+    slug = session['email']
     storage.Inbox.disable_account(slug)
     return redirect(url_for('inbox'))
 
@@ -225,7 +397,7 @@ def disable_inbox():
 @requires_auth
 def enable_inbox():
     # Auth0 stored account information.
-    slug = session['profile']['email']
+    slug = session['email']
     storage.Inbox.enable_account(slug)
     return redirect(url_for('inbox'))
 
@@ -259,77 +431,96 @@ def share_note(uuid):
         abort(404)
 
     note = storage.Note.fetch(uuid)
-    note_body = note.body
-    for i in ['<div>', '<p>', '</div>', '</p>']:
-        note_body = note_body.replace(i, '')
-    return render_template('share_note.htm.j2', note=note, note_body=note_body)
+    return render_template('share_note.htm.j2', note=note, note_body=share_body(note.body),
+                           note_text=note.body_text or note_text(note.body))
 
 
 @app.route('/inbox/archive/note/<uuid>', methods=['GET'])
 @requires_auth
 def archive_note(uuid):
     """Set aside the note by moving it into an archive."""
-    # Auth0 stored account information.
-    # profile = session['profile']
-
-    note = storage.Note.fetch(uuid)
+    if not is_uuid(uuid):
+        abort(404)
 
-    # Archive the note.
-    note.archive()
+    # Archive the note, provided it belongs to this inbox.
+    storage.Inbox(session['nickname']).set_archived([uuid])
     # Redirect to the archived inbox.
     return redirect(url_for('archived_inbox'))
 
 
+@app.route('/inbox/archive/notes', methods=['POST'])
+@requires_auth
+@requires_csrf
+def archive_notes():
+    """Archive or restore the selected notes, or every note matching a filter."""
+    inbox_db = storage.Inbox(session['nickname'])
+
+    archived = request.form.get('action', 'archive') != 'unarchive'
+    uuids = [uuid for uuid in request.form.getlist('uuid') if is_uuid(uuid)]
+    before = request.form.get('before')
+    match_search = 'match_search' in request.form and 'search_str' in session
+
+    if before or match_search:
+        try:
+            before = datetime.strptime(before, '%Y-%m-%d') if before else None
+        except ValueError:
+            abort(400)
+        search_str = session['search_str'] if match_search else None
+        inbox_db.set_archived_matching(archived, before=before, search_str=search_str)
+    elif uuids:
+        inbox_db.set_archived(uuids, archived)
+
+    return redirect(url_for('archived_inbox' if archived else 'inbox'))
+
+
 @app.route('/to/<inbox_id>/submit', methods=['POST'])
+@limit_submissions
 def submit_note(inbox_id):
     """Store note in database and send a copy to user's email."""
+    # Collapse repeats of a recent note before doing any work on it.
+    if flood.is_duplicate(inbox_id, request.form['body'], request.form['byline']):
+        return redirect(url_for('thanks'))
     # Fetch the current inbox.
     inbox_db = storage.Inbox(inbox_id)
-    inbox_db = storage.Inbox(inbox_id)
-    body = request.form['body']
     content_type = request.form['content-type']
-    byline = Markup(request.form['byline'])
-
-    # If the user chooses to send an HTML email,
-    # the contents of the HTML document will be sent
-    # as an email but will not be stored due to the enormous size
-    # of professional email templates
-
-    if content_type == 'html':
-        body = Markup(body)
-        note_obj = storage.Note.from_inbox(inbox=None, body=body, byline=byline)
-        if storage.Inbox.is_email_enabled(inbox_db.slug):
-            if session:
-                email_address = session['profile']['email']
-            else:
-                email_address = storage.Inbox.get_email(inbox_db.slug)
-            note_obj.notify(email_address)
-        body = remove_tags(body)
-        submitted_note = inbox_db.submit_note(body=body, byline=byline)
-        return redirect(url_for('thanks'))
-    # Strip any HTML away.
-
-    body = markdown(body)
-    body = remove_tags(body)
-    byline = Markup(request.form['byline']).striptags()
+    cleaned = clean_note(request.form['body'], request.form['byline'], content_type)
     # Assert that the body has length.
-    if not body:
+    if not cleaned:
         # Pretend that it was successful.
         return redirect(url_for('thanks'))
+    body, byline = cleaned
 
     # Store the incoming note to the database.
     submitted_note = inbox_db.submit_note(body=body, byline=byline)
     # Email the user the new note.
     if storage.Inbox.is_email_enabled(inbox_db.slug):
-        if session:
-            email_address = session['profile']['email']
+        if 'email' in session:
+            email_address = session['email']
         else:
             email_address = storage.Inbox.get_email(inbox_db.slug)
+        # If the user chooses to send an HTML email, the contents of the
+        # HTML document are sent as they are, but only the sanitized body
+        # is stored, due to the enormous size of professional email templates.
+        if content_type == 'html':
+            submitted_note = storage.Note.from_inbox(inbox=None, body=Markup(request.form['body']),
+                                                     byline=byline, uuid=submitted_note.uuid)
         submitted_note.notify(email_address)
 
     return redirect(url_for('thanks'))
 
 
+@app.route('/metrics')
+def show_metrics():
+    """Expose this worker's counters to a scraper holding METRICS_TOKEN."""
+    token = os.environ.get('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        abort(404)
+    response = make_response(metrics.render())
+    response.headers['Content-type'] = 'text/plain; version=0.0.4'
+    return response
+
+
 @app.route('/logout', methods=["POST"])
 def user_logout():
     session.clear()
@@ -362,17 +553,18 @@ def callback_handling():
 
     user_detail_info = requests.get(user_info_url, headers=json_header).json()
 
-    # Add the 'user_info' to Flask session.
-    session['profile'] = user_info
-
     nickname = user_detail_info['nickname']
     email = user_detail_info['email']
     userid = user_info['sub']
     picture = user_detail_info['picture']
     name = user_detail_info['name']
-    session['profile']['nickname'] = nickname
-    session['profile']['picture'] = picture
-    session['profile']['name'] = name
+
+    # Start a fresh session; keep only what most routes need in it, and the
+    # full 'user_info' profile beside it for the pages that render it.
+    session.rotate()
+    session['nickname'] = nickname
+    session['email'] = user_info.get('email', email)
+    session.profile = dict(user_info, nickname=nickname, picture=picture, name=name)
     if not storage.Inbox.does_exist(nickname):
         # Using nickname by default, can be changed manually later if needed.
         storage.Inbox.store(nickname, userid, email)
@@ -0,0 +1,63 @@
+# Maintained Counts
+# -----------------
+# The SQL keeping an inbox's maintained counts in step with its notes: the
+# note counters (migration 001), the byline facet (006) and the activity
+# rollups (009). storage.py runs these through SQLAlchemy and aiostorage.py
+# through asyncpg, so notes stored either way are counted alike. Run them
+# inside the transaction that stores or (un)archives the notes.
+
+# How a byline is normalized for the inbox_bylines facet; must match the
+# expression of the notes_inbox_byline_idx index (migration 006).
+BYLINE_KEY = "lower(regexp_replace(btrim({}), '\\s+', ' ', 'g'))"
+BYLINE_DISPLAY = "regexp_replace(btrim({}), '\\s+', ' ', 'g')"
+
+# :auth_id, :active, :archived
+COUNT_NOTES = """
+    UPDATE inboxes
+    SET notes_active = notes_active + :active, notes_archived = notes_archived + :archived
+    WHERE auth_id = :auth_id
+"""
+
+# :auth_id, :bylines (non-blank), :delta (positive)
+ADD_BYLINES = f"""
+    INSERT INTO inbox_bylines (inboxes_auth_id, byline, display, notes)
+    SELECT :auth_id, {BYLINE_KEY.format('b')}, max({BYLINE_DISPLAY.format('b')}), COUNT(*) * :delta
+    FROM unnest(CAST(:bylines AS text[])) AS b
+    GROUP BY 2
+    ON CONFLICT (inboxes_auth_id, byline) DO UPDATE
+    SET notes = inbox_bylines.notes + EXCLUDED.notes, display = EXCLUDED.display
+"""
+
+# :auth_id, :bylines (non-blank), :delta (negative)
+REMOVE_BYLINES = f"""
+    UPDATE inbox_bylines
+    SET notes = GREATEST(inbox_bylines.notes + c.notes * :delta, 0)
+    FROM (
+        SELECT {BYLINE_KEY.format('b')} AS byline, COUNT(*) AS notes
+        FROM unnest(CAST(:bylines AS text[])) AS b
+        GROUP BY 1
+    ) c
+    WHERE inboxes_auth_id = :auth_id AND inbox_bylines.byline = c.byline
+"""
+
+# :auth_id, :timestamps and :bylines (one per stored note)
+COUNT_ACTIVITY = f"""
+    WITH received AS (
+        SELECT t, COALESCE(b, '') AS b
+        FROM unnest(CAST(:timestamps AS timestamp[]), CAST(:bylines AS text[])) AS n(t, b)
+    ), hours AS (
+        INSERT INTO inbox_activity (inboxes_auth_id, day, hour, notes)
+        SELECT :auth_id, t::date, extract(hour FROM t)::int, COUNT(*)
+        FROM received
+        GROUP BY 2, 3 ORDER BY 2, 3
+        ON CONFLICT (inboxes_auth_id, day, hour) DO UPDATE
+        SET notes = inbox_activity.notes + EXCLUDED.notes
+    )
+    INSERT INTO inbox_byline_activity (inboxes_auth_id, day, byline, display, notes)
+    SELECT :auth_id, t::date, {BYLINE_KEY.format('b')}, max({BYLINE_DISPLAY.format('b')}), COUNT(*)
+    FROM received
+    WHERE btrim(b) <> ''
+    GROUP BY 2, 3 ORDER BY 2, 3
+    ON CONFLICT (inboxes_auth_id, day, byline) DO UPDATE
+    SET notes = inbox_byline_activity.notes + EXCLUDED.notes, display = EXCLUDED.display
+"""
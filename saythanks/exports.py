@@ -0,0 +1,237 @@
+import os
+import hmac
+import logging
+import threading
+from mimetypes import guess_type
+
+import psycopg2
+from flask import Response, request, session, abort, make_response
+
+from .core import app, requires_auth
+from . import metrics, storage
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Note Exports
+# ------------
+# /inbox/export/<format> downloads the inbox's active notes. csv, parquet
+# and arrow (an Arrow IPC stream) are streamed straight from Postgres:
+# COPY (SELECT ...) TO STDOUT runs on its own connection in a background
+# thread and is read back through a pipe, so an export of any size never
+# sits in memory whole. For parquet and arrow, pyarrow (optional) parses
+# the CSV into columnar record batches of about EXPORT_BATCH_BYTES each,
+# without a Python object per row or value, and each batch is written out
+# (a Parquet row group, EXPORT_COMPRESSION compressed) as soon as it is
+# parsed. tsv and json still go through tablib, in memory.
+#
+# `flask export-notes` writes the same formats for one inbox or, for the
+# analytics team, every note of every inbox; so does /admin/export/<format>
+# for a client holding EXPORT_TOKEN. See benchmarks/bench_export.py.
+
+EXPORT_BATCH_BYTES = int(os.environ.get('EXPORT_BATCH_BYTES', 16 * 1024 * 1024))
+EXPORT_COMPRESSION = os.environ.get('EXPORT_COMPRESSION', 'zstd')
+# Size of the chunks a CSV export is sent in.
+CHUNK_SIZE = 64 * 1024
+
+STREAMED_FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+TABULAR_FORMATS = ('tsv', 'json')
+EXTENSIONS = {'arrow': 'arrows'}
+
+NOTES_QUERY = """
+    SELECT uuid, inboxes_auth_id, body, byline, archived, "timestamp"
+    FROM notes
+"""
+INBOX_QUERY = NOTES_QUERY + """
+    WHERE inboxes_auth_id = %(auth_id)s AND archived = 'f'
+    ORDER BY "timestamp"
+"""
+
+
+def arrow_schema():
+    return pyarrow.schema([
+        ('uuid', pyarrow.string()),
+        ('inboxes_auth_id', pyarrow.string()),
+        ('body', pyarrow.string()),
+        ('byline', pyarrow.string()),
+        ('archived', pyarrow.bool_()),
+        ('timestamp', pyarrow.timestamp('us')),
+    ])
+
+
+class CopyOut:
+    """The CSV (with a header row) of COPY (query) TO STDOUT, as a readable
+    binary `stream`; use it as a context manager, which raises any error
+    of the COPY once the stream has been read.
+
+    It runs on a healthy replica when there is one (see storage.read_url),
+    else on the primary. `rows` is the number of rows copied, once it is
+    done.
+    """
+
+    def __init__(self, query, params=None):
+        self.query = query
+        self.params = params or {}
+        # Resolved here: reads pinned to the primary are this thread's.
+        self.url = storage.read_url()
+        self.rows = None
+        self.error = None
+        read_fd, write_fd = os.pipe()
+        self.stream = os.fdopen(read_fd, 'rb')
+        self.thread = threading.Thread(target=self.run, args=(write_fd,), daemon=True)
+        self.thread.start()
+
+    def run(self, write_fd):
+        try:
+            # Closing the pipe (even on failure) is what ends the stream.
+            with os.fdopen(write_fd, 'wb') as pipe:
+                connection = self.connect()
+                try:
+                    cursor = connection.cursor()
+                    query = cursor.mogrify(self.query, self.params).decode()
+                    cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)', pipe)
+                    self.rows = cursor.rowcount
+                finally:
+                    connection.close()
+        except Exception as e:
+            # Also a BrokenPipeError when the reader gave up early.
+            self.error = e
+
+    def connect(self):
+        primary = os.environ['DATABASE_URL']
+        try:
+            return psycopg2.connect(self.url)
+        except psycopg2.OperationalError as e:
+            if self.url == primary:
+                raise
+            logging.error(f"Export replica unavailable, copying from the primary: {e}")
+            return psycopg2.connect(primary)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stream.close()
+        self.thread.join()
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+
+class Chunks:
+    """A write-only file collecting what is written to it, so a pyarrow
+    writer's output can be streamed out as it goes."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def record_batches(stream):
+    """Parses a stream of COPY CSV into Arrow record batches."""
+    return pyarrow.csv.open_csv(
+        stream,
+        read_options=pyarrow.csv.ReadOptions(block_size=EXPORT_BATCH_BYTES),
+        parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types=arrow_schema(), true_values=['t'], false_values=['f'],
+            # COPY writes NULL unquoted and empty strings quoted.
+            strings_can_be_null=True, quoted_strings_can_be_null=False))
+
+
+def stream_export(query, params, export_format):
+    """Yields the rows of `query` as chunks of a csv, parquet or arrow file."""
+    metrics.incr('exports_total', format=export_format)
+    with CopyOut(query, params) as copy:
+        if export_format == 'csv':
+            while True:
+                chunk = copy.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            return
+
+        batches = record_batches(copy.stream)
+        sink = Chunks()
+        if export_format == 'parquet':
+            writer = pyarrow.parquet.ParquetWriter(sink, batches.schema, compression=EXPORT_COMPRESSION)
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression=EXPORT_COMPRESSION)
+            writer = pyarrow.ipc.new_stream(sink, batches.schema, options=options)
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+
+
+def export_response(query, params, export_format, filename):
+    if export_format in COLUMNAR_FORMATS and pyarrow is None:
+        abort(404)
+    response = Response(stream_export(query, params, export_format),
+                        mimetype=STREAMED_FORMATS[export_format])
+    extension = EXTENSIONS.get(export_format, export_format)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}.{extension}'
+    return response
+
+
+@app.context_processor
+def inject_export_formats():
+    return dict(columnar_exports=pyarrow is not None)
+
+
+@app.route('/inbox/export/<export_format>')
+@requires_auth
+def inbox_export(export_format):
+    """Download the inbox's active notes."""
+    inbox_db = storage.Inbox(session['nickname'])
+    if export_format in STREAMED_FORMATS:
+        return export_response(INBOX_QUERY, {'auth_id': inbox_db.auth_id}, export_format,
+                               'saythanks-inbox')
+    if export_format not in TABULAR_FORMATS:
+        abort(404)
+    response = make_response(inbox_db.export(export_format))
+    response.headers['Content-Disposition'] = f'attachment; filename=saythanks-inbox.{export_format}'
+    response.headers['Content-type'] = guess_type(f'inbox.{export_format}')[0] or 'application/octet-stream'
+    return response
+
+
+@app.route('/admin/export/<export_format>')
+def admin_export(export_format):
+    """Every note of every inbox, for a client holding EXPORT_TOKEN."""
+    token = os.environ.get('EXPORT_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    if not token or not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+        abort(404)
+    if export_format not in STREAMED_FORMATS:
+        abort(404)
+    return export_response(NOTES_QUERY, None, export_format, 'saythanks-notes')
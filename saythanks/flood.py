@@ -0,0 +1,110 @@
+import os
+import re
+import time
+import struct
+import hashlib
+import logging
+
+from . import metrics
+from .cache import cache
+
+# Flood Detection
+# ---------------
+# Floods against a public /to/<inbox_id> form repeat the same note, or
+# nearly, over and over. Each submission is fingerprinted from its raw
+# form fields before any markdown/lxml work: a hash of the normalized text
+# (for exact repeats) and a simhash of its words (for near ones).
+# The last FLOOD_RECENT fingerprints of each inbox are kept in the shared
+# cache, and a submission matching one seen within FLOOD_WINDOW seconds is
+# collapsed into it: the sender sees the usual thank-you page, but nothing
+# is parsed, stored or emailed.
+#
+# Short notes ("Thanks!") are only ever matched exactly, byline included,
+# so different people thanking an inbox the same way are not collapsed.
+
+FLOOD_ENABLED = os.environ.get('FLOOD_ENABLED', '1') != '0'
+FLOOD_WINDOW = int(os.environ.get('FLOOD_WINDOW', 600))
+FLOOD_RECENT = int(os.environ.get('FLOOD_RECENT', 32))
+# Notes within this many differing simhash bits are near duplicates.
+# Short texts make noisy simhashes, so the defaults are conservative: a word
+# or two swapped in a 16-word note typically moves it 6-9 bits, while
+# unrelated notes are rarely fewer than 15 apart.
+FLOOD_DISTANCE = int(os.environ.get('FLOOD_DISTANCE', 6))
+# Notes shorter than this (in words) are only matched exactly.
+FLOOD_MIN_WORDS = int(os.environ.get('FLOOD_MIN_WORDS', 16))
+# Only the start of a long note goes into its simhash.
+MAX_WORDS = 256
+
+# (exact hash, simhash, last seen): 20 bytes, so a full history of an inbox
+# stays well within a shm:// cache slot.
+ENTRY = struct.Struct('>QQI')
+WORD = re.compile(r'\w+')
+
+recent = cache.namespace('flood')
+
+
+def hash64(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'big')
+
+
+def simhash(words):
+    """A 64-bit simhash of `words`."""
+    weights = [0] * 64
+    for word in words[:MAX_WORDS]:
+        h = hash64(word)
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def fingerprint(body, byline):
+    """Returns (exact hash, simhash or None) of a submission's raw fields;
+    the simhash is None for notes too short to match approximately."""
+    words = WORD.findall(body.lower())
+    exact = hash64(' '.join(words) + '\0' + ' '.join(WORD.findall(byline.lower())))
+    if len(words) < FLOOD_MIN_WORDS:
+        return exact, None
+    return exact, simhash(words)
+
+
+def match(entry, exact, near):
+    """'exact' or 'near' if a recorded fingerprint matches, else None."""
+    if entry[0] == exact:
+        return 'exact'
+    if near is not None and entry[1] and bin(entry[1] ^ near).count('1') <= FLOOD_DISTANCE:
+        return 'near'
+    return None
+
+
+def is_duplicate(inbox_id, body, byline):
+    """Records the submission's fingerprint in the inbox's recent history.
+
+    Returns True when it repeats one seen within FLOOD_WINDOW, in which case
+    the caller should drop the note (and the match is refreshed, so a flood
+    that keeps going keeps being collapsed).
+    """
+    if not FLOOD_ENABLED:
+        return False
+    exact, near = fingerprint(body, byline)
+    now = int(time.time())
+    try:
+        data = recent.get(inbox_id, b'')
+        entries = [entry for entry in ENTRY.iter_unpack(data) if entry[2] > now - FLOOD_WINDOW]
+    except struct.error as e:
+        logging.error("Flood history unreadable: " + str(e))
+        entries = []
+    kind = None
+    for i, entry in enumerate(entries):
+        kind = match(entry, exact, near)
+        if kind:
+            entries.pop(i)
+            break
+    # Most recent last; forget the oldest beyond FLOOD_RECENT.
+    entries.append((exact, near or 0, now))
+    entries = entries[-FLOOD_RECENT:]
+    recent.set(inbox_id, b''.join(ENTRY.pack(*entry) for entry in entries), FLOOD_WINDOW)
+    if kind:
+        metrics.incr('flood_collapsed_total', kind=kind)
+        metrics.incr('flood_collapsed_bytes_total', len(body))
+        return True
+    return False
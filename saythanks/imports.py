@@ -0,0 +1,413 @@
+import io
+import os
+import sys
+import csv
+import glob
+import json
+import time
+import uuid
+import logging
+import secrets
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+from lxml.etree import ParserError
+from flask import request, session, abort, jsonify, url_for
+
+from .core import app, requires_auth, requires_csrf, clean_note
+from . import metrics, storage
+from .cache import cache, LocalBackend
+from .utils import note_text, note_preview
+
+# Note Imports
+# ------------
+# Loads notes into an inbox from CSV (with a header row) or NDJSON, e.g. a
+# file from /inbox/export. Recognised fields are body (required), byline,
+# content-type ('markdown' or 'html'), archived, timestamp and uuid.
+#
+# The file is read as a stream, IMPORT_CHUNK_SIZE rows at a time: each
+# chunk is validated and sanitized like a submitted note, then COPYed into
+# a temporary staging table. One set-based INSERT ... SELECT then merges
+# the staged notes into the inbox, skipping those already there (same uuid,
+# or same body and byline) and repeats within the file, and updates the
+# inbox's counters, byline facet and activity rollups. Memory stays bounded
+# by the chunk size, however large the file.
+#
+# Imported notes are not emailed or announced to open inboxes; their
+# share-page snapshots are published once they are merged.
+
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 1000))
+# Largest file accepted by the upload form.
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 100 * 1024 * 1024))
+# Rejected rows reported back (the rest are only counted).
+MAX_ERRORS = 20
+# An upload whose progress hasn't been refreshed for this long has stopped.
+IMPORT_STALE_SECONDS = int(os.environ.get('IMPORT_STALE_SECONDS', 120))
+# How often a running upload refreshes its progress.
+HEARTBEAT_SECONDS = 10
+UPLOAD_PREFIX = 'saythanks-import-'
+TRUE = {'t', 'true', '1', 'yes', 'y'}
+
+# Held while merging, so two imports never both take a uuid that neither
+# saw in notes (which, partitioned, can't keep uuids unique itself).
+IMPORT_LOCK = 7061830
+
+csv.field_size_limit(16 * 1024 * 1024)
+progress_cache = cache.namespace('imports')
+
+STAGING_TABLE = """
+    CREATE TEMPORARY TABLE import_notes (
+        line integer NOT NULL,
+        uuid uuid,
+        body text NOT NULL,
+        byline text NOT NULL,
+        body_text text NOT NULL,
+        preview text NOT NULL,
+        archived boolean NOT NULL,
+        "timestamp" timestamp without time zone
+    )
+"""
+
+MERGE = f"""
+    WITH staged AS (
+        SELECT s.*, row_number() OVER (PARTITION BY s.uuid ORDER BY s.line) AS nth
+        FROM import_notes s
+    ), candidates AS (
+        SELECT DISTINCT ON (md5(s.body), s.byline) s.*
+        FROM staged s
+        WHERE (s.uuid IS NULL OR s.nth = 1)
+        AND NOT EXISTS (SELECT 1 FROM notes n WHERE n.uuid = s.uuid)
+        AND NOT EXISTS (
+            SELECT 1 FROM notes n
+            WHERE n.inboxes_auth_id = %(auth_id)s AND md5(n.body) = md5(s.body) AND n.byline = s.byline
+        )
+        ORDER BY md5(s.body), s.byline, s.line
+    ), inserted AS (
+        INSERT INTO notes (uuid, inboxes_auth_id, body, byline, body_text, preview, archived, "timestamp")
+        SELECT COALESCE(uuid, gen_random_uuid()), %(auth_id)s, body, byline, body_text, preview, archived,
+            COALESCE("timestamp", now())
+        FROM candidates
+        RETURNING byline, archived, "timestamp"
+    ), counted AS (
+        UPDATE inboxes
+        SET notes_active = notes_active + (SELECT COUNT(*) FROM inserted WHERE NOT archived),
+            notes_archived = notes_archived + (SELECT COUNT(*) FROM inserted WHERE archived)
+        WHERE auth_id = %(auth_id)s
+    ), bylines AS (
+        INSERT INTO inbox_bylines (inboxes_auth_id, byline, display, notes)
+        SELECT %(auth_id)s, {storage.BYLINE_KEY.format('byline')},
+            max(regexp_replace(btrim(byline), '\\s+', ' ', 'g')), COUNT(*)
+        FROM inserted
+        WHERE NOT archived AND btrim(byline) <> ''
+        GROUP BY 2
+        ON CONFLICT (inboxes_auth_id, byline) DO UPDATE
+        SET notes = inbox_bylines.notes + EXCLUDED.notes, display = EXCLUDED.display
+    ), hours AS (
+        INSERT INTO inbox_activity (inboxes_auth_id, day, hour, notes, archived)
+        SELECT %(auth_id)s, "timestamp"::date, extract(hour FROM "timestamp")::int,
+            COUNT(*), COUNT(*) FILTER (WHERE archived)
+        FROM inserted
+        GROUP BY 2, 3
+        ON CONFLICT (inboxes_auth_id, day, hour) DO UPDATE
+        SET notes = inbox_activity.notes + EXCLUDED.notes, archived = inbox_activity.archived + EXCLUDED.archived
+    ), byline_days AS (
+        INSERT INTO inbox_byline_activity (inboxes_auth_id, day, byline, display, notes)
+        SELECT %(auth_id)s, "timestamp"::date, {storage.BYLINE_KEY.format('byline')},
+            max(regexp_replace(btrim(byline), '\\s+', ' ', 'g')), COUNT(*)
+        FROM inserted
+        WHERE btrim(byline) <> ''
+        GROUP BY 2, 3
+        ON CONFLICT (inboxes_auth_id, day, byline) DO UPDATE
+        SET notes = inbox_byline_activity.notes + EXCLUDED.notes, display = EXCLUDED.display
+    )
+    SELECT COUNT(*) FROM inserted
+"""
+
+
+def read_rows(stream, file_format):
+    """Yields the rows of a binary stream of CSV or NDJSON as dicts (None
+    for a line that isn't a JSON object)."""
+    if file_format == 'csv':
+        yield from csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+        return
+    for line in io.TextIOWrapper(stream, encoding='utf-8'):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row if isinstance(row, dict) else None
+
+
+def format_of(filename, default='csv'):
+    extension = os.path.splitext(filename or '')[1].lower()
+    return {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}.get(extension, default)
+
+
+def chunked(rows, size=IMPORT_CHUNK_SIZE):
+    """Groups rows into lists of (line number, row)."""
+    chunk = []
+    for line, row in enumerate(rows, 1):
+        chunk.append((line, row))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def clean_row(row, content_type):
+    """Returns the staged tuple for a row (without its line number), or
+    the reason it was rejected."""
+    if not isinstance(row, dict) or not isinstance(row.get('body'), str):
+        return 'no body'
+    byline = row.get('byline') or ''
+    if not isinstance(byline, str):
+        return 'byline is not text'
+    note_uuid = row.get('uuid') or None
+    timestamp = row.get('timestamp') or None
+    try:
+        if note_uuid is not None:
+            note_uuid = str(uuid.UUID(str(note_uuid)))
+        if timestamp is not None:
+            timestamp = datetime.fromisoformat(str(timestamp)).replace(tzinfo=None)
+    except ValueError:
+        return 'invalid uuid or timestamp'
+    try:
+        cleaned = clean_note(row['body'], byline, row.get('content-type') or content_type)
+    except (ParserError, ValueError) as e:
+        # e.g. "Document is empty", for a body of nothing but a comment
+        return f'unreadable body ({e})'
+    if not cleaned:
+        return 'empty body'
+    body, byline = str(cleaned[0]), str(cleaned[1])
+    text = note_text(body)
+    archived = str(row.get('archived') or '').strip().lower() in TRUE
+    return note_uuid, body, byline, text, note_preview(text), archived, timestamp
+
+
+def clean_chunk(chunk, content_type='markdown'):
+    """Validates and sanitizes a chunk; returns (staged rows, rejections)."""
+    staged, rejected = [], []
+    for line, row in chunk:
+        result = clean_row(row, content_type)
+        if isinstance(result, str):
+            rejected.append((line, result))
+        else:
+            staged.append((line,) + result)
+    return staged, rejected
+
+
+def clean_chunks(chunks, content_type, jobs=1):
+    """Yields clean_chunk() of each chunk, in order, sanitizing on `jobs`
+    processes with at most two chunks per process in flight."""
+    if jobs <= 1:
+        for chunk in chunks:
+            yield clean_chunk(chunk, content_type)
+        return
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = []
+        for chunk in chunks:
+            pending.append(pool.submit(clean_chunk, chunk, content_type))
+            if len(pending) >= 2 * jobs:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def copy_rows(cursor, rows):
+    """COPYs staged rows into import_notes."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(r'\N' if value is None else value for value in row)
+    buffer.seek(0)
+    cursor.copy_expert(r"COPY import_notes FROM STDIN WITH (FORMAT csv, NULL '\N')", buffer)
+
+
+def import_notes(slug, stream, file_format, content_type='markdown', jobs=1, progress=None):
+    """Imports a CSV or NDJSON stream of notes into the inbox `slug`.
+
+    `progress`, if given, is called with the running stats after every
+    chunk and once at the end. Returns the stats: rows read, staged,
+    rejected (with the first few errors), imported and duplicates.
+    """
+    auth_id = storage.Inbox(slug).auth_id
+    stats = {'read': 0, 'staged': 0, 'rejected': 0, 'errors': [], 'imported': None, 'duplicates': None}
+    connection = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        cursor = connection.cursor()
+        cursor.execute(STAGING_TABLE)
+        chunks = chunked(read_rows(stream, file_format))
+        for staged, rejected in clean_chunks(chunks, content_type, jobs):
+            copy_rows(cursor, staged)
+            # Commit as we go, so staging never holds one long transaction.
+            connection.commit()
+            stats['read'] += len(staged) + len(rejected)
+            stats['staged'] += len(staged)
+            stats['rejected'] += len(rejected)
+            room = MAX_ERRORS - len(stats['errors'])
+            stats['errors'].extend(f'row {line}: {reason}' for line, reason in rejected[:max(room, 0)])
+            if progress:
+                progress(stats)
+
+        cursor.execute('ANALYZE import_notes')
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (IMPORT_LOCK,))
+        cursor.execute(MERGE, {'auth_id': auth_id})
+        stats['imported'] = cursor.fetchone()[0]
+        connection.commit()
+    finally:
+        connection.close()
+    stats['duplicates'] = stats['staged'] - stats['imported']
+    metrics.incr('notes_imported_total', stats['imported'])
+    storage.invalidate_searches(auth_id)
+    if stats['imported']:
+        # Read back what was just written from the primary.
+        storage.pin_until(time.time() + storage.REPLICA_PIN_SECONDS)
+        storage.notes_imported.send(auth_id)
+    logging.error(f"Imported {stats['imported']} note(s) into {slug}")
+    if progress:
+        progress(stats)
+    return stats
+
+
+# Uploads
+# -------
+# POST /inbox/import (multipart, `file`) spools the upload to a temporary
+# file and starts `flask import-notes` on it in a process of its own, off
+# the web worker; poll the returned progress URL for the stats (`done` once
+# merged, `error` if it failed). The import refreshes them every
+# HEARTBEAT_SECONDS, so one whose process died is reported as stopped after
+# IMPORT_STALE_SECONDS. The process publishes progress through the cache,
+# so this needs a CACHE_URL shared between processes (shm:// or redis://);
+# on the per-process memory:// (development) the import runs on a thread
+# of the web process instead.
+
+
+class Progress:
+    """Publishes an upload's stats under `key` for its progress URL, and
+    refreshes them every HEARTBEAT_SECONDS until closed. Call it with the
+    running stats of import_notes()."""
+
+    def __init__(self, key):
+        self.key = key
+        self.stats = {'done': False, 'read': 0}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def __call__(self, stats):
+        self.publish(dict(stats, done=stats['imported'] is not None))
+
+    def publish(self, stats):
+        self.stats = stats
+        progress_cache.set(self.key, dict(stats, heartbeat=time.time()), 86400)
+
+    def beat(self):
+        while not self.stopped.wait(HEARTBEAT_SECONDS):
+            self.publish(self.stats)
+
+    def __enter__(self):
+        self.publish(self.stats)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_upload(slug, key, path, file_format, content_type):
+    """Imports an uploaded file, publishing progress under `key`, then
+    removes it (in the process start_upload() starts)."""
+    with Progress(key) as progress:
+        try:
+            with open(path, 'rb') as f:
+                import_notes(slug, f, file_format, content_type, progress=progress)
+        except Exception as e:
+            logging.error(f"Import into {slug} failed: {e}")
+            progress.publish({'done': True, 'error': 'The import failed.'})
+        finally:
+            os.remove(path)
+
+
+def start_upload(slug, key, path, file_format, content_type):
+    """Starts importing an uploaded file in a `flask import-notes` process,
+    detached from the web worker."""
+    if isinstance(progress_cache.backend, LocalBackend):
+        threading.Thread(target=run_upload, args=(slug, key, path, file_format, content_type),
+                         daemon=True).start()
+        return
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.Popen(
+        [sys.executable, '-m', 'flask', 'import-notes', slug, path, '--format', file_format,
+         '--content-type', content_type, '--upload', key],
+        cwd=root, env=dict(os.environ, FLASK_APP='saythanks'),
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, start_new_session=True)
+
+
+def sweep_uploads(max_age=86400):
+    """Removes spooled uploads older than `max_age` seconds, left behind by
+    imports that never got to run or were killed."""
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), UPLOAD_PREFIX + '*')):
+        try:
+            if os.path.getmtime(path) < time.time() - max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+@app.route('/inbox/import', methods=['POST'])
+@requires_auth
+@requires_csrf
+def inbox_import():
+    """Start importing an uploaded CSV or NDJSON file into the inbox."""
+    upload = request.files.get('file')
+    if upload is None:
+        abort(400)
+    file_format = format_of(upload.filename, 'ndjson' if 'json' in (upload.mimetype or '') else 'csv')
+    content_type = request.form.get('content-type', 'markdown')
+    if content_type not in ('markdown', 'html'):
+        abort(400)
+
+    sweep_uploads()
+    fd, path = tempfile.mkstemp(prefix=UPLOAD_PREFIX)
+    size = 0
+    with os.fdopen(fd, 'wb') as f:
+        while True:
+            block = upload.stream.read(64 * 1024)
+            if not block:
+                break
+            size += len(block)
+            if size > IMPORT_MAX_BYTES:
+                f.close()
+                os.remove(path)
+                abort(413)
+            f.write(block)
+
+    slug = session['nickname']
+    import_id = secrets.token_urlsafe(8)
+    key = f'{slug}:{import_id}'
+    progress_cache.set(key, {'done': False, 'read': 0, 'heartbeat': time.time()}, 86400)
+    try:
+        start_upload(slug, key, path, file_format, content_type)
+    except OSError:
+        os.remove(path)
+        raise
+    return jsonify(progress=url_for('inbox_import_progress', import_id=import_id)), 202
+
+
+@app.route('/inbox/import/<import_id>')
+@requires_auth
+def inbox_import_progress(import_id):
+    """The stats of an import started by this user."""
+    stats = progress_cache.get(f"{session['nickname']}:{import_id}")
+    if stats is None:
+        abort(404)
+    if not stats.get('done') and time.time() - stats.get('heartbeat', 0) > IMPORT_STALE_SECONDS:
+        stats = {'done': True, 'error': 'The import stopped.'}
+    return jsonify(stats)
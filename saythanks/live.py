@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import queue
+import select
+import logging
+import threading
+
+import psycopg2
+import psycopg2.extensions
+from flask import Response, session, abort
+
+from .core import app, requires_auth
+from . import metrics, storage
+from .utils import NOTES_CHANNEL
+
+# Live Inbox Updates
+# ------------------
+# Storing a note NOTIFYs NOTES_CHANNEL with a compact summary of it. One
+# listener thread per process LISTENs on a single connection, however many
+# clients are connected, and fans the summaries out to the open
+# /inbox/stream (Server-Sent Events) connections of that inbox.
+#
+# Each client gets a small bounded queue: one too slow to drain it is told
+# to reload and disconnected rather than buffered for without bound. Streams
+# close after SSE_MAX_AGE, and dead ones are noticed at the next heartbeat,
+# so idle clients don't hold on to workers; browsers reconnect by
+# themselves. Every open stream occupies a thread or greenlet, so a sync
+# worker would be tied up by a single open inbox (and killed by its
+# timeout): on gunicorn's sync workers the stream isn't offered at all.
+# Serve it with the gthread or gevent profile, or in ASGI mode.
+
+# Set SSE_ENABLED=0 or 1 to decide; otherwise gunicorn.conf.py decides from
+# the worker class each worker actually runs (see enable_for).
+SSE_ENABLED = os.environ.get('SSE_ENABLED', '1') != '0'
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 100))
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 50))
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 15))
+SSE_MAX_AGE = float(os.environ.get('SSE_MAX_AGE', 600))
+
+
+class Subscriber:
+    """One connected client, and the note summaries waiting for it."""
+
+    def __init__(self, auth_id):
+        self.auth_id = auth_id
+        self.queue = queue.Queue(SSE_QUEUE_SIZE)
+        self.overflowed = False
+
+    def push(self, data):
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.overflowed = True
+
+
+class Listener:
+    """Relays note notifications to this process's subscribers."""
+
+    def __init__(self, url):
+        self.url = url
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.pid = None
+
+    def count(self):
+        return sum(len(subscribers) for subscribers in self.subscribers.values())
+
+    def subscribe(self, auth_id):
+        """Returns a new Subscriber for the inbox, or None when full."""
+        with self.lock:
+            if self.pid != os.getpid():
+                # First subscriber in this process (workers fork after import).
+                self.pid = os.getpid()
+                self.subscribers = {}
+                threading.Thread(target=self.listen, daemon=True).start()
+            if self.count() >= SSE_MAX_CLIENTS:
+                return None
+            subscriber = Subscriber(auth_id)
+            self.subscribers.setdefault(auth_id, set()).add(subscriber)
+            metrics.set_gauge('sse_clients', self.count())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(subscriber.auth_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self.subscribers.pop(subscriber.auth_id, None)
+            metrics.set_gauge('sse_clients', self.count())
+
+    def dispatch(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        auth_id = event.pop('inbox', None)
+        with self.lock:
+            subscribers = list(self.subscribers.get(auth_id, ()))
+        data = json.dumps(event, separators=(',', ':'))
+        for subscriber in subscribers:
+            subscriber.push(data)
+
+    def listen(self):
+        while True:
+            connection = None
+            try:
+                connection = psycopg2.connect(self.url)
+                connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                connection.cursor().execute(f'LISTEN {NOTES_CHANNEL}')
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self.dispatch(connection.notifies.pop(0).payload)
+            except Exception as e:
+                logging.error("Live update listener failed: " + str(e))
+                if connection is not None:
+                    connection.close()
+                time.sleep(1)
+
+
+listener = Listener(os.environ['DATABASE_URL'])
+
+
+def stream(subscriber):
+    deadline = time.monotonic() + SSE_MAX_AGE
+    yield 'retry: 5000\n\n'
+    while time.monotonic() < deadline:
+        if subscriber.overflowed:
+            metrics.incr('sse_overflows_total')
+            yield 'event: reload\ndata: {}\n\n'
+            return
+        try:
+            data = subscriber.queue.get(timeout=SSE_HEARTBEAT)
+        except queue.Empty:
+            # Comments keep proxies from timing out, and show whether the
+            # client is still there.
+            yield ': keepalive\n\n'
+            continue
+        yield f'event: note\ndata: {data}\n\n'
+
+
+def enable_for(worker_class):
+    """Offer the stream unless the worker class is gunicorn's sync worker
+    (or derived from it), or SSE_ENABLED says otherwise."""
+    global SSE_ENABLED
+    from gunicorn.workers.sync import SyncWorker
+
+    if not os.environ.get('SSE_ENABLED'):
+        SSE_ENABLED = not issubclass(worker_class, SyncWorker)
+
+
+@app.context_processor
+def inject_live_updates():
+    return dict(live_updates=SSE_ENABLED)
+
+
+@app.route('/inbox/stream')
+@requires_auth
+def inbox_stream():
+    """Push summaries of the inbox's new notes as Server-Sent Events."""
+    if not SSE_ENABLED:
+        abort(404)
+    auth_id = storage.Inbox(session['nickname']).auth_id
+    subscriber = listener.subscribe(auth_id)
+    if subscriber is None:
+        abort(503)
+    response = Response(stream(subscriber), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Ask nginx-style proxies not to buffer the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    # Runs however the stream ends, even if it never started.
+    response.call_on_close(lambda: listener.unsubscribe(subscriber))
+    return response
@@ -0,0 +1,51 @@
+import threading
+from collections import defaultdict
+
+# Process-local Metrics
+# ---------------------
+# Each gunicorn worker keeps its own counters; scrape every worker (or sum
+# them downstream) to get totals for the dyno.
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+    """Increment the counter `name` (with optional labels) by `value`."""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    """Record the current value of the gauge `name`."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def value(name, **labels):
+    """Returns the current value of a counter or gauge, or 0 if unset."""
+    key = _key(name, labels)
+    with _lock:
+        if key in _gauges:
+            return _gauges[key]
+        return _counters.get(key, 0)
+
+
+def _format(key, val):
+    name, labels = key
+    if labels:
+        pairs = ','.join(f'{k}="{v}"' for k, v in labels)
+        name = f'{name}{{{pairs}}}'
+    return f'{name} {val:g}'
+
+
+def render():
+    """Renders every metric in the Prometheus text exposition format."""
+    with _lock:
+        items = list(_counters.items()) + list(_gauges.items())
+    return '\n'.join(_format(k, v) for k, v in sorted(items)) + '\n'
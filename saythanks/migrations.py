@@ -0,0 +1,341 @@
+import os
+import re
+import time
+import json
+import logging
+
+import psycopg2
+from psycopg2 import errors
+
+# Schema Migrations
+# -----------------
+# The files in sqls/migrations/, named NNN-description.sql, are applied in
+# order by `flask migrate` and recorded by name in schema_migrations. A file
+# runs statement by statement in one transaction, with lock_timeout set: DDL
+# that can't get its lock promptly gives up and is retried later, instead of
+# queueing every query on the table behind it. Comments direct the runner:
+#
+#   -- migrate:no-transaction   anywhere in the file: run each statement on
+#                               its own, as CREATE INDEX CONCURRENTLY needs
+#                               (such files must be safe to re-run)
+#   -- migrate:batch 1000       just before a statement (no-transaction files
+#                               only): repeat it, with :batch_size replaced
+#                               by 1000, until it changes fewer rows, each
+#                               batch its own short transaction
+#
+# An index a crashed CREATE INDEX CONCURRENTLY left INVALID is dropped and
+# built again when the file is re-run.
+#
+# `flask migrate --dry-run` shows what would run, with rough estimates.
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'sqls', 'migrations')
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')
+MIGRATION_RETRIES = int(os.environ.get('MIGRATION_RETRIES', 5))
+# Pause between backfill batches, so replicas and autovacuum keep up.
+MIGRATION_BATCH_PAUSE = float(os.environ.get('MIGRATION_BATCH_PAUSE', 0.1))
+# Throughput assumed by dry-run estimates.
+MIGRATION_MB_PER_SECOND = float(os.environ.get('MIGRATION_MB_PER_SECOND', 50))
+
+# Held while migrating, so two deploys never run migrations at once.
+ADVISORY_LOCK = 7061829
+NO_TRANSACTION = re.compile(r'^--\s*migrate:no-transaction\s*$', re.M)
+BATCH = re.compile(r'^--\s*migrate:batch\s+(\d+)\s*$', re.M)
+CONCURRENT_INDEX = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w."]+)', re.I)
+TARGET = re.compile(
+    r'\b(?:ON(?:\s+ONLY)?|ALTER\s+TABLE(?:\s+ONLY)?|UPDATE(?:\s+ONLY)?|INSERT\s+INTO|DELETE\s+FROM|LOCK\s+TABLE)'
+    r'\s+(?:IF\s+EXISTS\s+)?([\w."]+)', re.I)
+
+LockNotAvailable = errors.lookup('55P03')
+
+
+class MigrationError(Exception):
+    pass
+
+
+def split_statements(sql):
+    """Splits a SQL script on semicolons outside quotes, dollar-quoted
+    bodies and comments. Each statement keeps the comments before it."""
+    statements, start, i, code = [], 0, 0, False
+    while i < len(sql):
+        if sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = len(sql) if end == -1 else end + 1
+            continue
+        if sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = len(sql) if end == -1 else end + 2
+            continue
+        char = sql[i]
+        if char in '\'"':
+            end = sql.find(char, i + 1)
+            i = len(sql) if end == -1 else end + 1
+            code = True
+            continue
+        tag = re.match(r'\$(?:[A-Za-z_]\w*)?\$', sql[i:])
+        if tag:
+            end = sql.find(tag.group(), i + len(tag.group()))
+            i = len(sql) if end == -1 else end + len(tag.group())
+            code = True
+            continue
+        if char == ';':
+            if code:
+                statements.append(sql[start:i].strip())
+            start, code = i + 1, False
+        elif not char.isspace():
+            code = True
+        i += 1
+    if code:
+        statements.append(sql[start:].strip())
+    return statements
+
+
+def summary(statement):
+    """The statement's first line of SQL, for progress output."""
+    lines = [line.strip() for line in statement.splitlines() if line.strip() and not line.strip().startswith('--')]
+    line = lines[0] if lines else ''
+    return line if len(line) <= 72 else line[:69] + '...'
+
+
+class Migration:
+    """One migration file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.version = os.path.basename(path)[:-len('.sql')]
+        with open(path) as f:
+            self.sql = f.read()
+        self.transactional = not NO_TRANSACTION.search(self.sql)
+        self.statements = split_statements(self.sql)
+        if self.transactional and any(BATCH.search(s) for s in self.statements):
+            raise MigrationError(f'{self.version}: batched statements need -- migrate:no-transaction')
+
+    def __repr__(self):
+        return f'<Migration {self.version}>'
+
+
+def available():
+    names = sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith('.sql'))
+    return [Migration(os.path.join(MIGRATIONS_DIR, name)) for name in names]
+
+
+def connect():
+    connection = psycopg2.connect(os.environ['DATABASE_URL'])
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS public.schema_migrations (version character varying PRIMARY KEY)
+    ''')
+    return connection
+
+
+def applied(connection):
+    cursor = connection.cursor()
+    cursor.execute('SELECT version FROM public.schema_migrations')
+    return {row[0] for row in cursor.fetchall()}
+
+
+def pending(connection):
+    done = applied(connection)
+    return [migration for migration in available() if migration.version not in done]
+
+
+def record(cursor, version):
+    cursor.execute('INSERT INTO public.schema_migrations (version) VALUES (%s) ON CONFLICT DO NOTHING',
+                   (version,))
+
+
+def baseline(version):
+    """Records every migration up to `version` as applied without running
+    it (for databases migrated by hand). Returns the versions recorded."""
+    versions = [m.version for m in available() if m.version <= version]
+    if version not in versions:
+        raise MigrationError(f'No migration {version}.')
+    connection = connect()
+    try:
+        cursor = connection.cursor()
+        for v in versions:
+            record(cursor, v)
+    finally:
+        connection.close()
+    return versions
+
+
+def retrying(what, attempt, echo):
+    """Runs attempt() again when it times out waiting for a lock."""
+    for tries in range(MIGRATION_RETRIES + 1):
+        try:
+            return attempt()
+        except LockNotAvailable:
+            if tries == MIGRATION_RETRIES:
+                raise MigrationError(f'{what}: gave up waiting for locks after {tries + 1} attempts.')
+            wait = 2 ** tries
+            echo(f'  lock not available, retrying in {wait}s')
+            time.sleep(wait)
+
+
+def run_in_transaction(connection, migration, echo):
+    def attempt():
+        connection.autocommit = False
+        try:
+            with connection:
+                cursor = connection.cursor()
+                cursor.execute(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+                for statement in migration.statements:
+                    echo(f'  {summary(statement)}')
+                    cursor.execute(statement)
+                record(cursor, migration.version)
+        finally:
+            connection.autocommit = True
+
+    retrying(migration.version, attempt, echo)
+
+
+def run_statement(connection, statement, echo):
+    """Runs one statement of a no-transaction migration in autocommit mode."""
+    cursor = connection.cursor()
+    batch = BATCH.search(statement)
+    index = CONCURRENT_INDEX.search(statement)
+    echo(f'  {summary(statement)}')
+
+    if batch:
+        size = int(batch.group(1))
+        sql = statement.replace(':batch_size', str(size))
+        total = 0
+        while True:
+            retrying(summary(statement), lambda: cursor.execute(sql), echo)
+            total += cursor.rowcount
+            if cursor.rowcount < size:
+                break
+            echo(f'    {total} row(s)...')
+            time.sleep(MIGRATION_BATCH_PAUSE)
+        echo(f'    {total} row(s) in all')
+        return
+
+    def attempt():
+        if index:
+            drop_invalid_index(cursor, index.group(1), echo)
+        cursor.execute(statement)
+
+    retrying(summary(statement), attempt, echo)
+
+
+def drop_invalid_index(cursor, name, echo):
+    """Drops `name` if it is an INVALID index, as a failed or interrupted
+    CREATE INDEX CONCURRENTLY leaves behind (and IF NOT EXISTS would then
+    take for a finished one), so it is built again."""
+    cursor.execute('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)', (name,))
+    row = cursor.fetchone()
+    if row and row[0]:
+        echo(f'    dropping invalid index {name}')
+        cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def run(connection, migration, echo):
+    start = time.monotonic()
+    echo(f'{migration.version}' + ('' if migration.transactional else ' (no transaction)'))
+    if migration.transactional:
+        run_in_transaction(connection, migration, echo)
+    else:
+        connection.cursor().execute(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+        for statement in migration.statements:
+            run_statement(connection, statement, echo)
+        record(connection.cursor(), migration.version)
+    echo(f'  done in {time.monotonic() - start:.1f}s')
+
+
+def migrate(echo=print):
+    """Applies every pending migration in order; returns their versions."""
+    connection = connect()
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', (ADVISORY_LOCK,))
+        if not cursor.fetchone()[0]:
+            raise MigrationError('Another migration run is in progress.')
+        done = []
+        for migration in pending(connection):
+            try:
+                run(connection, migration, echo)
+            except psycopg2.Error as e:
+                logging.error(f"Migration {migration.version} failed: {e}")
+                raise MigrationError(f'{migration.version} failed: {e}')
+            done.append(migration.version)
+        return done
+    finally:
+        connection.close()
+
+
+# Dry Runs
+# --------
+
+
+def relation_size(cursor, name):
+    """(bytes, estimated rows) of a table, or None if it doesn't exist."""
+    cursor.execute('''
+        SELECT pg_total_relation_size(c.oid), GREATEST(c.reltuples, 0)::bigint
+        FROM pg_class c WHERE c.oid = to_regclass(%s)
+    ''', (name,))
+    return cursor.fetchone()
+
+
+def planned_rows(cursor, statement):
+    """The planner's estimate of the rows a DML statement touches."""
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + statement)
+    plan = cursor.fetchone()[0]
+    plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+    # ModifyTable nodes report 0 rows; what they are fed is the estimate.
+    return (plan.get('Plans') or [plan])[0]['Plan Rows']
+
+
+def estimate(cursor, statement):
+    """Describes what running `statement` would involve, and roughly how
+    long it might take from the size of the table it targets."""
+    code = '\n'.join(line for line in statement.splitlines() if not line.strip().startswith('--'))
+    target = TARGET.search(code)
+    size = relation_size(cursor, target.group(1)) if target else None
+    if size is None:
+        return 'new or unknown table' if target else '', None
+    megabytes, rows = size[0] / 1e6, size[1]
+    scan = megabytes / MIGRATION_MB_PER_SECOND
+    batch = BATCH.search(statement)
+    if batch:
+        batch_size = int(batch.group(1))
+        changed = planned_rows(cursor, code.replace(':batch_size', str(2 ** 31 - 1)))
+        batches = -(-changed // batch_size)
+        seconds = scan * min(changed / rows, 1) if rows else 0
+        return (f'~{changed} of {rows} rows in {batches} batch(es) of {batch_size}',
+                seconds + batches * MIGRATION_BATCH_PAUSE)
+    if CONCURRENT_INDEX.search(code):
+        # Two passes over the table, without blocking writes.
+        return f'{megabytes:.0f} MB, {rows} rows, concurrent', 2 * scan
+    if re.search(r'CREATE\s+(UNIQUE\s+)?INDEX', code, re.I):
+        return f'{megabytes:.0f} MB, {rows} rows, BLOCKS WRITES while building', scan
+    if re.match(r'\s*(UPDATE|INSERT|DELETE)\b', code, re.I):
+        changed = planned_rows(cursor, code)
+        return f'~{changed} of {rows} rows in one transaction', scan * min(changed / rows, 1) if rows else 0
+    return f'{megabytes:.0f} MB, {rows} rows', None
+
+
+def dry_run(echo=print):
+    """Lists the pending migrations and their statements, with estimates;
+    changes nothing. Returns the pending versions."""
+    connection = connect()
+    try:
+        cursor = connection.cursor()
+        migrations = pending(connection)
+        for migration in migrations:
+            echo(f'{migration.version}' + ('' if migration.transactional else ' (no transaction)'))
+            total = 0
+            for statement in migration.statements:
+                try:
+                    note, seconds = estimate(cursor, statement)
+                except psycopg2.Error as e:
+                    # e.g. it depends on an earlier statement of the migration
+                    note, seconds = f'no estimate ({str(e).splitlines()[0]})', None
+                total += seconds or 0
+                timing = f', ~{seconds:.1f}s' if seconds is not None else ''
+                echo(f'  {summary(statement)}' + (f'\n    [{note}{timing}]' if note else ''))
+            echo(f'  estimated {total:.1f}s in all')
+        return [migration.version for migration in migrations]
+    finally:
+        connection.close()
@@ -23,6 +23,15 @@ logger = logging.getLogger()
 API_KEY = os.environ['SENDGRID_API_KEY']
 sg = sendgrid.SendGridAPIClient(api_key=API_KEY)
 
+
+def reconnect():
+    """Builds this process's own SendGrid client (after a fork)."""
+    global sg
+    sg = sendgrid.SendGridAPIClient(api_key=API_KEY)
+
+
+SENDGRID_SEND_URL = 'https://api.sendgrid.com/v3/mail/send'
+
 TEMPLATE = """<div>{}
 <br>
 <br>
@@ -72,16 +81,7 @@ def notify(note, email_address):
             with current_app.app_context():
                 note_url = url_for('share_note', uuid=note.uuid, _external=True)
 
-        # Say 'someone' if the byline is empty.
-        who = note.byline or 'someone'
-
-        subject = f'saythanks.io: {who} sent a note!'
-        message = TEMPLATE.format(note.body, note.byline, note_url)
-        from_address = Email('no-reply@saythanks.io', name="SayThanks.io")
-        to_address = Email(email_address)
-        content = Content('text/html', message)
-
-        mail = Mail(from_address, subject, to_address, content)
+        mail = build_mail(note, email_address, note_url)
         response = sg.client.mail.send.post(request_body=mail.get())
     except URLError as e:
         logging.error("URL Error occurred "+ str(e))
@@ -89,3 +89,31 @@ def notify(note, email_address):
     except Exception as e:
         logging.error("General Error occurred: " + str(e))
         print(e)
+
+
+def build_mail(note, email_address, note_url):
+    """Build the sendgrid Mail for a note, linking to its public URL."""
+    # Say 'someone' if the byline is empty.
+    who = note.byline or 'someone'
+
+    subject = f'saythanks.io: {who} sent a note!'
+    message = TEMPLATE.format(note.body, note.byline, note_url)
+    from_address = Email('no-reply@saythanks.io', name="SayThanks.io")
+    to_address = Email(email_address)
+    content = Content('text/html', message)
+
+    return Mail(from_address, subject, to_address, content)
+
+
+async def notify_async(client, note, email_address, note_url):
+    """Like `notify`, but delivers through an async HTTP client (httpx)
+    so the event loop is free while SendGrid responds."""
+    try:
+        mail = build_mail(note, email_address, note_url)
+        response = await client.post(
+            SENDGRID_SEND_URL, json=mail.get(),
+            headers={'Authorization': f'Bearer {API_KEY}'})
+        response.raise_for_status()
+    except Exception as e:
+        logging.error("General Error occurred: " + str(e))
+        print(e)
@@ -0,0 +1,142 @@
+import os
+import logging
+from datetime import date
+
+import sqlalchemy
+
+from . import storage
+
+# Notes Partitions
+# ----------------
+# After migration 007, notes is partitioned LIST (archived) into
+# notes_active and notes_archived, split by RANGE ("timestamp") into
+# notes_active_YYYYMM and notes_archived_YYYY partitions. Each half has a
+# _default partition for rows outside every range; it should stay empty.
+#
+# `flask maintain-partitions` (run it daily, off-peak) creates the partitions
+# PARTITION_MONTHS_AHEAD months ahead, moving any rows that landed in a
+# default partition into them, and moves archived partitions older than
+# PARTITION_COLD_YEARS to PARTITION_COLD_TABLESPACE when one is set (e.g. on
+# cheaper or compressed storage). Partitions are created standalone and then
+# attached, which only takes a SHARE UPDATE EXCLUSIVE lock on the parent, so
+# notes can be stored meanwhile. Attaching does scan the parent's default
+# partition, under an ACCESS EXCLUSIVE lock, to check none of its rows
+# belong in the new one: quick while it is empty, as it stays when
+# partitions are created ahead of time.
+
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+PARTITION_COLD_YEARS = int(os.environ.get('PARTITION_COLD_YEARS', 1))
+PARTITION_COLD_TABLESPACE = os.environ.get('PARTITION_COLD_TABLESPACE') or None
+# DDL gives up rather than queue behind long transactions (and block others).
+PARTITION_LOCK_TIMEOUT = os.environ.get('PARTITION_LOCK_TIMEOUT', '5s')
+
+
+def is_partitioned():
+    q = sqlalchemy.text("""
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'public.notes'::regclass)
+    """)
+    return storage.conn.execute(q).scalar()
+
+
+def partitions(parent):
+    """Returns {name: tablespace or None} of `parent`'s partitions."""
+    q = sqlalchemy.text("""
+        SELECT c.relname, t.spcname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+        WHERE i.inhparent = CAST(:parent AS regclass)
+    """)
+    return {r['relname']: r['spcname'] for r in storage.conn.execute(q, parent=f'public.{parent}')}
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def create_partition(parent, name, start, end):
+    """Creates and attaches one partition of `parent` for [start, end),
+    first moving the rows of that range out of the default partition."""
+    with storage.conn.begin():
+        storage.conn.execute(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'")
+        storage.conn.execute(f'CREATE TABLE public.{name} (LIKE public.{parent} INCLUDING DEFAULTS)')
+        moved = storage.conn.execute(sqlalchemy.text(f"""
+            WITH moved AS (
+                DELETE FROM public.{parent}_default
+                WHERE "timestamp" >= :start AND "timestamp" < :end
+                RETURNING *
+            )
+            INSERT INTO public.{name} SELECT * FROM moved
+        """), start=start, end=end).rowcount
+        storage.conn.execute(
+            f"ALTER TABLE public.{parent} ATTACH PARTITION public.{name} FOR VALUES FROM ('{start}') TO ('{end}')")
+    if moved:
+        logging.error(f"Moved {moved} note(s) from {parent}_default into {name}")
+    return moved
+
+
+def create_upcoming(today=None):
+    """Creates the active partitions up to PARTITION_MONTHS_AHEAD months
+    ahead and the archived ones up to next year; returns their names."""
+    today = today or date.today()
+    wanted = []
+    for months in range(PARTITION_MONTHS_AHEAD + 1):
+        start = add_months(today, months)
+        wanted.append(('notes_active', f'notes_active_{start:%Y%m}', start, add_months(start, 1)))
+    for year in (today.year, today.year + 1):
+        wanted.append(('notes_archived', f'notes_archived_{year}', date(year, 1, 1), date(year + 1, 1, 1)))
+
+    existing = {**partitions('notes_active'), **partitions('notes_archived')}
+    created = []
+    for parent, name, start, end in wanted:
+        if name not in existing:
+            create_partition(parent, name, start, end)
+            created.append(name)
+    return created
+
+
+def move_cold(today=None):
+    """Moves archived partitions older than PARTITION_COLD_YEARS (and their
+    indexes) to PARTITION_COLD_TABLESPACE; returns their names.
+
+    Each move rewrites the partition under an exclusive lock, which only
+    blocks restoring (or archiving) notes of that year while it runs.
+    """
+    if not PARTITION_COLD_TABLESPACE:
+        return []
+    today = today or date.today()
+    moved = []
+    for name, tablespace in sorted(partitions('notes_archived').items()):
+        year = name.rsplit('_', 1)[-1]
+        if not year.isdigit() or int(year) >= today.year - PARTITION_COLD_YEARS:
+            continue
+        if tablespace == PARTITION_COLD_TABLESPACE:
+            continue
+        indexes = storage.conn.execute(sqlalchemy.text(
+            "SELECT indexrelid::regclass::text AS name FROM pg_index WHERE indrelid = CAST(:t AS regclass)"),
+            t=f'public.{name}').fetchall()
+        with storage.conn.begin():
+            storage.conn.execute(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'")
+            storage.conn.execute(f'ALTER TABLE public.{name} SET TABLESPACE {PARTITION_COLD_TABLESPACE}')
+            for index in indexes:
+                storage.conn.execute(f"ALTER INDEX {index['name']} SET TABLESPACE {PARTITION_COLD_TABLESPACE}")
+        moved.append(name)
+    return moved
+
+
+def detach_archived(before_year):
+    """Detaches the archived partitions of years before `before_year`.
+
+    Their notes disappear from the site but stay in the detached tables
+    (named as before) for dumping or dropping. Returns their names.
+    """
+    detached = []
+    for name in sorted(partitions('notes_archived')):
+        year = name.rsplit('_', 1)[-1]
+        if year.isdigit() and int(year) < before_year:
+            with storage.conn.begin():
+                storage.conn.execute(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}'")
+                storage.conn.execute(f'ALTER TABLE public.notes_archived DETACH PARTITION public.{name}')
+            detached.append(name)
+    return detached
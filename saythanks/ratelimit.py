@@ -0,0 +1,155 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, make_response
+
+from . import metrics
+
+# Token-bucket Rate Limiting
+# --------------------------
+# Limits are written as "<requests>/<seconds>", e.g. "5/60" allows a burst of
+# five requests which then refill at five per minute.
+
+
+def parse_limit(spec):
+    """Parses a "<requests>/<seconds>" string into (capacity, rate per second)."""
+    count, period = spec.split('/')
+    capacity = float(count)
+    return capacity, capacity / float(period)
+
+
+class MemoryStore:
+    """Buckets held in this process; fine for a single worker or for tests."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, cost=1):
+        """Takes `cost` tokens from the bucket at `key`.
+
+        Returns a tuple of (allowed, seconds until enough tokens are available).
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+            # Forget the least recently seen clients first.
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        if allowed:
+            return True, 0
+        return False, (cost - tokens) / rate
+
+
+class RedisStore:
+    """Buckets shared by every worker through a redis-protocol server."""
+
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local allowed = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url, prefix='saythanks:ratelimit:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def consume(self, key, capacity, rate, cost=1):
+        allowed, tokens = self.script(keys=[self.prefix + key], args=[capacity, rate, cost])
+        if int(allowed):
+            return True, 0
+        return False, (cost - float(tokens)) / rate
+
+
+def store_from_url(url):
+    """Returns a bucket store for `url`; an empty url means in-process buckets."""
+    if not url:
+        return MemoryStore()
+    return RedisStore(url)
+
+
+enabled = os.environ.get('RATELIMIT_ENABLED', '1') != '0'
+store = store_from_url(os.environ.get('RATELIMIT_STORAGE_URL'))
+per_ip = parse_limit(os.environ.get('RATELIMIT_PER_IP', '5/60'))
+per_inbox = parse_limit(os.environ.get('RATELIMIT_PER_INBOX', '60/60'))
+
+
+def client_ip():
+    """The originating client address: the one the nearest trusted proxy saw
+    (core applies ProxyFix), never one the client could put in a header."""
+    return request.remote_addr or 'unknown'
+
+
+def too_many_requests(retry_after):
+    response = make_response('Too many notes, please slow down.', 429)
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    return response
+
+
+def _consume(scope, key, limit):
+    try:
+        return store.consume(f'{scope}:{key}', *limit)
+    except Exception as e:
+        # Never turn a rate limiter outage into a site outage.
+        logging.error("Rate limiter unavailable: " + str(e))
+        metrics.incr('ratelimit_errors_total', scope=scope)
+        return True, 0
+
+
+def check_submission(ip, inbox_id):
+    """Spends a token from the client's and the inbox's buckets.
+
+    Returns None when the submission may proceed, otherwise the number of
+    seconds the client should wait.
+    """
+    if not enabled:
+        return None
+    for scope, key, limit in (('ip', ip, per_ip), ('inbox', inbox_id, per_inbox)):
+        allowed, retry_after = _consume(scope, key, limit)
+        if not allowed:
+            metrics.incr('ratelimit_rejected_total', scope=scope)
+            return retry_after
+    return None
+
+
+def limit_submissions(f):
+    """Rejects note submissions over the per-IP or per-inbox budget.
+
+    The check runs before the request form is parsed, so a rejected flood
+    costs neither markdown/lxml work nor a database round trip.
+    """
+    @wraps(f)
+    def decorated(inbox_id, *args, **kwargs):
+        retry_after = check_submission(client_ip(), inbox_id)
+        if retry_after is not None:
+            return too_many_requests(retry_after)
+        return f(inbox_id, *args, **kwargs)
+
+    return decorated
@@ -0,0 +1,143 @@
+import os
+import secrets
+from datetime import datetime, timedelta, timezone
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from . import storage
+from .cache import cache
+
+# Server-side Sessions
+# --------------------
+# The session cookie only carries an opaque, random session id. The session
+# dict (slug, email, search string...) is stored server-side with a TTL, and
+# the full Auth0 profile is stored next to it but only loaded by the routes
+# that render it.
+#
+# SESSION_BACKEND is 'database' (the default) or 'cache'; only use 'cache'
+# with a CACHE_URL that every worker shares.
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 30 * 24 * 3600))
+
+serializer = TaggedJSONSerializer()
+
+
+class DatabaseStore:
+    def load(self, sid):
+        data = storage.Session.load(sid)
+        return serializer.loads(data) if data else None
+
+    def save(self, sid, data):
+        storage.Session.save(sid, serializer.dumps(data), SESSION_TTL)
+
+    def load_profile(self, sid):
+        profile = storage.Session.load_profile(sid)
+        return serializer.loads(profile) if profile else None
+
+    def save_profile(self, sid, profile):
+        storage.Session.save_profile(sid, serializer.dumps(profile), SESSION_TTL)
+
+    def delete(self, sid):
+        storage.Session.delete(sid)
+
+
+class CacheStore:
+    def __init__(self, cache):
+        self.cache = cache
+
+    def load(self, sid):
+        return self.cache.get(sid)
+
+    def save(self, sid, data):
+        self.cache.set(sid, data, SESSION_TTL)
+
+    def load_profile(self, sid):
+        return self.cache.get('profile:' + sid)
+
+    def save_profile(self, sid, profile):
+        self.cache.set('profile:' + sid, profile, SESSION_TTL)
+
+    def delete(self, sid):
+        self.cache.delete(sid)
+        self.cache.delete('profile:' + sid)
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """A session whose contents live server-side, under `sid`."""
+
+    def __init__(self, store, sid, initial=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.store = store
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.stale_sid = None
+        self._profile = None
+
+    @property
+    def profile(self):
+        """The user's Auth0 profile, loaded on first use."""
+        if self._profile is None and not self.new:
+            self._profile = self.store.load_profile(self.sid)
+        return self._profile
+
+    @profile.setter
+    def profile(self, profile):
+        self._profile = profile
+        self.store.save_profile(self.sid, profile)
+
+    def rotate(self):
+        """Moves the session to a fresh id, e.g. on login."""
+        self.stale_sid = self.stale_sid or self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(self.store, sid, data)
+        return ServerSession(self.store, secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.stale_sid:
+            self.store.delete(session.stale_sid)
+        if not session:
+            # Emptied (e.g. on logout): forget it on both sides.
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+
+        self.store.save(session.sid, dict(session))
+        response.set_cookie(
+            name, session.sid,
+            expires=datetime.now(timezone.utc) + timedelta(seconds=SESSION_TTL),
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=app.config.get('SESSION_COOKIE_SAMESITE'),
+            domain=domain, path=path)
+
+
+if os.environ.get('SESSION_BACKEND', 'database') == 'cache':
+    session_store = CacheStore(cache.namespace('session'))
+else:
+    session_store = DatabaseStore()
@@ -0,0 +1,244 @@
+import os
+import re
+import gzip
+import queue
+import logging
+import tempfile
+import threading
+from wsgiref.util import FileWrapper
+
+from flask import render_template
+
+from .core import app, share_body
+from . import storage
+from .compression import negotiate
+from .utils import note_text
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static Share-page Snapshots
+# ---------------------------
+# Share pages never change once a note is written, so with SNAPSHOT_DIR set
+# each stored note's page is rendered once, precompressed, and written to
+#
+#   $SNAPSHOT_DIR/note/<uuid>       (+ .gz, and .br when brotli is installed)
+#
+# A front proxy can serve these directly (as text/html); otherwise the
+# middleware below serves them ahead of Flask. Archiving a note removes its
+# snapshot and restoring it publishes it again; the dynamic /note/<uuid>
+# route remains the fallback. Regenerate everything after template changes
+# with `flask rebuild-snapshots`.
+#
+# Stored and restored notes are published by a background thread of the
+# worker, not in the request (a bulk submission can store thousands), and
+# compressed at SNAPSHOT_BROTLI_QUALITY; rebuild-snapshots compresses
+# harder. Notes still queued when a worker exits are only picked up by the
+# next rebuild-snapshots, and meanwhile served by the dynamic route.
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR')
+# Absolute URLs in share pages (tweet and share links) are built on this.
+SNAPSHOT_BASE_URL = os.environ.get('SNAPSHOT_BASE_URL', 'https://saythanks.io/')
+
+# Brotli quality (0-11) of snapshots published as notes arrive.
+SNAPSHOT_BROTLI_QUALITY = int(os.environ.get('SNAPSHOT_BROTLI_QUALITY', 4))
+# Notes waiting to be published, per worker; beyond this they're skipped.
+SNAPSHOT_QUEUE_SIZE = int(os.environ.get('SNAPSHOT_QUEUE_SIZE', 100000))
+
+UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'), (None, ''))
+
+
+def path_for(uuid):
+    return os.path.join(SNAPSHOT_DIR, 'note', str(uuid))
+
+
+def render(note):
+    """Renders the share page of `note` as the dynamic route would."""
+    path = f'/note/{note.uuid}'
+    with app.test_request_context(path, base_url=SNAPSHOT_BASE_URL):
+        return render_template('share_note.htm.j2', note=note, note_body=share_body(note.body),
+                               note_text=note.body_text or note_text(note.body))
+
+
+def _write(path, data):
+    # Write then rename, so a reader never sees a half-written file.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def publish(note, gzip_level=6, brotli_quality=SNAPSHOT_BROTLI_QUALITY):
+    """Writes the (precompressed) snapshot of a note's share page."""
+    html = render(note).encode('utf-8')
+    path = path_for(note.uuid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Compressed variants first: the plain file marks the snapshot as live.
+    _write(path + '.gz', gzip.compress(html, gzip_level))
+    if brotli is not None:
+        _write(path + '.br', brotli.compress(html, quality=brotli_quality))
+    _write(path, html)
+
+
+def unpublish(uuid):
+    """Removes a note's snapshot, leaving the dynamic route to answer."""
+    for _, suffix in reversed(ENCODINGS):
+        try:
+            os.remove(path_for(uuid) + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def rebuild():
+    """Re-renders every active note and drops snapshots of any other note.
+
+    Returns the number of snapshots written.
+    """
+    published = set()
+    for note in storage.Note.iter_active():
+        publish(note, gzip_level=9, brotli_quality=11)
+        published.add(str(note.uuid))
+    directory = os.path.join(SNAPSHOT_DIR, 'note')
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        uuid = name.split('.')[0]
+        if UUID_RE.match(uuid) and uuid not in published:
+            unpublish(uuid)
+    return len(published)
+
+
+def publish_missing(auth_id):
+    """Publishes the inbox's active notes that have no snapshot yet;
+    returns how many."""
+    published = 0
+    for note in storage.Note.iter_active(auth_id=auth_id):
+        if not os.path.exists(path_for(note.uuid)):
+            publish(note)
+            published += 1
+    return published
+
+
+class Publisher:
+    """Publishes the snapshots of queued note uuids on a thread of its own,
+    a batch at a time, reading each note afresh (so one archived meanwhile
+    is skipped). The thread starts with the first note queued, i.e. in the
+    worker rather than in a master process that forks it."""
+
+    def __init__(self, maxsize=SNAPSHOT_QUEUE_SIZE, batch_size=500):
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def enqueue(self, uuids):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        for uuid in uuids:
+            try:
+                self.queue.put_nowait(str(uuid))
+            except queue.Full:
+                logging.error("Snapshot queue full; run `flask rebuild-snapshots`.")
+                return
+
+    def run(self):
+        # The notes were only just written: read them from the primary.
+        storage.pin_until(float('inf'))
+        while True:
+            uuids = [self.queue.get()]
+            while len(uuids) < self.batch_size:
+                try:
+                    uuids.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for note in storage.Note.iter_active(uuids):
+                    publish(note)
+            except Exception as e:
+                logging.error("Snapshots not published: " + str(e))
+            finally:
+                # Don't sit idle in a transaction between batches.
+                storage.conn.close()
+                for _ in uuids:
+                    self.queue.task_done()
+
+    def join(self):
+        """Waits until every queued note has been published."""
+        self.queue.join()
+
+
+publisher = Publisher()
+
+
+def on_note_stored(note):
+    publisher.enqueue([note.uuid])
+
+
+def on_notes_archived(auth_id, uuids, archived):
+    if not archived:
+        publisher.enqueue(uuids)
+        return
+    try:
+        for uuid in uuids:
+            unpublish(uuid)
+    except OSError as e:
+        logging.error("Snapshots not updated: " + str(e))
+
+
+def on_notes_imported(auth_id):
+    # Imports already run off the request path (see imports.py).
+    try:
+        publish_missing(auth_id)
+    except OSError as e:
+        logging.error("Snapshots not published: " + str(e))
+
+
+class SnapshotMiddleware:
+    """Serves published share pages straight from disk, ahead of Flask."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        method = environ.get('REQUEST_METHOD')
+        if method in ('GET', 'HEAD') and path.startswith('/note/') and UUID_RE.match(path[6:]):
+            response = self.serve(path[6:], environ, start_response)
+            if response is not None:
+                return response
+        return self.app(environ, start_response)
+
+    def serve(self, uuid, environ, start_response):
+        path = path_for(uuid)
+        if not os.path.exists(path):
+            return None
+        accepted = negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        for encoding, suffix in ENCODINGS:
+            if encoding and encoding != accepted:
+                continue
+            try:
+                f = open(path + suffix, 'rb')
+            except FileNotFoundError:
+                continue
+            headers = [('Content-Type', 'text/html; charset=utf-8'),
+                       ('Content-Length', str(os.fstat(f.fileno()).st_size)),
+                       ('Vary', 'Accept-Encoding'),
+                       ('Cache-Control', 'public, max-age=300')]
+            if encoding:
+                headers.append(('Content-Encoding', encoding))
+            start_response('200 OK', headers)
+            if environ['REQUEST_METHOD'] == 'HEAD':
+                f.close()
+                return []
+            return environ.get('wsgi.file_wrapper', FileWrapper)(f)
+        return None
+
+
+if SNAPSHOT_DIR:
+    storage.note_stored.connect(on_note_stored)
+    storage.notes_archived.connect(on_notes_archived)
+    storage.notes_imported.connect(on_notes_imported)
+    app.wsgi_app = SnapshotMiddleware(app.wsgi_app)
@@ -0,0 +1,19 @@
+--
+-- Maintained per-inbox note counters, so pagination does not COUNT(*) the
+-- inbox on every page view. Kept up to date by storage.py; repair drift
+-- with `flask reconcile-counts`.
+--
+
+ALTER TABLE public.inboxes ADD COLUMN IF NOT EXISTS notes_active integer DEFAULT 0 NOT NULL;
+ALTER TABLE public.inboxes ADD COLUMN IF NOT EXISTS notes_archived integer DEFAULT 0 NOT NULL;
+
+UPDATE public.inboxes
+SET notes_active = c.active, notes_archived = c.archived
+FROM (
+    SELECT inboxes_auth_id,
+        COUNT(*) FILTER (WHERE NOT archived) AS active,
+        COUNT(*) FILTER (WHERE archived) AS archived
+    FROM public.notes
+    GROUP BY inboxes_auth_id
+) c
+WHERE inboxes.auth_id = c.inboxes_auth_id;
@@ -0,0 +1,14 @@
+--
+-- Server-side sessions: the cookie only carries the opaque sid. The small
+-- session dict and the (larger, lazily loaded) Auth0 profile are kept apart.
+-- Expired rows are removed by `flask purge-sessions`.
+--
+
+CREATE TABLE IF NOT EXISTS public.sessions (
+    sid text NOT NULL PRIMARY KEY,
+    data text NOT NULL,
+    profile text,
+    expires timestamp with time zone NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS sessions_expires_idx ON public.sessions (expires);
@@ -0,0 +1,8 @@
+--
+-- Plain-text and preview forms of each note body, computed once when the
+-- note is stored. Existing rows are filled in by `flask backfill-note-text`,
+-- which runs in small batches against a live database.
+--
+
+ALTER TABLE public.notes ADD COLUMN IF NOT EXISTS body_text text;
+ALTER TABLE public.notes ADD COLUMN IF NOT EXISTS preview text;
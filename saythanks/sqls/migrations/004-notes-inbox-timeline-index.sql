@@ -0,0 +1,12 @@
+--
+-- Lets inbox listings, including the keyset pages of the JSON API
+-- ((timestamp, uuid) < (...)), walk an inbox's notes newest first instead
+-- of sorting all of them. Built concurrently, so notes keep arriving
+-- meanwhile.
+--
+-- migrate:no-transaction
+--
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_inbox_timeline_idx
+    ON public.notes (inboxes_auth_id, "timestamp" DESC, uuid DESC)
+    WHERE archived = 'f';
@@ -0,0 +1,37 @@
+--
+-- A change sequence on notes for delta sync (/api/v1/inbox/changes): every
+-- insert takes the next value by default, and archiving or restoring a note
+-- takes a new one. change_txid is the id of the transaction that made the
+-- change (txid_current()): sync only hands out changes of transactions
+-- older than every one still running, so a change that commits after a
+-- later-numbered one is never skipped.
+--
+-- Existing notes are numbered in batches (as change_txid 0, before any
+-- new change), and the indexes are built concurrently, so notes keep
+-- arriving meanwhile.
+--
+-- migrate:no-transaction
+--
+
+CREATE SEQUENCE IF NOT EXISTS public.notes_change_seq;
+
+ALTER TABLE public.notes ADD COLUMN IF NOT EXISTS change_seq bigint;
+ALTER TABLE public.notes ADD COLUMN IF NOT EXISTS change_txid bigint;
+
+-- Set apart from ADD COLUMN, so existing rows aren't all rewritten at once.
+ALTER TABLE public.notes ALTER COLUMN change_seq SET DEFAULT nextval('public.notes_change_seq');
+ALTER TABLE public.notes ALTER COLUMN change_txid SET DEFAULT txid_current();
+
+-- Finds the notes still to number without rescanning the numbered ones.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_change_seq_backfill_idx
+    ON public.notes (uuid) WHERE change_seq IS NULL;
+
+-- migrate:batch 5000
+UPDATE public.notes
+SET change_seq = nextval('public.notes_change_seq'), change_txid = 0
+WHERE uuid IN (SELECT uuid FROM public.notes WHERE change_seq IS NULL LIMIT :batch_size);
+
+DROP INDEX CONCURRENTLY IF EXISTS public.notes_change_seq_backfill_idx;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_inbox_change_idx
+    ON public.notes (inboxes_auth_id, change_txid, change_seq);
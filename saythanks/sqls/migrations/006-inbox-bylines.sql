@@ -0,0 +1,58 @@
+--
+-- A per-inbox facet of who said thanks: one row per distinct normalized
+-- byline (trimmed, whitespace collapsed, lower-cased), with the number of
+-- active notes signed with it. Kept up to date by storage.py alongside the
+-- note counters; autocomplete (/api/v1/inbox/bylines) prefix-matches it
+-- through a text_pattern_ops index, and the inbox's "filter by byline" mode
+-- reads the notes through an index on the same normalized expression.
+--
+-- The notes index is built concurrently and the facet filled in batches
+-- of inboxes, so notes keep arriving meanwhile.
+--
+-- migrate:no-transaction
+--
+
+CREATE TABLE IF NOT EXISTS public.inbox_bylines (
+    inboxes_auth_id text NOT NULL REFERENCES public.inboxes (auth_id),
+    byline text NOT NULL,
+    display text NOT NULL,
+    notes integer DEFAULT 0 NOT NULL,
+    PRIMARY KEY (inboxes_auth_id, byline)
+);
+
+CREATE INDEX IF NOT EXISTS inbox_bylines_prefix_idx
+    ON public.inbox_bylines (inboxes_auth_id, byline text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_inbox_byline_idx
+    ON public.notes (inboxes_auth_id, (lower(regexp_replace(btrim(byline), '\s+', ' ', 'g'))), "timestamp" DESC)
+    WHERE archived = 'f';
+
+-- The last inbox counted.
+CREATE TABLE IF NOT EXISTS public.inbox_bylines_backfill (last_auth_id text NOT NULL);
+INSERT INTO public.inbox_bylines_backfill
+SELECT '' WHERE NOT EXISTS (SELECT 1 FROM public.inbox_bylines_backfill);
+
+-- migrate:batch 500
+WITH progress AS (
+    SELECT last_auth_id FROM public.inbox_bylines_backfill FOR UPDATE
+), batch AS (
+    SELECT i.auth_id FROM public.inboxes i, progress
+    WHERE i.auth_id > progress.last_auth_id
+    ORDER BY i.auth_id
+    LIMIT :batch_size
+), counted AS (
+    INSERT INTO public.inbox_bylines (inboxes_auth_id, byline, display, notes)
+    SELECT inboxes_auth_id, lower(regexp_replace(btrim(byline), '\s+', ' ', 'g')),
+        max(regexp_replace(btrim(byline), '\s+', ' ', 'g')), COUNT(*)
+    FROM public.notes
+    WHERE inboxes_auth_id IN (SELECT auth_id FROM batch) AND archived = 'f' AND btrim(byline) <> ''
+    GROUP BY 1, 2
+    ON CONFLICT (inboxes_auth_id, byline) DO UPDATE SET notes = EXCLUDED.notes
+), advanced AS (
+    UPDATE public.inbox_bylines_backfill
+    SET last_auth_id = (SELECT max(auth_id) FROM batch)
+    WHERE EXISTS (SELECT 1 FROM batch)
+)
+SELECT auth_id FROM batch;
+
+DROP TABLE IF EXISTS public.inbox_bylines_backfill;
@@ -0,0 +1,192 @@
+--
+-- Rebuilds notes as a partitioned table: LIST (archived) into notes_active
+-- and notes_archived, each split by RANGE ("timestamp") into monthly and
+-- yearly partitions respectively, plus a default partition each. Archiving
+-- or restoring a note moves it between the two, so listings (which all
+-- filter archived = 'f') only touch active, recent partitions. Keep
+-- partitions ahead of time with `flask maintain-partitions`; see
+-- saythanks/partitions.py.
+--
+-- It runs online: the partitioned table is built alongside as
+-- notes_partitioned, a trigger on notes mirrors every change into it, and
+-- the existing notes are copied over in batches (each its own short
+-- transaction, in uuid order, resuming where it left off if interrupted).
+-- Only the final swap locks notes, briefly, to rename the tables. The old
+-- table is kept as notes_unpartitioned; drop it once satisfied.
+--
+-- uuid alone can no longer be the primary key (it must include the
+-- partition columns), so the database no longer enforces its uniqueness.
+-- Notes get gen_random_uuid() by default; the only path that supplies its
+-- own uuids, imports.py, skips those already present and merges one import
+-- at a time under an advisory lock.
+--
+-- migrate:no-transaction
+--
+
+DO $$
+DECLARE
+    oldest date;
+    starts date;
+    yr int;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'public.notes'::regclass)
+            OR to_regclass('public.notes_partitioned') IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    CREATE TABLE public.notes_partitioned (LIKE public.notes INCLUDING DEFAULTS)
+        PARTITION BY LIST (archived);
+    ALTER TABLE public.notes_partitioned ALTER COLUMN "timestamp" SET NOT NULL;
+
+    CREATE TABLE public.notes_active PARTITION OF public.notes_partitioned
+        FOR VALUES IN (false) PARTITION BY RANGE ("timestamp");
+    CREATE TABLE public.notes_archived PARTITION OF public.notes_partitioned
+        FOR VALUES IN (true) PARTITION BY RANGE ("timestamp");
+    CREATE TABLE public.notes_active_default PARTITION OF public.notes_active DEFAULT;
+    CREATE TABLE public.notes_archived_default PARTITION OF public.notes_archived DEFAULT;
+
+    -- Monthly active partitions from the oldest note to three months ahead,
+    -- yearly archived ones to next year (as partitions.py names them).
+    oldest := date_trunc('month', COALESCE((SELECT min("timestamp") FROM public.notes), now()))::date;
+    starts := oldest;
+    WHILE starts <= date_trunc('month', now()) + interval '3 months' LOOP
+        EXECUTE format('CREATE TABLE public.%I PARTITION OF public.notes_active FOR VALUES FROM (%L) TO (%L)',
+                       'notes_active_' || to_char(starts, 'YYYYMM'), starts, (starts + interval '1 month')::date);
+        starts := (starts + interval '1 month')::date;
+    END LOOP;
+    FOR yr IN extract(year FROM oldest)::int .. extract(year FROM now())::int + 1 LOOP
+        EXECUTE format('CREATE TABLE public.%I PARTITION OF public.notes_archived FOR VALUES FROM (%L) TO (%L)',
+                       'notes_archived_' || yr, make_date(yr, 1, 1), make_date(yr + 1, 1, 1));
+    END LOOP;
+
+    -- Built while the table is empty; renamed at the swap, as the old
+    -- table's hold the final names until then. Migrations 004-006, on
+    -- every partition.
+    ALTER TABLE public.notes_partitioned ADD CONSTRAINT notes_partitioned_pk
+        PRIMARY KEY (uuid, archived, "timestamp");
+    ALTER TABLE public.notes_partitioned ADD CONSTRAINT notes_partitioned_inboxes
+        FOREIGN KEY (inboxes_auth_id) REFERENCES public.inboxes (auth_id);
+    CREATE INDEX notes_partitioned_timeline_idx
+        ON public.notes_partitioned (inboxes_auth_id, "timestamp" DESC, uuid DESC)
+        WHERE archived = 'f';
+    CREATE INDEX notes_partitioned_change_idx
+        ON public.notes_partitioned (inboxes_auth_id, change_txid, change_seq);
+    CREATE INDEX notes_partitioned_byline_idx
+        ON public.notes_partitioned (inboxes_auth_id, (lower(regexp_replace(btrim(byline), '\s+', ' ', 'g'))), "timestamp" DESC)
+        WHERE archived = 'f';
+
+    -- The last uuid copied.
+    CREATE TABLE public.notes_partitioning_progress (last_uuid uuid NOT NULL);
+    INSERT INTO public.notes_partitioning_progress VALUES ('00000000-0000-0000-0000-000000000000');
+END
+$$;
+
+-- Mirrors each change to notes into notes_partitioned. A note without a
+-- timestamp gets one on the way (the partitioned table needs it), in notes
+-- too, so the copy and the trigger always agree on it.
+CREATE OR REPLACE FUNCTION public.notes_partitioning_sync() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM public.notes_partitioned WHERE uuid = OLD.uuid;
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        RETURN OLD;
+    END IF;
+    NEW."timestamp" := COALESCE(NEW."timestamp", now());
+    INSERT INTO public.notes_partitioned (uuid, inboxes_auth_id, body, byline, archived, "timestamp",
+                                          body_text, preview, change_seq, change_txid)
+    VALUES (NEW.uuid, NEW.inboxes_auth_id, NEW.body, NEW.byline, NEW.archived, NEW."timestamp",
+            NEW.body_text, NEW.preview, NEW.change_seq, NEW.change_txid)
+    ON CONFLICT DO NOTHING;
+    RETURN NEW;
+END
+$$;
+
+DO $$
+BEGIN
+    IF to_regclass('public.notes_partitioned') IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM pg_trigger
+        WHERE tgrelid = 'public.notes'::regclass AND tgname = 'notes_partitioning_sync'
+    ) THEN
+        CREATE TRIGGER notes_partitioning_sync BEFORE INSERT OR UPDATE OR DELETE ON public.notes
+            FOR EACH ROW EXECUTE FUNCTION public.notes_partitioning_sync();
+    END IF;
+END
+$$;
+
+-- Copies the next `batch_size` notes after the last one copied; returns
+-- their uuids. The rows are locked while copied, so a concurrent archive
+-- or restore either waits for the batch (and then moves the copy) or is
+-- copied as it stands.
+CREATE OR REPLACE FUNCTION public.notes_partitioning_copy(batch_size integer) RETURNS SETOF uuid
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF to_regclass('public.notes_partitioning_progress') IS NULL THEN
+        RETURN;
+    END IF;
+    RETURN QUERY
+    WITH progress AS (
+        SELECT last_uuid FROM public.notes_partitioning_progress FOR UPDATE
+    ), batch AS (
+        SELECT n.* FROM public.notes n, progress
+        WHERE n.uuid > progress.last_uuid
+        ORDER BY n.uuid
+        LIMIT batch_size
+        FOR UPDATE OF n
+    ), copied AS (
+        INSERT INTO public.notes_partitioned (uuid, inboxes_auth_id, body, byline, archived, "timestamp",
+                                              body_text, preview, change_seq, change_txid)
+        SELECT uuid, inboxes_auth_id, body, byline, archived, COALESCE("timestamp", now()),
+            body_text, preview, change_seq, change_txid
+        FROM batch
+        ON CONFLICT DO NOTHING
+    ), advanced AS (
+        UPDATE public.notes_partitioning_progress
+        SET last_uuid = (SELECT b.uuid FROM batch b ORDER BY b.uuid DESC LIMIT 1)
+        WHERE EXISTS (SELECT 1 FROM batch)
+    )
+    SELECT b.uuid FROM batch b;
+END
+$$;
+
+-- migrate:batch 5000
+SELECT * FROM public.notes_partitioning_copy(:batch_size);
+
+-- The swap. Every note is copied by now, and every change since the
+-- trigger was created mirrored.
+DO $$
+BEGIN
+    IF to_regclass('public.notes_partitioned') IS NULL THEN
+        RETURN;
+    END IF;
+    LOCK TABLE public.notes IN ACCESS EXCLUSIVE MODE;
+    IF EXISTS (
+        SELECT 1 FROM public.notes n
+        WHERE n.uuid > (SELECT last_uuid FROM public.notes_partitioning_progress)
+        AND NOT EXISTS (SELECT 1 FROM public.notes_partitioned p WHERE p.uuid = n.uuid)
+    ) THEN
+        RAISE EXCEPTION 'notes_partitioned is missing notes; run the migration again';
+    END IF;
+
+    DROP TRIGGER notes_partitioning_sync ON public.notes;
+    ALTER TABLE public.notes RENAME CONSTRAINT notes_pk TO notes_unpartitioned_pk;
+    ALTER TABLE public.notes RENAME CONSTRAINT notes_inboxes TO notes_unpartitioned_inboxes;
+    ALTER INDEX public.notes_inbox_timeline_idx RENAME TO notes_unpartitioned_timeline_idx;
+    ALTER INDEX public.notes_inbox_change_idx RENAME TO notes_unpartitioned_change_idx;
+    ALTER INDEX public.notes_inbox_byline_idx RENAME TO notes_unpartitioned_byline_idx;
+    ALTER TABLE public.notes RENAME TO notes_unpartitioned;
+
+    ALTER TABLE public.notes_partitioned RENAME TO notes;
+    ALTER TABLE public.notes RENAME CONSTRAINT notes_partitioned_pk TO notes_pk;
+    ALTER TABLE public.notes RENAME CONSTRAINT notes_partitioned_inboxes TO notes_inboxes;
+    ALTER INDEX public.notes_partitioned_timeline_idx RENAME TO notes_inbox_timeline_idx;
+    ALTER INDEX public.notes_partitioned_change_idx RENAME TO notes_inbox_change_idx;
+    ALTER INDEX public.notes_partitioned_byline_idx RENAME TO notes_inbox_byline_idx;
+
+    DROP TABLE public.notes_partitioning_progress;
+END
+$$;
+
+DROP FUNCTION IF EXISTS public.notes_partitioning_copy(integer);
+DROP FUNCTION IF EXISTS public.notes_partitioning_sync();
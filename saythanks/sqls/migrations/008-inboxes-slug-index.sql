@@ -0,0 +1,9 @@
+--
+-- Every Inbox lookup filters inboxes on slug, but only auth_id (the primary
+-- key) was indexed. Built concurrently, so signing in and submitting notes
+-- carry on meanwhile. Not UNIQUE: older rows may share a slug.
+--
+-- migrate:no-transaction
+--
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS inboxes_slug_idx ON public.inboxes (slug);
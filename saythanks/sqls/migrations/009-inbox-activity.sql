@@ -0,0 +1,30 @@
+--
+-- Daily rollups behind the inbox stats (/inbox/stats, /api/v1/inbox/stats),
+-- so they never scan notes: inbox_activity counts the notes received per
+-- inbox, day and hour (and how many of those are now archived), and
+-- inbox_byline_activity the notes received per inbox, day and normalized
+-- byline (see migration 006). Days and hours are in the database's time
+-- zone, like notes."timestamp".
+--
+-- storage.py keeps them up to date as notes are stored, imported, archived
+-- and restored. Fill in the history with `flask backfill-activity` after
+-- applying this; it is safe to run while notes arrive.
+--
+
+CREATE TABLE IF NOT EXISTS public.inbox_activity (
+    inboxes_auth_id text NOT NULL REFERENCES public.inboxes (auth_id),
+    day date NOT NULL,
+    hour smallint NOT NULL,
+    notes integer DEFAULT 0 NOT NULL,
+    archived integer DEFAULT 0 NOT NULL,
+    PRIMARY KEY (inboxes_auth_id, day, hour)
+);
+
+CREATE TABLE IF NOT EXISTS public.inbox_byline_activity (
+    inboxes_auth_id text NOT NULL REFERENCES public.inboxes (auth_id),
+    day date NOT NULL,
+    byline text NOT NULL,
+    display text NOT NULL,
+    notes integer DEFAULT 0 NOT NULL,
+    PRIMARY KEY (inboxes_auth_id, day, byline)
+);
@@ -1,11 +1,23 @@
+import hashlib
+import itertools
 import logging
 import os
+import secrets
+import threading
+import time
+from datetime import date, timedelta
 
 import tablib
 import sqlalchemy
+from blinker import signal
 from auth0.v2.management import Auth0
 
+from . import counts
+from . import metrics
 from . import myemail
+from .cache import cache, LocalBackend
+from .counts import BYLINE_KEY
+from .utils import note_text, note_preview, note_event, NOTES_CHANNEL
 import traceback  # Just to show the full traceback
 from psycopg2 import errors
 
@@ -28,15 +40,309 @@ auth0_domain = os.environ['AUTH0_DOMAIN']
 auth0_token = os.environ['AUTH0_JWT_V2_TOKEN']
 auth0 = Auth0(auth0_domain, auth0_token)
 
+
+class ThreadConnection:
+    """Stands in for a Connection, giving each thread one of its own so
+    threaded workers never share a connection (or its transaction)."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = self.engine.connect()
+        return getattr(connection, name)
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
 # Database connection.
 engine = sqlalchemy.create_engine(os.environ['DATABASE_URL'])
-conn = engine.connect()
+conn = ThreadConnection(engine)
+
+
+def disconnect():
+    """Closes every database connection, e.g. in a master process before it
+    forks workers: a socket shared between processes corrupts both sides."""
+    conn.close()
+    engine.dispose()
+    for replica in replicas:
+        replica.disconnect()
+
+
+def reconnect():
+    """Starts this process's own connections afresh (after a fork)."""
+    global conn
+    conn = ThreadConnection(engine)
+    for replica in replicas:
+        replica.conn = ThreadConnection(replica.engine)
+
+
+# Read replicas (optional): a comma-separated list of database URLs.
+REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# Replicas further behind the primary than this are skipped.
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+# How often each replica's health and lag are re-checked.
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+# After a write, the session reads from the primary for this long.
+REPLICA_PIN_SECONDS = float(os.environ.get('REPLICA_PIN_SECONDS', 15))
+
+
+class Replica:
+    """A read-only standby, with its health and lag checked periodically."""
+
+    LAG_QUERY = sqlalchemy.text(
+        "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) AS lag")
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+        self.engine = sqlalchemy.create_engine(url)
+        self.conn = ThreadConnection(self.engine)
+        self.healthy = False
+        self.checked = 0
+
+    def check(self):
+        """Refreshes the replica's lag and health when the last check is stale."""
+        now = time.monotonic()
+        if now - self.checked < REPLICA_CHECK_INTERVAL:
+            return self.healthy
+        self.checked = now
+        try:
+            lag = float(self.conn.execute(self.LAG_QUERY).scalar())
+            metrics.set_gauge('db_replica_lag_seconds', lag, replica=self.name)
+            self.healthy = lag <= REPLICA_MAX_LAG
+        except sqlalchemy.exc.DBAPIError as e:
+            self.mark_down(e)
+        metrics.set_gauge('db_replica_healthy', int(self.healthy), replica=self.name)
+        return self.healthy
+
+    def disconnect(self):
+        self.conn.close()
+        self.engine.dispose()
+        self.checked = 0
+
+    def mark_down(self, error):
+        logging.error(f"Replica {self.name} unavailable: {error}")
+        self.healthy = False
+        self.checked = time.monotonic()
+        metrics.set_gauge('db_replica_healthy', 0, replica=self.name)
+
+
+replicas = [Replica(str(i), url) for i, url in enumerate(REPLICA_URLS)]
+_replica_turn = itertools.count()
+_local = threading.local()
+
+
+def pinned_until():
+    """The wall-clock time until which reads must go to the primary."""
+    return getattr(_local, 'pinned_until', 0)
+
+
+def pin_until(timestamp):
+    """Restores a pin carried over from an earlier request (e.g. in the session)."""
+    _local.pinned_until = timestamp
+
+
+def read(q, **params):
+    """Runs a read-only query on a healthy replica, falling back to the primary.
+
+    Reads stay on the primary for a while after this thread wrote, so users
+    always see their own changes.
+    """
+    if replicas and pinned_until() < time.time():
+        start = next(_replica_turn)
+        for i in range(len(replicas)):
+            replica = replicas[(start + i) % len(replicas)]
+            if not replica.check():
+                continue
+            try:
+                return replica.conn.execute(q, **params)
+            except sqlalchemy.exc.DBAPIError as e:
+                replica.mark_down(e)
+    return conn.execute(q, **params)
+
+
+def read_url():
+    """The URL of a healthy replica, for a read-only connection of its own
+    (e.g. a long COPY), falling back to the primary's as read() does."""
+    if replicas and pinned_until() < time.time():
+        start = next(_replica_turn)
+        for i in range(len(replicas)):
+            replica = replicas[(start + i) % len(replicas)]
+            if replica.check():
+                return replica.url
+    return os.environ['DATABASE_URL']
+
+
+def write(q, **params):
+    """Runs a query on the primary, and pins following reads to it."""
+    pin_until(time.time() + REPLICA_PIN_SECONDS)
+    return conn.execute(q, **params)
+
+
+# Signals
+# -------
+# Sent once the change is committed:
+#   note_stored(note) for every stored note;
+#   notes_archived(auth_id, uuids=[...], archived=True/False) for every
+#   batch of notes archived (or restored, with archived=False);
+#   notes_imported(auth_id) once an import (imports.py) has added notes.
+note_stored = signal('note-stored')
+notes_archived = signal('notes-archived')
+notes_imported = signal('notes-imported')
+
+
+def count_notes(auth_id, active=0, archived=0):
+    """Adjusts an inbox's maintained note counters. Call it inside the
+    transaction that stored or (un)archived the notes."""
+    write(sqlalchemy.text(counts.COUNT_NOTES), auth_id=auth_id, active=active, archived=archived)
+
+
+def count_archived(auth_id, changed, archived=True):
+    """Moves `changed` notes between the active and archived counters."""
+    if changed:
+        sign = 1 if archived else -1
+        count_notes(auth_id, active=-sign * changed, archived=sign * changed)
+
+
+def count_bylines(auth_id, bylines, delta=1):
+    """Adds `delta` per entry of `bylines` to the inbox's byline facet (a
+    negative one for notes archived). Call it inside the transaction that
+    stored or (un)archived the notes."""
+    bylines = [byline for byline in bylines if byline and byline.strip()]
+    if not bylines:
+        return
+    q = sqlalchemy.text(counts.ADD_BYLINES if delta > 0 else counts.REMOVE_BYLINES)
+    write(q, auth_id=auth_id, bylines=bylines, delta=delta)
+
+
+def count_activity(auth_id, notes):
+    """Adds stored notes, as (timestamp, byline) pairs, to the inbox's
+    activity rollups (migration 009). Call it inside the storing
+    transaction."""
+    if not notes:
+        return
+    timestamps, bylines = zip(*notes)
+    write(sqlalchemy.text(counts.COUNT_ACTIVITY), auth_id=auth_id,
+          timestamps=list(timestamps), bylines=list(bylines))
+
+
+def count_archived_activity(auth_id, timestamps, archived=True):
+    """Counts notes received at `timestamps` as archived (or restored) in
+    the inbox's activity rollups. Call it inside the archiving transaction."""
+    if not timestamps:
+        return
+    q = sqlalchemy.text("""
+        UPDATE inbox_activity
+        SET archived = GREATEST(inbox_activity.archived + c.notes * :sign, 0)
+        FROM (
+            SELECT t::date AS day, extract(hour FROM t)::int AS hour, COUNT(*) AS notes
+            FROM unnest(CAST(:timestamps AS timestamp[])) AS t
+            GROUP BY 1, 2
+        ) c
+        WHERE inboxes_auth_id = :auth_id AND inbox_activity.day = c.day AND inbox_activity.hour = c.hour
+    """)
+    write(q, auth_id=auth_id, timestamps=list(timestamps), sign=1 if archived else -1)
+
+
+def announce_stored(auth_id, notes):
+    """Queues a NOTIFY per stored note for live inbox listeners. Call it
+    inside the storing transaction: Postgres delivers them on commit."""
+    payloads = [note_event(auth_id, note.uuid, note.byline, note.preview, note.timestamp)
+                for note in notes]
+    q = sqlalchemy.text("""
+        SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload
+    """)
+    write(q, channel=NOTES_CHANNEL, payloads=payloads)
+
+
+# Search Result Cache
+# -------------------
+# The ordered uuids matching an inbox search are cached for
+# SEARCH_CACHE_TTL, so paging through results slices the cached list
+# instead of re-scanning the inbox. Entries are keyed by a per-inbox
+# generation token that storing or (un)archiving any of its notes replaces,
+# which orphans every cached search of that inbox at once.
+#
+# The generation has to be shared by every worker for that to work. On a
+# per-process memory:// cache without CACHE_BROADCAST_URL, only the worker
+# that stored the note replaces it, and the others keep serving results
+# without the note for up to SEARCH_CACHE_TTL; a warning is logged at
+# startup. Use a redis:// or shm:// CACHE_URL, or a broadcaster, with more
+# than one worker.
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 300))
+# Searches matching more notes than this are not cached.
+SEARCH_CACHE_MAX_IDS = int(os.environ.get('SEARCH_CACHE_MAX_IDS', 5000))
+search_cache = cache.namespace('search')
+
+
+def check_search_cache(namespace):
+    """Warns when invalidating cached searches only reaches this process."""
+    if isinstance(namespace.backend, LocalBackend) and namespace.broadcaster is None:
+        logging.warning('Search results are cached per process (memory:// without CACHE_BROADCAST_URL): '
+                        f'other workers may serve stale searches for up to {SEARCH_CACHE_TTL}s.')
+
+
+check_search_cache(search_cache)
+
+
+def search_generation(auth_id):
+    generation = search_cache.get('gen:' + auth_id)
+    if generation is None:
+        generation = secrets.token_hex(4)
+        search_cache.set('gen:' + auth_id, generation, SEARCH_CACHE_TTL)
+    return generation
+
+
+def invalidate_searches(auth_id):
+    """Drops every cached search of an inbox (in every worker)."""
+    search_cache.delete('gen:' + auth_id)
+
+
+def on_note_stored(note):
+    invalidate_searches(note.auth_id)
+
+
+def on_notes_archived(auth_id, uuids, archived):
+    invalidate_searches(auth_id)
+
+
+note_stored.connect(on_note_stored)
+notes_archived.connect(on_notes_archived)
+
+
+def archive_rows(q, auth_id, archived, **params):
+    """Runs an archiving (or restoring) UPDATE ... RETURNING uuid, byline,
+    timestamp for one inbox in its own transaction, keeping the counters
+    and rollups in step.
+
+    Returns the uuids of the notes that changed.
+    """
+    with conn.begin():
+        r = write(q, auth_id=auth_id, archived=archived, **params).fetchall()
+        uuids = [row['uuid'] for row in r]
+        count_archived(auth_id, len(uuids), archived)
+        count_bylines(auth_id, [row['byline'] for row in r], -1 if archived else 1)
+        count_archived_activity(auth_id, [row['timestamp'] for row in r], archived)
+    if uuids:
+        notes_archived.send(auth_id, uuids=uuids, archived=archived)
+    return uuids
 
 
 
 # Storage Models
 # Note: Some of these are a little fancy (send email and such).
 # --------------
+# notes may be partitioned by archived, then by timestamp (migration 007):
+# filter on both wherever the query allows, so Postgres only visits the
+# partitions that can match (lookups by uuid alone probe every partition).
 
 
 class Note:
@@ -49,6 +355,9 @@ class Note:
         self.archived = None
         self.uuid = None
         self.timestamp = None
+        self.body_text = None
+        self.preview = None
+        self.auth_id = None
 
     def __repr__(self):
         return f'<Note size={len(self.body)}>'
@@ -57,14 +366,16 @@ class Note:
     def fetch(cls, uuid):
         self = cls()
         q = sqlalchemy.text("SELECT * FROM notes WHERE uuid=:uuid")
-        r = conn.execute(q, uuid=uuid).fetchall()
+        r = read(q, uuid=uuid).fetchall()
         self.body = r[0]['body']
         self.byline = r[0]['byline']
+        self.body_text = r[0]['body_text']
+        self.preview = r[0]['preview']
         self.uuid = uuid
         return self
 
     @classmethod
-    def from_inbox(cls, inbox, body, byline, archived=False, uuid=None, timestamp=None):
+    def from_inbox(cls, inbox, body, byline, archived=False, uuid=None, timestamp=None, preview=None):
         """Creates a Note instance from a given inbox."""
         self = cls()
 
@@ -74,30 +385,126 @@ class Note:
         self.archived = archived
         self.inbox = Inbox(inbox)
         self.timestamp = timestamp
+        self.preview = preview
         return self
 
+    def derive_text(self):
+        """Computes the plain-text and preview forms of the body, once, at
+        write time, so pages and search never re-derive them from HTML."""
+        self.body_text = note_text(self.body)
+        self.preview = note_preview(self.body_text)
+
     @classmethod
     def does_exist(cls, uuid):
         q = sqlalchemy.text('SELECT * from notes where uuid = :uuid')
-        r = conn.execute(q, uuid=uuid).fetchall()
+        r = read(q, uuid=uuid).fetchall()
         return bool(len(r))
 
     def store(self):
         """Stores the Note instance to the database."""
         q = '''
-        INSERT INTO notes (body, byline, inboxes_auth_id)
-        VALUES (:body, :byline, :inbox)
-        RETURNING uuid
+        INSERT INTO notes (body, byline, inboxes_auth_id, body_text, preview)
+        VALUES (:body, :byline, :inbox, :body_text, :preview)
+        RETURNING uuid, timestamp
         '''
         q = sqlalchemy.text(q)
-        result = conn.execute(q, body=self.body, byline=self.byline, inbox=self.inbox.auth_id)
-        # Assign the generated UUID from the database to this Note instance
-        self.uuid = result.fetchone()['uuid']
+        auth_id = self.inbox.auth_id
+        self.derive_text()
+        with conn.begin():
+            result = write(q, body=self.body, byline=self.byline, inbox=auth_id,
+                           body_text=self.body_text, preview=self.preview)
+            # Assign the generated UUID from the database to this Note instance
+            row = result.fetchone()
+            self.uuid, self.timestamp = row['uuid'], row['timestamp']
+            self.auth_id = auth_id
+            count_notes(auth_id, active=1)
+            count_bylines(auth_id, [self.byline])
+            count_activity(auth_id, [(self.timestamp, self.byline)])
+            announce_stored(auth_id, [self])
+        note_stored.send(self)
         logging.error(f"Note stored with UUID: {self.uuid}")
 
-    def archive(self):
-        q = sqlalchemy.text("UPDATE notes SET archived = 't' WHERE uuid = :uuid")
-        conn.execute(q, uuid=self.uuid)
+    @classmethod
+    def store_many(cls, notes, auth_id, batch_size=500):
+        """Stores many Note instances for one inbox, a batch per INSERT."""
+        notes = list(notes)
+        with conn.begin():
+            for start in range(0, len(notes), batch_size):
+                batch = notes[start:start + batch_size]
+                rows, params = [], {'inbox': auth_id}
+                for i, note in enumerate(batch):
+                    note.derive_text()
+                    rows.append(f'(:body_{i}, :byline_{i}, :inbox, :body_text_{i}, :preview_{i})')
+                    params[f'body_{i}'] = note.body
+                    params[f'byline_{i}'] = note.byline
+                    params[f'body_text_{i}'] = note.body_text
+                    params[f'preview_{i}'] = note.preview
+                q = sqlalchemy.text(f'''
+                INSERT INTO notes (body, byline, inboxes_auth_id, body_text, preview)
+                VALUES {', '.join(rows)}
+                RETURNING uuid, timestamp
+                ''')
+                # Postgres returns the generated rows in VALUES order.
+                result = write(q, **params).fetchall()
+                for note, row in zip(batch, result):
+                    note.uuid, note.timestamp = row['uuid'], row['timestamp']
+                    note.auth_id = auth_id
+            count_notes(auth_id, active=len(notes))
+            count_bylines(auth_id, [note.byline for note in notes])
+            count_activity(auth_id, [(note.timestamp, note.byline) for note in notes])
+            announce_stored(auth_id, notes)
+        for note in notes:
+            note_stored.send(note)
+        return notes
+
+    @classmethod
+    def iter_active(cls, uuids=None, batch_size=500, auth_id=None):
+        """Yields every active (unarchived) note, or those among `uuids` or
+        of the inbox `auth_id`, with full bodies, paging through them by uuid."""
+        filters = ''
+        params = dict(limit=batch_size, after='00000000-0000-0000-0000-000000000000')
+        if uuids is not None:
+            filters = ' AND uuid = ANY(CAST(:ids AS uuid[]))'
+            params['ids'] = [str(uuid) for uuid in uuids]
+        if auth_id is not None:
+            filters += ' AND inboxes_auth_id = :auth_id'
+            params['auth_id'] = auth_id
+        q = sqlalchemy.text(f"""
+            SELECT uuid, body, byline, body_text, timestamp FROM notes
+            WHERE archived = 'f' AND uuid > CAST(:after AS uuid){filters}
+            ORDER BY uuid LIMIT :limit
+        """)
+        while True:
+            rows = read(q, **params).fetchall()
+            for row in rows:
+                note = cls.from_inbox(None, row['body'], row['byline'], uuid=row['uuid'],
+                                      timestamp=row['timestamp'])
+                note.body_text = row['body_text']
+                yield note
+            if len(rows) < batch_size:
+                return
+            params['after'] = str(rows[-1]['uuid'])
+
+    @classmethod
+    def backfill_text(cls, batch_size=500):
+        """Fills in body_text and preview for notes stored before they existed.
+
+        Works in batches so it can run against a live database; returns the
+        number of notes updated.
+        """
+        select = sqlalchemy.text("SELECT uuid, body FROM notes WHERE body_text IS NULL LIMIT :limit")
+        update = sqlalchemy.text("UPDATE notes SET body_text = :body_text, preview = :preview WHERE uuid = :uuid")
+        updated = 0
+        while True:
+            rows = conn.execute(select, limit=batch_size).fetchall()
+            with conn.begin():
+                for row in rows:
+                    body_text = note_text(row['body'])
+                    conn.execute(update, uuid=row['uuid'], body_text=body_text,
+                                 preview=note_preview(body_text))
+            updated += len(rows)
+            if len(rows) < batch_size:
+                return updated
 
     def notify(self, email_address):
         myemail.notify(self, email_address)
@@ -112,19 +519,19 @@ class Inbox:
     @property
     def auth_id(self):
         q = sqlalchemy.text("SELECT * FROM inboxes WHERE slug=:inbox")
-        r = conn.execute(q, inbox=self.slug).fetchall()
+        r = read(q, inbox=self.slug).fetchall()
         return r[0]['auth_id']
     @classmethod
     def is_linked(cls, auth_id):
         q = sqlalchemy.text('SELECT * from inboxes where auth_id = :auth_id')
-        r = conn.execute(q, auth_id=auth_id).fetchall()
+        r = read(q, auth_id=auth_id).fetchall()
         return bool(len(r))
 
     @classmethod
     def store(cls, slug, auth_id, email):
         try:
             q = sqlalchemy.text('INSERT into inboxes (slug, auth_id,email) VALUES (:slug, :auth_id, :email)')
-            conn.execute(q, slug=slug, auth_id=auth_id, email=email)
+            write(q, slug=slug, auth_id=auth_id, email=email)
 
         except UniqueViolation:
             print('Duplicate record - ID already exist')
@@ -134,14 +541,14 @@ class Inbox:
     @classmethod
     def does_exist(cls, slug):
         q = sqlalchemy.text('SELECT * from inboxes where slug = :slug')
-        r = conn.execute(q, slug=slug).fetchall()
+        r = read(q, slug=slug).fetchall()
         return bool(len(r))
 
     @classmethod
     def is_email_enabled(cls, slug):
         q = sqlalchemy.text('SELECT email_enabled FROM inboxes where slug = :slug')
         try:
-            r = conn.execute(q, slug=slug).fetchall()
+            r = read(q, slug=slug).fetchall()
             return bool(r[0]['email_enabled'])
         except InFailedSqlTransaction:
             print(traceback.print_exc())
@@ -151,18 +558,18 @@ class Inbox:
     @classmethod
     def disable_email(cls, slug):
         q = sqlalchemy.text('update inboxes set email_enabled = false where slug = :slug')
-        conn.execute(q, slug=slug)
+        write(q, slug=slug)
 
     @classmethod
     def enable_email(cls, slug):
         q = sqlalchemy.text('update inboxes set email_enabled = true where slug = :slug')
-        conn.execute(q, slug=slug)
+        write(q, slug=slug)
 
     @classmethod
     def is_enabled(cls, slug):
         q = sqlalchemy.text('SELECT enabled FROM inboxes where slug = :slug')
         try:
-            r = conn.execute(q, slug=slug).fetchall()
+            r = read(q, slug=slug).fetchall()
             if not r[0]['enabled']:
                 return False
             return bool(r[0]['enabled'])
@@ -174,22 +581,28 @@ class Inbox:
     @classmethod
     def disable_account(cls, slug):
         q = sqlalchemy.text('update inboxes set enabled = false where slug = :slug')
-        conn.execute(q, slug=slug)
+        write(q, slug=slug)
 
     @classmethod
     def enable_account(cls, slug):
         q = sqlalchemy.text('update inboxes set enabled = true where slug = :slug')
-        conn.execute(q, slug=slug)
+        write(q, slug=slug)
 
     def submit_note(self, body, byline):
         note = Note.from_inbox(self.slug, body, byline)
         note.store()
         return note
 
+    def submit_notes(self, notes):
+        """Stores an iterable of (body, byline) pairs; returns the new uuids."""
+        notes = [Note.from_inbox(self.slug, body, byline) for body, byline in notes]
+        Note.store_many(notes, self.auth_id)
+        return [note.uuid for note in notes]
+
     @classmethod
     def get_email(cls, slug):
         q = sqlalchemy.text('SELECT email FROM inboxes where slug = :slug')
-        r = conn.execute(q, slug=slug).fetchall()
+        r = read(q, slug=slug).fetchall()
         return r[0]['email']
 
     @property
@@ -202,20 +615,24 @@ class Inbox:
     def notes(self,page,page_size):
         """Returns a list of notes, ordered reverse-chronologically with pagination."""
         offset = (page - 1) * page_size
-        count_query = sqlalchemy.text("SELECT COUNT(*) FROM notes WHERE inboxes_auth_id = :auth_id AND archived = 'f'")
-        total_notes = conn.execute(count_query, auth_id=self.auth_id).scalar()
+        # The maintained counter saves a COUNT(*) over the inbox per page view.
+        count_query = sqlalchemy.text("SELECT auth_id, notes_active FROM inboxes WHERE slug = :slug")
+        inbox = read(count_query, slug=self.slug).fetchone()
+        auth_id, total_notes = inbox['auth_id'], inbox['notes_active']
+        # Listings only need the short preview, not the full body.
         query = sqlalchemy.text("""
-            SELECT * FROM notes 
+            SELECT uuid, byline, archived, timestamp, COALESCE(preview, body) AS preview
+            FROM notes
             WHERE inboxes_auth_id = :auth_id AND archived = 'f'
             ORDER BY timestamp DESC
             LIMIT :limit OFFSET :offset
         """)
-        result = conn.execute(query, auth_id=self.auth_id, limit=page_size, offset=offset).fetchall()
+        result = read(query, auth_id=auth_id, limit=page_size, offset=offset).fetchall()
 
         notes = [
             Note.from_inbox(
                 self.slug,
-                n["body"], n["byline"], n["archived"], n["uuid"], n["timestamp"]
+                None, n["byline"], n["archived"], n["uuid"], n["timestamp"], n["preview"]
             )
             for n in result
         ]
@@ -227,29 +644,195 @@ class Inbox:
             "total_pages": (total_notes + page_size - 1) // page_size  # Calculate total pages
         }
 
+    def notes_by_byline(self, byline, page, page_size):
+        """Returns a page of the notes signed `byline` (compared normalized,
+        see BYLINE_KEY), like notes(), through the byline index instead of
+        scanning the inbox."""
+        offset = (page - 1) * page_size
+        auth_id = self.auth_id
+        count_query = sqlalchemy.text(f"""
+            SELECT notes FROM inbox_bylines
+            WHERE inboxes_auth_id = :auth_id AND byline = {BYLINE_KEY.format(':byline')}
+        """)
+        r = read(count_query, auth_id=auth_id, byline=byline).fetchall()
+        total_notes = r[0]['notes'] if r else 0
+        query = sqlalchemy.text(f"""
+            SELECT uuid, byline, archived, timestamp, COALESCE(preview, body) AS preview
+            FROM notes
+            WHERE inboxes_auth_id = :auth_id AND archived = 'f'
+            AND {BYLINE_KEY.format('byline')} = {BYLINE_KEY.format(':byline')}
+            ORDER BY timestamp DESC
+            LIMIT :limit OFFSET :offset
+        """)
+        result = read(query, auth_id=auth_id, byline=byline, limit=page_size, offset=offset).fetchall()
+
+        notes = [
+            Note.from_inbox(
+                self.slug,
+                None, n["byline"], n["archived"], n["uuid"], n["timestamp"], n["preview"]
+            )
+            for n in result
+        ]
+
+        return {
+            "notes": notes,
+            "total_notes": total_notes,
+            "page": page,
+            "total_pages": (total_notes + page_size - 1) // page_size  # Calculate total pages
+        }
+
+    def bylines(self, prefix, limit=10):
+        """Returns up to `limit` of the inbox's bylines starting with
+        `prefix` (normalized), most used first, as dicts of byline (its
+        latest spelling), key (normalized) and notes."""
+        prefix = ' '.join(prefix.lower().split())
+        # Escape LIKE wildcards, so the prefix is matched literally.
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        q = sqlalchemy.text("""
+            SELECT display, byline, notes FROM inbox_bylines
+            WHERE inboxes_auth_id = (SELECT auth_id FROM inboxes WHERE slug = :slug)
+            AND byline LIKE :pattern AND notes > 0
+            ORDER BY notes DESC, byline
+            LIMIT :limit
+        """)
+        r = read(q, slug=self.slug, pattern=pattern, limit=limit).fetchall()
+        return [{'byline': row['display'], 'key': row['byline'], 'notes': row['notes']} for row in r]
+
+    def stats(self, days=30, bylines=10):
+        """Returns the inbox's activity over the last `days` days, read from
+        the rollups (migration 009) only: notes received and archived in
+        total, per day and per week (starting Monday), per hour of the day,
+        and its `bylines` most frequent bylines."""
+        auth_id = self.auth_id
+        q = sqlalchemy.text("""
+            SELECT d::date AS day, COALESCE(sum(a.notes), 0) AS notes, COALESCE(sum(a.archived), 0) AS archived
+            FROM generate_series(current_date - :days + 1, current_date, interval '1 day') AS d
+            LEFT JOIN inbox_activity a ON a.inboxes_auth_id = :auth_id AND a.day = d::date
+            GROUP BY 1 ORDER BY 1
+        """)
+        daily = [{'day': r['day'], 'notes': int(r['notes']), 'archived': int(r['archived'])}
+                 for r in read(q, auth_id=auth_id, days=days)]
+        weekly = {}
+        for row in daily:
+            week = row['day'] - timedelta(days=row['day'].weekday())
+            weekly[week] = weekly.get(week, 0) + row['notes']
+
+        q = sqlalchemy.text("""
+            SELECT hour, sum(notes) AS notes FROM inbox_activity
+            WHERE inboxes_auth_id = :auth_id AND day > current_date - :days
+            GROUP BY hour
+        """)
+        hours = [0] * 24
+        for r in read(q, auth_id=auth_id, days=days):
+            hours[r['hour']] = int(r['notes'])
+
+        q = sqlalchemy.text("""
+            SELECT byline, max(display) AS display, sum(notes) AS notes FROM inbox_byline_activity
+            WHERE inboxes_auth_id = :auth_id AND day > current_date - :days
+            GROUP BY byline
+            ORDER BY 3 DESC, byline
+            LIMIT :limit
+        """)
+        top = [{'byline': r['display'], 'key': r['byline'], 'notes': int(r['notes'])}
+               for r in read(q, auth_id=auth_id, days=days, limit=bylines)]
+
+        return {
+            'days': days,
+            'notes': sum(row['notes'] for row in daily),
+            'archived': sum(row['archived'] for row in daily),
+            'daily': daily,
+            'weekly': [{'week': week, 'notes': notes} for week, notes in weekly.items()],
+            'hours': hours,
+            'bylines': top,
+        }
+
     def search_notes(self, search_str, page, page_size):
+        offset = (page - 1) * page_size
+        search_str = ' '.join(search_str.split())
+        auth_id = self.auth_id
+        uuids = self.search_uuids(auth_id, search_str)
+        if uuids is None:
+            return self.search_page(auth_id, search_str, page, page_size)
+
+        query = sqlalchemy.text("""
+            SELECT uuid, byline, archived, timestamp, COALESCE(preview, body) AS preview
+            FROM notes WHERE uuid = ANY(CAST(:ids AS uuid[]))
+            AND archived = 'f' AND inboxes_auth_id = :auth_id
+        """)
+        ids = uuids[offset:offset + page_size]
+        # Notes archived since the ids were cached drop out of the page;
+        # the filters also let Postgres skip the archived partitions.
+        rows = {str(n['uuid']): n for n in read(query, ids=ids, auth_id=auth_id).fetchall()} if ids else {}
+        notes = [
+            Note.from_inbox(
+                self.slug,
+                None, n["byline"], n["archived"], n["uuid"], n["timestamp"], n["preview"]
+            )
+            for n in (rows.get(uuid) for uuid in ids) if n is not None
+        ]
+        total_notes = len(uuids)
+
+        return {
+            "notes": notes,
+            "total_notes": total_notes,
+            "page": page,
+            "total_pages": (total_notes + page_size - 1) // page_size  # Calculate total pages
+        }
+
+    def search_uuids(self, auth_id, search_str):
+        """Returns the uuids of every active note matching `search_str`,
+        newest first, from the search cache when possible; None when there
+        are too many to cache."""
+        digest = hashlib.sha1(search_str.lower().encode()).hexdigest()
+        key = f'{auth_id}:{search_generation(auth_id)}:{digest}'
+        uuids = search_cache.get(key)
+        if uuids is not None:
+            metrics.incr('search_cache_hits_total')
+            return uuids
+        metrics.incr('search_cache_misses_total')
+
+        query = sqlalchemy.text("""
+            SELECT uuid FROM notes
+            WHERE (LOWER(COALESCE(body_text, body)) LIKE '%' || :param || '%' OR LOWER(byline) LIKE '%' || :param || '%')
+            AND inboxes_auth_id = :auth_id
+            AND archived = 'f'
+            ORDER BY timestamp DESC
+            LIMIT :limit
+        """)
+        # From the primary: a lagging replica's answer would stay cached
+        # after the invalidation meant to clear it.
+        result = conn.execute(query, param=search_str.lower(), auth_id=auth_id,
+                              limit=SEARCH_CACHE_MAX_IDS + 1).fetchall()
+        if len(result) > SEARCH_CACHE_MAX_IDS:
+            return None
+        uuids = [str(r['uuid']) for r in result]
+        search_cache.set(key, uuids, SEARCH_CACHE_TTL)
+        return uuids
+
+    def search_page(self, auth_id, search_str, page, page_size):
+        """One page of a search, queried directly (for very broad searches)."""
         offset = (page - 1) * page_size
         search_str_lower = search_str.lower()
 
         query = sqlalchemy.text("""
-            SELECT *, 
+            SELECT uuid, byline, archived, timestamp, COALESCE(preview, body) AS preview,
                 COUNT(*) OVER() AS total_notes
             FROM notes
-            WHERE (LOWER(body) LIKE '%' || :param || '%' OR LOWER(byline) LIKE '%' || :param || '%')
+            WHERE (LOWER(COALESCE(body_text, body)) LIKE '%' || :param || '%' OR LOWER(byline) LIKE '%' || :param || '%')
             AND inboxes_auth_id = :auth_id
             AND archived = 'f'
             ORDER BY timestamp DESC
             LIMIT :limit OFFSET :offset
         """)
         # Execute the query with the search string and pagination parameters
-        result = conn.execute(
-            query, param=search_str_lower, auth_id=self.auth_id, limit=page_size, offset=offset
+        result = read(
+            query, param=search_str_lower, auth_id=auth_id, limit=page_size, offset=offset
         ).fetchall()
 
         notes = [
             Note.from_inbox(
                 self.slug,
-                n["body"], n["byline"], n["archived"], n["uuid"], n["timestamp"]
+                None, n["byline"], n["archived"], n["uuid"], n["timestamp"], n["preview"]
             )
             for n in result
         ]
@@ -264,17 +847,296 @@ class Inbox:
             "total_pages": (total_notes + page_size - 1) // page_size  # Calculate total pages
         }
 
+    # Columns callers may ask of page() and note(), and how to select them.
+    NOTE_FIELDS = {
+        'uuid': 'n.uuid',
+        'byline': 'n.byline',
+        'timestamp': 'n.timestamp',
+        'archived': 'n.archived',
+        'preview': 'COALESCE(n.preview, n.body) AS preview',
+        'body': 'n.body',
+        'body_text': 'n.body_text',
+    }
+
+    def page(self, limit, after=None, search_str=None, fields=('uuid', 'byline', 'timestamp', 'preview')):
+        """Returns up to `limit` active notes as dicts of `fields`, newest
+        first, optionally matching `search_str`.
+
+        Pages by keyset rather than offset: `after` is the (timestamp, uuid)
+        of the last note of the previous page, so deep pages cost the same as
+        the first. Returns (rows, keyset of the last row or None).
+        """
+        columns = ', '.join(self.NOTE_FIELDS[field] for field in fields)
+        filters = ''
+        params = dict(slug=self.slug, limit=limit)
+        if after is not None:
+            filters += ' AND (n.timestamp, n.uuid) < (:after_timestamp, CAST(:after_uuid AS uuid))'
+            params['after_timestamp'], params['after_uuid'] = after
+        if search_str:
+            filters += " AND (LOWER(COALESCE(n.body_text, n.body)) LIKE '%' || :param || '%' OR LOWER(n.byline) LIKE '%' || :param || '%')"
+            params['param'] = search_str.lower()
+        q = sqlalchemy.text(f"""
+            SELECT {columns}, n.timestamp AS keyset_timestamp, n.uuid AS keyset_uuid
+            FROM notes n JOIN inboxes i ON i.auth_id = n.inboxes_auth_id
+            WHERE i.slug = :slug AND n.archived = 'f'{filters}
+            ORDER BY n.timestamp DESC, n.uuid DESC
+            LIMIT :limit
+        """)
+        result = read(q, **params).fetchall()
+        rows = [{field: r[field] for field in fields} for r in result]
+        last = (result[-1]['keyset_timestamp'], str(result[-1]['keyset_uuid'])) if result else None
+        return rows, last
+
+    def note(self, uuid, fields=('uuid', 'byline', 'timestamp', 'archived', 'body')):
+        """Returns one note of this inbox as a dict of `fields`, or None if
+        this inbox has no such note."""
+        columns = ', '.join(self.NOTE_FIELDS[field] for field in fields)
+        q = sqlalchemy.text(f"""
+            SELECT {columns}
+            FROM notes n JOIN inboxes i ON i.auth_id = n.inboxes_auth_id
+            WHERE i.slug = :slug AND n.uuid = :uuid
+        """)
+        r = read(q, slug=self.slug, uuid=uuid).fetchall()
+        return {field: r[0][field] for field in fields} if r else None
+
+    def changes(self, after, limit, fields=('uuid', 'byline', 'timestamp', 'archived', 'body')):
+        """Returns up to `limit` notes of this inbox stored, archived or
+        restored since the change `after`, oldest change first, as dicts of
+        `fields`. Changes are (change_txid, change_seq) pairs; (0, 0) is
+        before the first.
+
+        Only changes of transactions older than every transaction still
+        running are returned: those are settled, and every change yet to
+        commit will sort after them, so none is ever skipped.
+        Returns (rows, the change of the last row or `after`).
+        """
+        columns = ', '.join(self.NOTE_FIELDS[field] for field in fields)
+        q = sqlalchemy.text(f"""
+            SELECT {columns}, n.change_txid, n.change_seq
+            FROM notes n JOIN inboxes i ON i.auth_id = n.inboxes_auth_id
+            WHERE i.slug = :slug AND (n.change_txid, n.change_seq) > (:after_txid, :after_seq)
+            AND n.change_txid < txid_snapshot_xmin(txid_current_snapshot())
+            ORDER BY n.change_txid, n.change_seq
+            LIMIT :limit
+        """)
+        after_txid, after_seq = after
+        result = read(q, slug=self.slug, after_txid=after_txid, after_seq=after_seq, limit=limit).fetchall()
+        rows = [{field: r[field] for field in fields} for r in result]
+        return rows, (result[-1]['change_txid'], result[-1]['change_seq']) if result else after
+
+    def set_archived(self, uuids, archived=True, chunk_size=1000):
+        """Archives (or restores) the given notes of this inbox.
+
+        Notes owned by other inboxes are left untouched. Returns the number of
+        notes that changed state.
+        """
+        q = sqlalchemy.text("""
+            UPDATE notes SET archived = :archived, change_seq = nextval('notes_change_seq'), change_txid = txid_current()
+            WHERE uuid = ANY(CAST(:ids AS uuid[]))
+            AND inboxes_auth_id = :auth_id
+            AND archived <> :archived
+            RETURNING uuid, byline, "timestamp"
+        """)
+        auth_id = self.auth_id
+        uuids = [str(uuid) for uuid in uuids]
+        changed = 0
+        for start in range(0, len(uuids), chunk_size):
+            chunk = uuids[start:start + chunk_size]
+            changed += len(archive_rows(q, auth_id, archived, ids=chunk))
+        return changed
+
+    def set_archived_matching(self, archived=True, before=None, search_str=None, chunk_size=1000):
+        """Archives (or restores) every note of this inbox older than `before`
+        and/or matching `search_str`, one chunk per statement so a large
+        selection never holds its row locks for long.
+        """
+        filters = ''
+        auth_id = self.auth_id
+        params = dict(auth_id=auth_id, archived=archived, chunk_size=chunk_size)
+        if before is not None:
+            filters += ' AND timestamp < :before'
+            params['before'] = before
+        if search_str:
+            filters += " AND (LOWER(COALESCE(body_text, body)) LIKE '%' || :param || '%' OR LOWER(byline) LIKE '%' || :param || '%')"
+            params['param'] = search_str.lower()
+        q = sqlalchemy.text(f"""
+            UPDATE notes SET archived = :archived, change_seq = nextval('notes_change_seq'), change_txid = txid_current()
+            WHERE archived <> :archived AND uuid IN (
+                SELECT uuid FROM notes
+                WHERE inboxes_auth_id = :auth_id AND archived <> :archived{filters}
+                LIMIT :chunk_size
+            )
+            RETURNING uuid, byline, "timestamp"
+        """)
+        changed = 0
+        while True:
+            count = len(archive_rows(q, **params))
+            changed += count
+            if count < chunk_size:
+                return changed
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Repairs drift in the maintained note counters of every inbox.
+
+        Returns the number of inboxes whose counters were corrected.
+        """
+        q = sqlalchemy.text("""
+            UPDATE inboxes
+            SET notes_active = c.active, notes_archived = c.archived
+            FROM (
+                SELECT i.auth_id,
+                    COUNT(n.uuid) FILTER (WHERE NOT n.archived) AS active,
+                    COUNT(n.uuid) FILTER (WHERE n.archived) AS archived
+                FROM inboxes i LEFT JOIN notes n ON n.inboxes_auth_id = i.auth_id
+                GROUP BY i.auth_id
+            ) c
+            WHERE inboxes.auth_id = c.auth_id
+            AND (inboxes.notes_active, inboxes.notes_archived) IS DISTINCT FROM (c.active, c.archived)
+        """)
+        return write(q).rowcount
+
+    @classmethod
+    def reconcile_bylines(cls):
+        """Repairs drift in the maintained byline facet of every inbox.
+
+        Returns the number of bylines whose counts were corrected.
+        """
+        q = sqlalchemy.text(f"""
+            INSERT INTO inbox_bylines (inboxes_auth_id, byline, display, notes)
+            SELECT COALESCE(c.inboxes_auth_id, b.inboxes_auth_id), COALESCE(c.byline, b.byline),
+                COALESCE(c.display, b.display), COALESCE(c.notes, 0)
+            FROM (
+                SELECT inboxes_auth_id, {BYLINE_KEY.format('byline')} AS byline,
+                    max(regexp_replace(btrim(byline), '\\s+', ' ', 'g')) AS display, COUNT(*) AS notes
+                FROM notes WHERE archived = 'f' AND btrim(byline) <> ''
+                GROUP BY 1, 2
+            ) c
+            FULL JOIN inbox_bylines b ON b.inboxes_auth_id = c.inboxes_auth_id AND b.byline = c.byline
+            WHERE b.notes IS DISTINCT FROM COALESCE(c.notes, 0)
+            ON CONFLICT (inboxes_auth_id, byline) DO UPDATE SET notes = EXCLUDED.notes
+        """)
+        return write(q).rowcount
+
+    @classmethod
+    def backfill_activity(cls, since=None):
+        """Rebuilds the activity rollups from the notes received since `since`
+        (a date; by default from the first note), a month per transaction.
+
+        Each month locks the rollups against writes while it is recounted,
+        so notes stored meanwhile wait for it rather than being missed.
+        Returns the number of notes counted.
+        """
+        if since is None:
+            since = conn.execute(sqlalchemy.text('SELECT min("timestamp")::date FROM notes')).scalar()
+            if since is None:
+                return 0
+        hours = sqlalchemy.text("""
+            WITH counted AS (
+                INSERT INTO inbox_activity (inboxes_auth_id, day, hour, notes, archived)
+                SELECT inboxes_auth_id, "timestamp"::date, extract(hour FROM "timestamp")::int,
+                    COUNT(*), COUNT(*) FILTER (WHERE archived)
+                FROM notes
+                WHERE "timestamp" >= :start AND "timestamp" < :end
+                GROUP BY 1, 2, 3
+                RETURNING notes
+            )
+            SELECT COALESCE(sum(notes), 0) FROM counted
+        """)
+        bylines = sqlalchemy.text(f"""
+            INSERT INTO inbox_byline_activity (inboxes_auth_id, day, byline, display, notes)
+            SELECT inboxes_auth_id, "timestamp"::date, {BYLINE_KEY.format('byline')},
+                max(regexp_replace(btrim(byline), '\\s+', ' ', 'g')), COUNT(*)
+            FROM notes
+            WHERE "timestamp" >= :start AND "timestamp" < :end AND btrim(byline) <> ''
+            GROUP BY 1, 2, 3
+        """)
+        counted = 0
+        start = since.replace(day=1)
+        # A month past today, in case the database's clock is ahead.
+        while start <= date.today() + timedelta(days=31):
+            end = (start + timedelta(days=32)).replace(day=1)
+            params = dict(start=max(start, since), end=end)
+            with conn.begin():
+                conn.execute('LOCK TABLE inbox_activity, inbox_byline_activity IN SHARE ROW EXCLUSIVE MODE')
+                for table in ('inbox_activity', 'inbox_byline_activity'):
+                    conn.execute(sqlalchemy.text(f'DELETE FROM {table} WHERE day >= :start AND day < :end'),
+                                 **params)
+                counted += conn.execute(hours, **params).scalar()
+                conn.execute(bylines, **params)
+            start = end
+        return counted
+
     def export(self, file_format):
-        q = sqlalchemy.text("SELECT * from notes where inboxes_auth_id = :auth_id and archived = 'f'")
-        r = conn.execute(q, auth_id=self.auth_id).fetchall()
-        return tablib.Dataset(r).export(file_format)
+        """Returns the inbox's active notes as a tablib `file_format` file
+        (built in memory; see exports.py for the streamed formats)."""
+        q = sqlalchemy.text("""
+            SELECT CAST(uuid AS text) AS uuid, inboxes_auth_id, body, byline, archived, timestamp
+            FROM notes WHERE inboxes_auth_id = :auth_id AND archived = 'f'
+            ORDER BY timestamp
+        """)
+        r = read(q, auth_id=self.auth_id)
+        headers = list(r.keys())
+        return tablib.Dataset(*(tuple(row) for row in r), headers=headers).export(file_format)
 
     @property
     def archived_notes(self):
         """Returns a list of archived notes, ordered reverse-chronologically."""
-        q = sqlalchemy.text("SELECT * from notes where inboxes_auth_id = :auth_id and archived = 't'")
-        r = conn.execute(q, auth_id=self.auth_id).fetchall()
+        q = sqlalchemy.text("""
+            SELECT uuid, byline, archived, COALESCE(preview, body) AS preview
+            FROM notes WHERE inboxes_auth_id = :auth_id AND archived = 't'
+        """)
+        r = read(q, auth_id=self.auth_id).fetchall()
 
         notes = [Note.from_inbox(
-            self.slug, n['body'], n['byline'], n['archived'], n['uuid']) for n in r]
+            self.slug, None, n['byline'], n['archived'], n['uuid'], preview=n['preview']) for n in r]
         return notes[::-1]
+
+
+class Session:
+    """Server-side session data, keyed by the opaque id in the session cookie.
+
+    Sessions always live on the primary: they are read back on the very next
+    request, and saving one must not pin the user's reads to the primary.
+    """
+
+    @classmethod
+    def load(cls, sid):
+        q = sqlalchemy.text("SELECT data FROM sessions WHERE sid = :sid AND expires > now()")
+        r = conn.execute(q, sid=sid).fetchall()
+        return r[0]['data'] if r else None
+
+    @classmethod
+    def load_profile(cls, sid):
+        q = sqlalchemy.text("SELECT profile FROM sessions WHERE sid = :sid AND expires > now()")
+        r = conn.execute(q, sid=sid).fetchall()
+        return r[0]['profile'] if r else None
+
+    @classmethod
+    def save(cls, sid, data, ttl):
+        q = sqlalchemy.text("""
+            INSERT INTO sessions (sid, data, expires)
+            VALUES (:sid, :data, now() + make_interval(secs => :ttl))
+            ON CONFLICT (sid) DO UPDATE SET data = EXCLUDED.data, expires = EXCLUDED.expires
+        """)
+        conn.execute(q, sid=sid, data=data, ttl=ttl)
+
+    @classmethod
+    def save_profile(cls, sid, profile, ttl):
+        q = sqlalchemy.text("""
+            INSERT INTO sessions (sid, data, profile, expires)
+            VALUES (:sid, '', :profile, now() + make_interval(secs => :ttl))
+            ON CONFLICT (sid) DO UPDATE SET profile = EXCLUDED.profile, expires = EXCLUDED.expires
+        """)
+        conn.execute(q, sid=sid, profile=profile, ttl=ttl)
+
+    @classmethod
+    def delete(cls, sid):
+        q = sqlalchemy.text("DELETE FROM sessions WHERE sid = :sid")
+        conn.execute(q, sid=sid)
+
+    @classmethod
+    def purge_expired(cls):
+        """Deletes expired sessions; returns how many were removed."""
+        q = sqlalchemy.text("DELETE FROM sessions WHERE expires <= now()")
+        return conn.execute(q).rowcount
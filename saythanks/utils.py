@@ -1,7 +1,40 @@
 import re
+import json
+from html import unescape
+
+# Length of the stored note preview shown in inbox listings.
+PREVIEW_LENGTH = 140
+
+# Postgres NOTIFY channel announcing stored notes (see live.py).
+NOTES_CHANNEL = 'saythanks_notes'
+
 
 def strip_html(text):
     if not text:
         return ""
     # Remove HTML tags
     return re.sub(r'<[^>]+>', '', text)
+
+
+def note_text(html):
+    """The plain text of a stored (sanitized HTML) note body."""
+    return unescape(strip_html(html)).strip()
+
+
+def note_preview(text, length=PREVIEW_LENGTH):
+    """A single-line preview of a note's plain text."""
+    text = ' '.join(text.split())
+    if len(text) <= length:
+        return text
+    return text[:length - 1].rstrip() + '…'
+
+
+def note_event(auth_id, uuid, byline, preview, timestamp):
+    """The compact NOTIFY payload announcing a stored note to live inboxes."""
+    return json.dumps({
+        'inbox': auth_id,
+        'uuid': str(uuid),
+        'byline': str(byline or '')[:200],
+        'preview': preview,
+        'timestamp': timestamp.isoformat() if timestamp else None,
+    }, separators=(',', ':'))
@@ -0,0 +1,72 @@
+import os
+
+# The app reads its settings from the environment at import time; these
+# stand in for the ones a test run doesn't need real values for.
+os.environ.setdefault('AUTH0_DOMAIN', 'example.auth0.com')
+os.environ.setdefault('AUTH0_JWT_V2_TOKEN', 'test')
+os.environ.setdefault('AUTH0_CLIENT_ID', 'test')
+os.environ.setdefault('AUTH0_CLIENT_SECRET', 'test')
+os.environ.setdefault('AUTH0_CALLBACK_URL', 'http://localhost:5000/callback')
+os.environ.setdefault('SENDGRID_API_KEY', 'test')
+os.environ.setdefault('DATABASE_URL', 'postgresql://saythanks@localhost/saythanks_test')
+os.environ.setdefault('SESSION_BACKEND', 'cache')
+os.environ.setdefault('CACHE_URL', 'memory://')
+
+# Tests touching Postgres run against TEST_DATABASE_URL, a scratch database
+# whose public schema they drop and recreate; they're skipped without it.
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+if TEST_DATABASE_URL:
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+
+import psycopg2  # noqa: E402
+import pytest  # noqa: E402
+
+SCHEMA = os.path.join(os.path.dirname(__file__), '..', 'saythanks', 'sqls', 'schema.sql')
+
+
+def connect():
+    connection = psycopg2.connect(TEST_DATABASE_URL)
+    connection.autocommit = True
+    return connection
+
+
+@pytest.fixture(scope='session')
+def database():
+    """The scratch database, with schema.sql and every migration applied."""
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    from saythanks import migrations
+
+    connection = connect()
+    with open(SCHEMA) as f:
+        connection.cursor().execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public;' + f.read())
+    connection.close()
+    migrations.migrate(echo=lambda line: None)
+    return TEST_DATABASE_URL
+
+
+@pytest.fixture
+def db(database):
+    """A cursor on the scratch database, emptied of rows (but for the
+    applied migrations) before each test."""
+    from saythanks import storage
+
+    # Its idle transactions would hold locks TRUNCATE waits for.
+    storage.disconnect()
+    connection = connect()
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT string_agg(format('%I.%I', schemaname, tablename), ', ')
+        FROM pg_tables WHERE schemaname = 'public' AND tablename <> 'schema_migrations'
+    """)
+    cursor.execute(f'TRUNCATE {cursor.fetchone()[0]} CASCADE')
+    yield cursor
+    connection.close()
+    storage.disconnect()
+
+
+@pytest.fixture
+def inbox(db):
+    """A registered inbox, as (slug, auth_id)."""
+    db.execute("INSERT INTO inboxes (slug, auth_id, email) VALUES ('someone', 'auth0|someone', 'a@example.com')")
+    return 'someone', 'auth0|someone'
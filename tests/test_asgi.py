@@ -0,0 +1,56 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('starlette')
+
+from starlette.testclient import TestClient  # noqa: E402
+
+from saythanks import aiostorage, asgi, ratelimit, storage  # noqa: E402
+
+
+def test_positional_numbers_named_parameters():
+    sql, *args = aiostorage.positional(
+        'SELECT :a, :b::int, t::date, :a FROM x WHERE y = :b', a=1, b=2)
+    assert sql == 'SELECT $1, $2::int, t::date, $1 FROM x WHERE y = $2'
+    assert args == [1, 2]
+
+
+def test_submit_without_body_is_a_bad_request(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'enabled', False)
+    client = TestClient(asgi.app)
+    response = client.post('/to/someone/submit', data={'byline': 'Ann'}, follow_redirects=False)
+    assert response.status_code == 400
+
+
+def counts(db, auth_id):
+    db.execute('SELECT notes_active FROM inboxes WHERE auth_id = %s', (auth_id,))
+    active = db.fetchone()[0]
+    db.execute('SELECT byline, display, notes FROM inbox_bylines WHERE inboxes_auth_id = %s', (auth_id,))
+    bylines = db.fetchall()
+    db.execute('SELECT day, hour, notes FROM inbox_activity WHERE inboxes_auth_id = %s', (auth_id,))
+    hours = db.fetchall()
+    db.execute('SELECT byline, notes FROM inbox_byline_activity WHERE inboxes_auth_id = %s', (auth_id,))
+    return active, bylines, hours, db.fetchall()
+
+
+def test_async_store_counts_like_storage(db, inbox):
+    slug, auth_id = inbox
+    storage.Inbox(slug).submit_note(body='<p>one</p>', byline='  Ann  Smith')
+
+    async def store():
+        await aiostorage.connect()
+        try:
+            await aiostorage.store_note(auth_id, '<p>two</p>', 'ann smith')
+            await aiostorage.store_note(auth_id, '<p>three</p>', '')
+        finally:
+            await aiostorage.disconnect()
+
+    asyncio.run(store())
+    active, bylines, hours, byline_days = counts(db, auth_id)
+    assert active == 3
+    assert bylines == [('ann smith', 'ann smith', 2)]
+    assert sum(notes for day, hour, notes in hours) == 3
+    assert hours[0][0] == datetime.now().date()
+    assert byline_days == [('ann smith', 2)]
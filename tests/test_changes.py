@@ -0,0 +1,57 @@
+import psycopg2
+import pytest
+
+from saythanks import api, core, storage
+
+
+def test_change_cursor_round_trip():
+    cursor = api.encode_change_cursor((123456, 42))
+    with core.app.test_request_context():
+        assert api.decode_change_cursor(cursor) == (123456, 42)
+
+
+@pytest.mark.parametrize('cursor', ['', 'bm9wZQ', api.encode_change_cursor((1, 2))[:-2], '***'])
+def test_invalid_change_cursors_are_rejected(cursor):
+    with core.app.test_request_context():
+        with pytest.raises(Exception) as e:
+            api.decode_change_cursor(cursor)
+    assert e.value.response.status_code == 400
+
+
+def bodies(rows):
+    return [row['body'] for row in rows]
+
+
+def test_changes_feed_never_skips_a_late_commit(database, inbox):
+    slug, auth_id = inbox
+    inbox_db = storage.Inbox(slug)
+    inbox_db.submit_note(body='first', byline='')
+    rows, cursor = inbox_db.changes((0, 0), 10)
+    assert bodies(rows) == ['first']
+
+    # A note whose transaction started first, but commits last.
+    slow = psycopg2.connect(database)
+    slow.cursor().execute("INSERT INTO notes (body, byline, inboxes_auth_id) VALUES ('slow', '', %s)",
+                          (auth_id,))
+    inbox_db.submit_note(body='fast', byline='')
+    rows, held = inbox_db.changes(cursor, 10)
+    assert rows == [] and held == cursor
+
+    slow.commit()
+    slow.close()
+    rows, cursor = inbox_db.changes(cursor, 10)
+    assert bodies(rows) == ['slow', 'fast']
+    assert inbox_db.changes(cursor, 10) == ([], cursor)
+
+
+def test_archiving_is_a_new_change(inbox):
+    slug, auth_id = inbox
+    inbox_db = storage.Inbox(slug)
+    first = inbox_db.submit_note(body='first', byline='')
+    inbox_db.submit_note(body='second', byline='')
+    rows, cursor = inbox_db.changes((0, 0), 1)
+    assert bodies(rows) == ['first']
+
+    inbox_db.set_archived([first.uuid])
+    rows, cursor = inbox_db.changes(cursor, 10, fields=('body', 'archived'))
+    assert rows == [{'body': 'second', 'archived': False}, {'body': 'first', 'archived': True}]
@@ -0,0 +1,80 @@
+import gzip
+
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from saythanks import compression
+
+BODY = b'<p>Thank you!</p>' * 100
+
+
+def client(body=BODY, mimetype='text/html', headers=None):
+    def app(environ, start_response):
+        response = Response(body, mimetype=mimetype, headers=headers)
+        return response(environ, start_response)
+    return Client(compression.CompressionMiddleware(app, min_size=512))
+
+
+@pytest.mark.parametrize('accept, expected', [
+    ('gzip, deflate, br', 'br'),
+    ('gzip;q=1.0, br;q=0.5', 'gzip'),
+    ('br;q=0, gzip;q=0', None),
+    ('identity', None),
+    ('', None),
+    ('*', 'br'),
+    ('br;q=0, *;q=0.5', 'gzip'),
+    ('GZIP;Q=0.8', 'gzip'),
+    ('gzip;q=nonsense, br;q=0.1', 'br'),
+])
+def test_negotiate(accept, expected, monkeypatch):
+    # Only whether brotli is importable matters here.
+    monkeypatch.setattr(compression, 'brotli', compression.brotli or object())
+    assert compression.negotiate(accept) == expected
+
+
+def test_negotiate_without_brotli(monkeypatch):
+    monkeypatch.setattr(compression, 'brotli', None)
+    assert compression.negotiate('br, gzip') == 'gzip'
+    assert compression.negotiate('br') is None
+
+
+def test_gzip_round_trip():
+    response = client(headers={'ETag': '"abc"', 'Vary': 'Cookie'}).get(headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Cookie, Accept-Encoding'
+    assert response.headers['ETag'] == 'W/"abc"'
+    assert 'Content-Length' not in response.headers
+    assert gzip.decompress(response.data) == BODY
+
+
+def test_brotli_round_trip():
+    brotli = pytest.importorskip('brotli')
+    response = client().get(headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(response.data) == BODY
+
+
+def test_streamed_body_is_compressed_once_big_enough():
+    response = client(body=iter([b'x' * 100] * 10), mimetype='text/csv').get(headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == b'x' * 1000
+
+
+@pytest.mark.parametrize('kwargs, expected, encoding', [
+    (dict(body=b'<p>short</p>'), b'<p>short</p>', None),
+    (dict(body=iter([b'short'] * 3)), b'short' * 3, None),
+    (dict(mimetype='image/png'), BODY, None),
+    # Already encoded, e.g. a precompressed asset.
+    (dict(headers={'Content-Encoding': 'br'}), BODY, 'br'),
+])
+def test_passes_through(kwargs, expected, encoding):
+    response = client(**kwargs).get(headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers.get('Content-Encoding') == encoding
+    assert response.data == expected
+
+
+def test_without_accept_encoding():
+    response = client().get()
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == BODY
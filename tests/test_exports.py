@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from saythanks import core, exports, storage
+
+UNREACHABLE = 'postgresql://nobody@127.0.0.1:1/nowhere'
+
+
+class FakeReplica:
+    def __init__(self, url, healthy):
+        self.url = url
+        self.healthy = healthy
+
+    def check(self):
+        return self.healthy
+
+
+@pytest.fixture
+def client():
+    return core.app.test_client()
+
+
+def test_read_url_prefers_a_healthy_replica(monkeypatch):
+    monkeypatch.setattr(storage, 'replicas', [FakeReplica('postgresql://down', False),
+                                              FakeReplica('postgresql://up', True)])
+    monkeypatch.setattr(storage, 'pinned_until', lambda: 0)
+    assert storage.read_url() == 'postgresql://up'
+
+
+def test_read_url_falls_back_to_the_primary(monkeypatch):
+    monkeypatch.setattr(storage, 'replicas', [FakeReplica('postgresql://down', False)])
+    assert storage.read_url() == os.environ['DATABASE_URL']
+
+
+def test_copy_falls_back_to_the_primary(inbox, monkeypatch):
+    monkeypatch.setattr(storage, 'read_url', lambda: UNREACHABLE)
+    with exports.CopyOut(exports.INBOX_QUERY, {'auth_id': inbox[1]}) as copy:
+        assert copy.stream.read().startswith(b'uuid,inboxes_auth_id')
+    assert copy.rows == 0
+
+
+def test_admin_export_needs_the_token(inbox, client, monkeypatch):
+    monkeypatch.setenv('EXPORT_TOKEN', 'secret')
+    assert client.get('/admin/export/csv').status_code == 404
+    assert client.get('/admin/export/csv', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    response = client.get('/admin/export/csv', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert response.data.startswith(b'uuid,')
@@ -0,0 +1,82 @@
+import io
+import json
+import time
+
+import pytest
+
+from saythanks import core, imports, ratelimit
+from saythanks.cache import Cache, SharedMemoryBackend
+
+UUID = '5b0f6f3e-8a4c-4d55-9f0e-3c1d2a7b9e10'
+
+
+def ndjson(*rows):
+    return io.BytesIO(''.join(json.dumps(row) + '\n' for row in rows).encode())
+
+
+@pytest.fixture
+def signed_in(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'enabled', False)
+    client = core.app.test_client()
+    with client.session_transaction() as session:
+        session['nickname'] = 'someone'
+        session['_csrf_token'] = 'token'
+    return client
+
+
+def test_repeated_uuid_within_file_is_imported_once(inbox, db):
+    stats = imports.import_notes('someone', ndjson(
+        {'body': 'first', 'uuid': UUID},
+        {'body': 'second', 'uuid': UUID},
+        {'body': 'third'},
+    ), 'ndjson')
+
+    assert (stats['imported'], stats['duplicates']) == (2, 1)
+    db.execute('SELECT body FROM notes WHERE uuid = %s', (UUID,))
+    assert db.fetchall() == [('<p>first</p>',)]
+
+
+def test_repeated_body_and_byline_are_imported_once(inbox, db):
+    rows = [{'body': 'thanks', 'byline': 'Ann'}, {'body': 'thanks', 'byline': 'Ann'},
+            {'body': 'thanks', 'byline': 'Bob'}]
+    assert imports.import_notes('someone', ndjson(*rows), 'ndjson')['imported'] == 2
+    # Nor again when re-run.
+    assert imports.import_notes('someone', ndjson(*rows), 'ndjson')['imported'] == 0
+    db.execute("SELECT notes_active FROM inboxes WHERE slug = 'someone'")
+    assert db.fetchone()[0] == 2
+
+
+def test_import_needs_csrf_token(signed_in):
+    response = signed_in.post('/inbox/import', data={'file': (ndjson({'body': 'hi'}), 'notes.ndjson')})
+    assert response.status_code == 403
+
+
+def test_stale_progress_is_reported_stopped(signed_in):
+    imports.progress_cache.set('someone:abc', {'done': False, 'read': 10, 'heartbeat': time.time() - 3600})
+    assert signed_in.get('/inbox/import/abc').get_json() == {'done': True, 'error': 'The import stopped.'}
+
+
+def test_upload_is_imported_in_its_own_process(inbox, db, tmp_path, monkeypatch):
+    url = f'shm://{tmp_path}/cache'
+    monkeypatch.setenv('CACHE_URL', url)
+    monkeypatch.setattr(imports, 'progress_cache', Cache(SharedMemoryBackend(f'{tmp_path}/cache')).namespace('imports'))
+    upload = tmp_path / 'upload'
+    upload.write_bytes(ndjson({'body': 'thanks'}).getvalue())
+
+    imports.start_upload('someone', 'someone:abc', str(upload), 'ndjson', 'markdown')
+    deadline = time.time() + 60
+    while not (imports.progress_cache.get('someone:abc') or {}).get('done') and time.time() < deadline:
+        time.sleep(0.2)
+
+    assert imports.progress_cache.get('someone:abc')['imported'] == 1
+    assert not upload.exists()
+
+
+def test_unparseable_body_is_rejected_not_fatal(inbox, db):
+    stats = imports.import_notes('someone', ndjson(
+        {'body': '<!-- -->', 'content-type': 'html'},
+        {'body': 'thanks'},
+    ), 'ndjson')
+
+    assert (stats['imported'], stats['rejected']) == (1, 1)
+    assert stats['errors'][0].startswith('row 1: unreadable body')
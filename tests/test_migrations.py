@@ -0,0 +1,165 @@
+import pytest
+
+from saythanks import migrations
+
+from conftest import SCHEMA, connect
+
+
+def quiet(line):
+    pass
+
+
+@pytest.fixture
+def unmigrated(request, database):
+    """A cursor on the scratch database rebuilt with the migrations before
+    007 (or the version parametrized) applied, with an inbox; every
+    migration is applied again after."""
+    from saythanks import storage
+
+    before = getattr(request, 'param', '007')
+
+    storage.disconnect()
+    connection = connect()
+    cursor = connection.cursor()
+    with open(SCHEMA) as f:
+        cursor.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public;' + f.read())
+    # schema.sql empties it.
+    cursor.execute('RESET search_path')
+    for migration in migrations.available():
+        if migration.version < before:
+            migrations.run(connection, migration, quiet)
+    cursor.execute("INSERT INTO inboxes (slug, auth_id, email) VALUES ('someone', 'auth0|someone', 'a@example.com')")
+    yield cursor
+    migrations.migrate(echo=quiet)
+    connection.close()
+
+
+def add_note(cursor, body, archived=False, timestamp='2024-01-15 10:00'):
+    cursor.execute("""
+        INSERT INTO notes (inboxes_auth_id, body, byline, archived, "timestamp")
+        VALUES ('auth0|someone', %s, '', %s, %s) RETURNING uuid
+    """, (body, archived, timestamp))
+    return cursor.fetchone()[0]
+
+
+def notes(cursor, table='notes'):
+    cursor.execute(f'SELECT body, archived, "timestamp" IS NOT NULL FROM {table} ORDER BY body')
+    return cursor.fetchall()
+
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'public.notes'::regclass)")
+    return cursor.fetchone()[0]
+
+
+def test_partitioning_copies_existing_notes(unmigrated):
+    add_note(unmigrated, 'active')
+    add_note(unmigrated, 'archived', archived=True)
+    add_note(unmigrated, 'undated', timestamp=None)
+
+    migrations.migrate(echo=quiet)
+
+    assert is_partitioned(unmigrated)
+    assert notes(unmigrated) == [('active', False, True), ('archived', True, True), ('undated', False, True)]
+    assert len(notes(unmigrated, 'notes_archived_2024')) == 1
+    assert len(notes(unmigrated, 'notes_unpartitioned')) == 3
+    unmigrated.execute("""
+        SELECT to_regclass('public.notes_partitioning_progress'),
+            to_regprocedure('public.notes_partitioning_copy(integer)')
+    """)
+    assert unmigrated.fetchone() == (None, None)
+
+
+def test_partitioning_mirrors_changes_during_copy(unmigrated):
+    kept = add_note(unmigrated, 'kept')
+    archived = add_note(unmigrated, 'to archive')
+    deleted = add_note(unmigrated, 'to delete')
+    migration = next(m for m in migrations.available() if m.version.startswith('007'))
+    copy = next(i for i, s in enumerate(migration.statements) if migrations.BATCH.search(s))
+    connection = unmigrated.connection
+    connection.cursor().execute(f"SET lock_timeout = '{migrations.MIGRATION_LOCK_TIMEOUT}'")
+    for statement in migration.statements[:copy + 1]:
+        migrations.run_statement(connection, statement, quiet)
+
+    # Notes keep changing between the copy and the swap.
+    add_note(unmigrated, 'new')
+    unmigrated.execute('UPDATE notes SET archived = true WHERE uuid = %s', (archived,))
+    unmigrated.execute('DELETE FROM notes WHERE uuid = %s', (deleted,))
+    for statement in migration.statements[copy + 1:]:
+        migrations.run_statement(connection, statement, quiet)
+
+    assert is_partitioned(unmigrated)
+    assert notes(unmigrated) == [('kept', False, True), ('new', False, True), ('to archive', True, True)]
+    unmigrated.execute('SELECT count(*) FROM notes WHERE uuid = %s', (kept,))
+    assert unmigrated.fetchone()[0] == 1
+
+
+@pytest.mark.parametrize('unmigrated', ['006'], indirect=True)
+def test_byline_facet_is_backfilled(unmigrated):
+    for byline in ('Ann', ' ann ', 'Bob'):
+        unmigrated.execute("""
+            INSERT INTO notes (inboxes_auth_id, body, byline) VALUES ('auth0|someone', 'thanks', %s)
+        """, (byline,))
+
+    migrations.migrate(echo=quiet)
+
+    unmigrated.execute('SELECT byline, notes FROM inbox_bylines ORDER BY byline')
+    assert unmigrated.fetchall() == [('ann', 2), ('bob', 1)]
+    unmigrated.execute("SELECT to_regclass('public.inbox_bylines_backfill')")
+    assert unmigrated.fetchone()[0] is None
+
+
+def test_split_statements_keeps_quoted_semicolons():
+    sql = """
+        -- first; not a statement
+        CREATE TABLE t (x text DEFAULT ';');
+        DO $$ BEGIN PERFORM 1; END $$;
+        /* ; */ SELECT 'it''s';
+    """
+    statements = migrations.split_statements(sql)
+    assert len(statements) == 3
+    assert statements[0].startswith('-- first; not a statement')
+    assert statements[1] == 'DO $$ BEGIN PERFORM 1; END $$'
+
+
+def test_directives():
+    migration = next(m for m in migrations.available() if m.version.startswith('006'))
+    assert not migration.transactional
+    batched = [s for s in migration.statements if migrations.BATCH.search(s)]
+    assert len(batched) == 1 and ':batch_size' in batched[0]
+
+
+def test_invalid_concurrent_index_is_rebuilt(db):
+    db.execute('CREATE TABLE scratch (n integer)')
+    try:
+        db.execute('INSERT INTO scratch VALUES (1), (1)')
+        # A unique build that fails on the duplicates leaves an INVALID index.
+        with pytest.raises(Exception):
+            db.execute('CREATE UNIQUE INDEX CONCURRENTLY scratch_idx ON scratch (n)')
+        db.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = 'scratch_idx'::regclass")
+        assert db.fetchone()[0] is False
+
+        echoed = []
+        migrations.run_statement(db.connection, 'CREATE INDEX CONCURRENTLY IF NOT EXISTS scratch_idx ON scratch (n)',
+                                 echoed.append)
+        db.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = 'scratch_idx'::regclass")
+        assert db.fetchone()[0] is True
+        assert any('dropping invalid index scratch_idx' in line for line in echoed)
+    finally:
+        db.execute('DROP TABLE scratch')
+
+
+def test_batched_statement_repeats_until_short(db):
+    db.execute('CREATE TABLE scratch (n integer, done boolean DEFAULT false)')
+    try:
+        db.execute('INSERT INTO scratch SELECT generate_series(1, 25)')
+        echoed = []
+        migrations.run_statement(db.connection, (
+            '-- migrate:batch 10\n'
+            'UPDATE scratch SET done = true WHERE n IN (SELECT n FROM scratch WHERE NOT done LIMIT :batch_size)'
+        ), echoed.append)
+        db.execute('SELECT count(*) FROM scratch WHERE NOT done')
+        assert db.fetchone()[0] == 0
+        assert echoed[-1].strip() == '25 row(s) in all'
+    finally:
+        db.execute('DROP TABLE scratch')
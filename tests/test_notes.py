@@ -0,0 +1,103 @@
+import pytest
+
+from saythanks import core, ratelimit
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(ratelimit, 'enabled', False)
+    return core.app.test_client()
+
+
+@pytest.fixture
+def signed_in(client):
+    with client.session_transaction() as session:
+        session['nickname'] = 'someone'
+        session['_csrf_token'] = 'token'
+    return client
+
+
+def test_clean_note_renders_markdown_and_strips_scripts():
+    body, byline = core.clean_note('**thanks** <script>alert(1)</script>', '<b>Ann</b>')
+    assert '<strong>thanks</strong>' in body
+    assert 'script' not in body
+    assert byline == 'Ann'
+
+
+def test_clean_note_html_keeps_markup_but_not_handlers():
+    body, byline = core.clean_note('<p onclick="steal()">hi<style>p {}</style></p>', 'Ann', 'html')
+    assert body == '<p>hi</p>'
+    assert 'onclick' not in body
+
+
+@pytest.mark.parametrize('body, content_type', [
+    ('', 'markdown'),
+    ('   \n', 'markdown'),
+    ('', 'html'),
+    (' ', 'html'),
+])
+def test_clean_note_rejects_empty_bodies(body, content_type):
+    assert core.clean_note(body, 'Ann', content_type) is None
+
+
+def test_empty_submission_pretends_to_succeed(client):
+    response = client.post('/to/someone/submit',
+                           data={'body': '  ', 'byline': 'Ann', 'content-type': 'markdown'})
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/thanks')
+
+
+def test_bulk_submit_needs_csrf_token(signed_in):
+    response = signed_in.post('/inbox/notes/bulk', json=[{'body': 'hi'}])
+    assert response.status_code == 403
+    response = signed_in.post('/inbox/notes/bulk', json=[{'body': 'hi'}],
+                              headers={'X-CSRF-Token': 'forged'})
+    assert response.status_code == 403
+
+
+def test_bulk_submit_needs_json_content_type(signed_in):
+    # A cross-site form can send text/plain without a preflight.
+    response = signed_in.post('/inbox/notes/bulk', data='[{"body": "hi"}]',
+                              content_type='text/plain', headers={'X-CSRF-Token': 'token'})
+    assert response.status_code == 415
+
+
+def test_bulk_submit_rejects_malformed_notes(signed_in):
+    response = signed_in.post('/inbox/notes/bulk', json={'body': 'hi'},
+                              headers={'X-CSRF-Token': 'token'})
+    assert response.status_code == 400
+    response = signed_in.post('/inbox/notes/bulk', data='{"body": "hi"}\nnot json',
+                              content_type='application/x-ndjson', headers={'X-CSRF-Token': 'token'})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('note', [
+    {'body': '<!-- -->', 'content-type': 'html'},
+    {'body': '<!-- -->'},
+    {'byline': 'Ann'},
+])
+def test_bulk_submit_names_the_unreadable_note(signed_in, note):
+    response = signed_in.post('/inbox/notes/bulk', json=[{'body': 'hi'}, note],
+                              headers={'X-CSRF-Token': 'token'})
+    assert response.status_code == 400
+    assert response.get_json()['index'] == 1
+    assert response.get_json()['error'].startswith('note 1 ')
+
+
+def test_api_hands_out_csrf_token_in_same_site_cookie_session(client):
+    with client.session_transaction() as session:
+        session['nickname'] = 'someone'
+    response = client.get('/api/v1/inbox/changes?limit=0')
+    assert response.status_code == 400
+    token = response.headers['X-CSRF-Token']
+    assert 'SameSite=Lax' in response.headers['Set-Cookie']
+    with client.session_transaction() as session:
+        assert session['_csrf_token'] == token
+
+
+def test_bulk_archive_needs_csrf_token(signed_in):
+    response = signed_in.post('/inbox/archive/notes', data={'before': '2020-01-01'})
+    assert response.status_code == 403
+    response = signed_in.post('/inbox/archive/notes',
+                              data={'before': 'not a date', 'csrf_token': 'token'})
+    assert response.status_code == 400
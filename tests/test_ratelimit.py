@@ -0,0 +1,99 @@
+import pytest
+
+from saythanks import core, ratelimit
+
+
+def test_bucket_allows_burst_then_refills():
+    store = ratelimit.MemoryStore()
+    capacity, rate = ratelimit.parse_limit('2/60')
+    assert store.consume('ip:a', capacity, rate) == (True, 0)
+    assert store.consume('ip:a', capacity, rate) == (True, 0)
+    allowed, retry_after = store.consume('ip:a', capacity, rate)
+    assert not allowed
+    assert 0 < retry_after <= 30
+    # Other clients have buckets of their own.
+    assert store.consume('ip:b', capacity, rate) == (True, 0)
+
+
+def test_store_forgets_least_recent_clients():
+    store = ratelimit.MemoryStore(max_keys=2)
+    for key in ('a', 'b', 'c'):
+        store.consume(key, 1, 1)
+    assert list(store.buckets) == ['b', 'c']
+
+
+def test_rate_limiter_outage_lets_requests_through(monkeypatch):
+    class Broken:
+        def consume(self, *args):
+            raise ConnectionError('down')
+
+    monkeypatch.setattr(ratelimit, 'store', Broken())
+    assert ratelimit.check_submission('1.2.3.4', 'inbox') is None
+
+
+@pytest.fixture
+def seen_ips(monkeypatch):
+    """Records the address each submission is rate-limited by, and rejects
+    it before it reaches the database."""
+    seen = []
+
+    def check_submission(ip, inbox_id):
+        seen.append(ip)
+        return 60
+
+    monkeypatch.setattr(ratelimit, 'check_submission', check_submission)
+    return seen
+
+
+def submit(headers):
+    client = core.app.test_client()
+    return client.post('/to/someone/submit', data={'body': 'hi', 'byline': 'me'},
+                       headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+
+def test_limits_by_address_the_proxy_saw(seen_ips):
+    response = submit({'X-Forwarded-For': '1.2.3.4'})
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '61'
+    assert seen_ips == ['1.2.3.4']
+
+
+def test_forged_forwarded_for_entries_are_ignored(seen_ips):
+    submit({'X-Forwarded-For': '6.6.6.6, 1.2.3.4'})
+    submit({'X-Forwarded-For': '7.7.7.7, 1.2.3.4'})
+    assert seen_ips == ['1.2.3.4', '1.2.3.4']
+
+
+def test_without_proxy_header_uses_peer_address(seen_ips):
+    submit({})
+    assert seen_ips == ['10.0.0.1']
+
+
+class FakeClient:
+    host = '10.0.0.1'
+
+
+class FakeRequest:
+    client = FakeClient()
+
+    def __init__(self, forwarded_for=None):
+        self.headers = {'x-forwarded-for': forwarded_for} if forwarded_for else {}
+
+
+@pytest.mark.parametrize('forwarded_for, expected', [
+    (None, '10.0.0.1'),
+    ('1.2.3.4', '1.2.3.4'),
+    ('6.6.6.6, 1.2.3.4', '1.2.3.4'),
+    ('6.6.6.6,1.2.3.4, ', '1.2.3.4'),
+])
+def test_asgi_client_ip(forwarded_for, expected):
+    asgi = pytest.importorskip('saythanks.asgi')
+    assert asgi.client_ip(FakeRequest(forwarded_for)) == expected
+
+
+def test_metrics_need_the_token(monkeypatch):
+    monkeypatch.setenv('METRICS_TOKEN', 'secret')
+    client = core.app.test_client()
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
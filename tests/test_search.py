@@ -0,0 +1,54 @@
+import hashlib
+
+from saythanks import storage
+from saythanks.cache import Cache, LocalBackend, SharedMemoryBackend
+
+
+def previews(result):
+    return [note.preview for note in result['notes']]
+
+
+def test_search_cache_is_invalidated_per_inbox():
+    first = storage.search_generation('auth0|a')
+    other = storage.search_generation('auth0|b')
+    assert storage.search_generation('auth0|a') == first
+    storage.invalidate_searches('auth0|a')
+    assert storage.search_generation('auth0|a') != first
+    assert storage.search_generation('auth0|b') == other
+
+
+def test_search_sees_new_and_archived_notes(inbox):
+    slug, auth_id = inbox
+    inbox_db = storage.Inbox(slug)
+    kept = inbox_db.submit_note(body='<p>thanks for the cake</p>', byline='Ann')
+    assert previews(inbox_db.search_notes('cake', 1, 25)) == ['thanks for the cake']
+
+    inbox_db.submit_note(body='<p>more cake please</p>', byline='Bob')
+    assert len(previews(inbox_db.search_notes('cake', 1, 25))) == 2
+
+    inbox_db.set_archived([kept.uuid])
+    assert previews(inbox_db.search_notes('cake', 1, 25)) == ['more cake please']
+
+
+def test_stale_cached_ids_never_show_archived_or_foreign_notes(db, inbox):
+    slug, auth_id = inbox
+    db.execute("INSERT INTO inboxes (slug, auth_id) VALUES ('other', 'auth0|other')")
+    inbox_db = storage.Inbox(slug)
+    mine = inbox_db.submit_note(body='<p>cake</p>', byline='')
+    archived = inbox_db.submit_note(body='<p>old cake</p>', byline='')
+    theirs = storage.Inbox('other').submit_note(body='<p>their cake</p>', byline='')
+    inbox_db.search_notes('cake', 1, 25)
+
+    # As if the invalidation of the cached ids had been missed.
+    db.execute("UPDATE notes SET archived = 't' WHERE uuid = %s", (str(archived.uuid),))
+    key = f'{auth_id}:{storage.search_generation(auth_id)}:{hashlib.sha1(b"cake").hexdigest()}'
+    storage.search_cache.set(key, [str(mine.uuid), str(archived.uuid), str(theirs.uuid)])
+    assert previews(inbox_db.search_notes('cake', 1, 25)) == ['cake']
+
+
+def test_unshared_search_cache_is_warned_about(caplog, tmp_path):
+    storage.check_search_cache(Cache(LocalBackend()).namespace('search'))
+    assert 'stale searches' in caplog.text
+    caplog.clear()
+    storage.check_search_cache(Cache(SharedMemoryBackend(f'{tmp_path}/cache')).namespace('search'))
+    assert not caplog.text
@@ -0,0 +1,68 @@
+import io
+import os
+import threading
+
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from saythanks import compression, imports, snapshots, storage
+
+UUID = '5b0f6f3e-8a4c-4d55-9f0e-3c1d2a7b9e10'
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshots, 'SNAPSHOT_DIR', str(tmp_path))
+    return tmp_path
+
+
+def served(accept_encoding):
+    def app(environ, start_response):
+        return Response('dynamic')(environ, start_response)
+    client = Client(snapshots.SnapshotMiddleware(app))
+    return client.get(f'/note/{UUID}', headers={'Accept-Encoding': accept_encoding})
+
+
+@pytest.mark.parametrize('accept, encoding', [
+    ('gzip, br', 'br'),
+    ('br;q=0, gzip', 'gzip'),
+    ('br;q=0, gzip;q=0', None),
+    ('x-gzip-like', None),
+])
+def test_serve_negotiates_encoding(snapshot_dir, monkeypatch, accept, encoding):
+    monkeypatch.setattr(compression, 'brotli', compression.brotli or object())
+    os.makedirs(snapshot_dir / 'note')
+    for suffix in ('', '.gz', '.br'):
+        (snapshot_dir / 'note' / (UUID + suffix)).write_bytes(b'page' + suffix.encode())
+    response = served(accept)
+    assert response.headers.get('Content-Encoding') == encoding
+    assert response.data == b'page' + {'br': b'.br', 'gzip': b'.gz', None: b''}[encoding]
+
+
+def test_notes_are_published_in_the_background(inbox, db, snapshot_dir, monkeypatch):
+    threads = []
+    publish = snapshots.publish
+    monkeypatch.setattr(snapshots, 'publish', lambda note: threads.append(threading.current_thread())
+                        or publish(note))
+    db.execute("INSERT INTO notes (inboxes_auth_id, body, byline) VALUES (%s, 'thanks', 'Ann') RETURNING uuid",
+               (inbox[1],))
+    uuid = db.fetchone()[0]
+
+    snapshots.on_notes_archived(inbox[1], [uuid], archived=False)
+    snapshots.publisher.join()
+
+    assert threads and threading.current_thread() not in threads
+    assert os.path.exists(snapshots.path_for(uuid))
+    snapshots.on_notes_archived(inbox[1], [uuid], archived=True)
+    assert not os.path.exists(snapshots.path_for(uuid))
+
+
+def test_imported_notes_are_published(inbox, db, snapshot_dir):
+    storage.notes_imported.connect(snapshots.on_notes_imported)
+    try:
+        imports.import_notes('someone', io.BytesIO(b'{"body": "thanks"}\n'), 'ndjson')
+    finally:
+        storage.notes_imported.disconnect(snapshots.on_notes_imported)
+    db.execute('SELECT uuid FROM notes')
+    assert os.path.exists(snapshots.path_for(db.fetchone()[0]))
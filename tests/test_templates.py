@@ -0,0 +1,95 @@
+import os
+import runpy
+import subprocess
+import sys
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from flask import render_template
+from gunicorn.config import Config
+
+from saythanks import core, live, storage
+
+SCRIPT = '<script>alert(1)</script>'
+GUNICORN_CONF = os.path.join(os.path.dirname(__file__), '..', 'gunicorn.conf.py')
+
+
+@pytest.fixture
+def note():
+    # Previews are the note's plain text: markup typed as text (&lt;script&gt;
+    # in the stored body) comes back unescaped.
+    return storage.Note.from_inbox(inbox=None, body='&lt;script&gt;alert(1)&lt;/script&gt;',
+                                   byline='Ann', uuid='0' * 32, timestamp=datetime.now(),
+                                   preview=SCRIPT)
+
+
+def render(template, **context):
+    with core.app.test_request_context('/inbox'):
+        return render_template(template, user={'picture': ''}, inbox=None, is_enabled=True,
+                               is_email_enabled=True, page=1, total_pages=1, **context)
+
+
+@pytest.mark.parametrize('template', ['inbox.htm.j2', 'inbox_archived.htm.j2'])
+def test_previews_are_escaped(template, note):
+    html = render(template, notes=[note], search_str='Search by message body or byline')
+    assert SCRIPT not in html
+    assert '&lt;script&gt;alert(1)&lt;/script&gt;' in html
+
+
+def test_unwritable_template_cache_dir_is_skipped(tmp_path):
+    # A path under a regular file can never be created.
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    env = dict(os.environ, JINJA_CACHE_DIR=str(blocker / 'cache'))
+    result = subprocess.run([sys.executable, '-c', 'import saythanks.core as c; '
+                             'assert c.app.jinja_env.bytecode_cache is None'],
+                            env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+@pytest.mark.parametrize('enabled', [True, False])
+def test_live_updates_only_on_workers_that_can_hold_streams(monkeypatch, enabled):
+    monkeypatch.setattr(live, 'SSE_ENABLED', enabled)
+    html = render('inbox.htm.j2', notes=[], search_str='Search by message body or byline', byline='')
+    assert ('EventSource' in html) == enabled
+
+
+@pytest.mark.parametrize('worker_class, enabled', [
+    ('uvicorn.workers.UvicornWorker', True),
+    ('gthread', True),
+    ('sync', False),
+])
+def test_live_updates_follow_the_running_worker_class(monkeypatch, worker_class, enabled):
+    # As with `gunicorn -k uvicorn.workers.UvicornWorker saythanks.asgi:app`:
+    # gunicorn.conf.py is loaded with its default sync profile, then `-k`
+    # overrides the class.
+    monkeypatch.delenv('GUNICORN_PROFILE', raising=False)
+    monkeypatch.delenv('SSE_ENABLED', raising=False)
+    monkeypatch.setattr(live, 'SSE_ENABLED', not enabled)
+    config = Config()
+    config.set('worker_class', worker_class)
+    runpy.run_path(GUNICORN_CONF)['post_fork'](SimpleNamespace(cfg=config), None)
+    assert live.SSE_ENABLED == enabled
+
+
+def test_stream_is_not_served_on_sync_workers(monkeypatch):
+    monkeypatch.setattr(live, 'SSE_ENABLED', False)
+    client = core.app.test_client()
+    with client.session_transaction() as session:
+        session['nickname'] = 'someone'
+    assert client.get('/inbox/stream').status_code == 404
+
+
+def test_byline_filter_is_escaped():
+    html = render('inbox.htm.j2', notes=[], search_str='Search by message body or byline',
+                  byline='"><script>alert(1)</script>')
+    assert '<script>alert(1)' not in html
+
+
+def test_stats_bylines_are_escaped():
+    stats = {'days': 30, 'notes': 1, 'archived': 0, 'hours': [0] * 24, 'weekly': [], 'daily': [],
+             'bylines': [{'key': 'x', 'byline': SCRIPT, 'notes': 1}]}
+    html = render('inbox_stats.htm.j2', stats=stats, busiest_hour=0, busiest_day=0)
+    assert SCRIPT not in html
+    assert '&lt;script&gt;' in html
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""A tiny in-memory redis-protocol server for development and tests.
+
+It speaks enough RESP for the cache, its invalidation broadcast and the
+rate limiter's fallback paths, so the shared backends can be exercised
+without a real redis:
+
+    python tools/fakeredis.py --port 6390
+    CACHE_URL=redis://localhost:6390/0 CACHE_BROADCAST_URL=redis://localhost:6390/0 ...
+
+Lua scripting (EVAL/EVALSHA) is not implemented; callers that need it see
+an error reply, exactly as with a server that has scripting disabled.
+"""
+import argparse
+import socketserver
+import threading
+import time
+from collections import defaultdict
+
+
+class Store:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+        self.expiry = {}
+        self.subscribers = defaultdict(set)
+
+    def _alive(self, key):
+        expires = self.expiry.get(key)
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return key in self.data
+
+
+class Error(Exception):
+    pass
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Handles one client connection, one command at a time."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Inline command, e.g. from telnet.
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def reply(self, value):
+        self.wfile.write(encode(value))
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            try:
+                command = self.read_command()
+            except (ConnectionError, ValueError):
+                return
+            if not command:
+                return
+            name, args = command[0].upper().decode(), command[1:]
+            if name in ('SUBSCRIBE', 'PSUBSCRIBE'):
+                return self.subscribe(args)
+            handler = getattr(self, 'cmd_' + name.lower(), None)
+            try:
+                if handler is None:
+                    raise Error(f"ERR unknown command '{name}'")
+                with store.lock:
+                    self.reply(handler(store, *args))
+            except Error as e:
+                self.reply(e)
+            except (TypeError, ValueError):
+                self.reply(Error(f"ERR wrong arguments for '{name}' command"))
+
+    def subscribe(self, channels):
+        store = self.server.store
+        with store.lock:
+            for i, channel in enumerate(channels, 1):
+                store.subscribers[channel].add(self)
+                self.reply([b'subscribe', channel, i])
+        try:
+            # Block until the client goes away; messages are pushed by PUBLISH.
+            while self.read_command() is not None:
+                pass
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            with store.lock:
+                for channel in channels:
+                    store.subscribers[channel].discard(self)
+
+    # Commands
+    # --------
+
+    def cmd_ping(self, store, message=None):
+        return message if message is not None else Status('PONG')
+
+    def cmd_client(self, store, *args):
+        return Status('OK')
+
+    def cmd_select(self, store, db):
+        return Status('OK')
+
+    def cmd_flushdb(self, store, *args):
+        store.data.clear()
+        store.expiry.clear()
+        return Status('OK')
+
+    cmd_flushall = cmd_flushdb
+
+    def cmd_get(self, store, key):
+        if not store._alive(key):
+            return None
+        return store.data[key]
+
+    def cmd_set(self, store, key, value, *options):
+        options = [o.upper() for o in options]
+        expires = None
+        if b'EX' in options:
+            expires = time.time() + int(options[options.index(b'EX') + 1])
+        if b'PX' in options:
+            expires = time.time() + int(options[options.index(b'PX') + 1]) / 1000
+        exists = store._alive(key)
+        if (b'NX' in options and exists) or (b'XX' in options and not exists):
+            return None
+        store.data[key] = value
+        store.expiry.pop(key, None)
+        if expires is not None:
+            store.expiry[key] = expires
+        return Status('OK')
+
+    def cmd_del(self, store, *keys):
+        deleted = 0
+        for key in keys:
+            if store._alive(key):
+                del store.data[key]
+                store.expiry.pop(key, None)
+                deleted += 1
+        return deleted
+
+    def cmd_incrby(self, store, key, amount):
+        value = int(store.data[key]) if store._alive(key) else 0
+        value += int(amount)
+        store.data[key] = str(value).encode()
+        return value
+
+    def cmd_incr(self, store, key):
+        return self.cmd_incrby(store, key, b'1')
+
+    def cmd_expire(self, store, key, seconds):
+        if not store._alive(key):
+            return 0
+        store.expiry[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_ttl(self, store, key):
+        if not store._alive(key):
+            return -2
+        if key not in store.expiry:
+            return -1
+        return int(store.expiry[key] - time.time())
+
+    def cmd_publish(self, store, channel, message):
+        receivers = list(store.subscribers[channel])
+        for client in receivers:
+            try:
+                client.reply([b'message', channel, message])
+            except OSError:
+                store.subscribers[channel].discard(client)
+        return len(receivers)
+
+
+class Status(str):
+    pass
+
+
+def encode(value):
+    if isinstance(value, Error):
+        return b'-' + str(value).encode() + b'\r\n'
+    if isinstance(value, Status):
+        return b'+' + value.encode() + b'\r\n'
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode(v) for v in value)
+    if isinstance(value, str):
+        value = value.encode()
+    return b'$%d\r\n' % len(value) + value + b'\r\n'
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, Handler)
+        self.store = Store()
+
+
+def serve_in_background(host='127.0.0.1', port=0):
+    """Starts a server on a thread; returns it (see `server.server_address`)."""
+    server = Server((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    with Server((args.host, args.port)) as server:
+        print(f'fakeredis listening on {args.host}:{args.port}')
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()